@@ -1,26 +1,29 @@
 import pandas as pd
-import os
-import matplotlib.pyplot as plt
+import os, sys
 import geopandas as gpd
-import contextily as ctx
+import shapely
 import warnings
-import folium
-from folium.plugins import HeatMap
-from shapely.geometry import Point, Polygon
-from sklearn.decomposition import PCA
+
+# Make the shared mosaiks_query package importable when run from GDP_replication/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mosaiks_query.basemap import BasemapTiles, render_shrid_images
+from mosaiks_query.heatmaps import export_heatmaps, render_heatmaps
+from mosaiks_query.polygons import parse_polygons
+from mosaiks_query.projection import FeatureProjection
+from mosaiks_query.storage import read_table, write_table
 
 warnings.filterwarnings('ignore')
 
 def load_data(mosaik_file: str, polygon_file: str):
     """
-    Load Mosaik and polygon data from CSV files.
+    Load Mosaik and polygon data from CSV, Parquet or Feather files.
 
     Parameters
     ----------
     mosaik_file : str
-        Path to the Mosaik CSV file.
+        Path to the Mosaik table.
     polygon_file : str
-        Path to the polygon CSV file.
+        Path to the polygon table.
 
     Returns
     -------
@@ -28,8 +31,8 @@ def load_data(mosaik_file: str, polygon_file: str):
         Loaded dataframes: (mosaik_data, polygon_data)
     """
     try:
-        mosaik_data = pd.read_csv(mosaik_file)
-        polygon_data = pd.read_csv(polygon_file)
+        mosaik_data = read_table(mosaik_file)
+        polygon_data = read_table(polygon_file)
         return mosaik_data, polygon_data
     except Exception as e:
         raise IOError(f"Error loading files: {e}")
@@ -48,7 +51,7 @@ def merge_data(mosaik_data: pd.DataFrame,
     polygon_data : pd.DataFrame
         DataFrame containing polygon data.
     output_file : str, optional
-        If provided, save the merged DataFrame to the given CSV file path.
+        If provided, save the merged DataFrame to the given path (.csv, .parquet or .feather).
 
     Returns
     -------
@@ -57,7 +60,7 @@ def merge_data(mosaik_data: pd.DataFrame,
     """
     merged_data = pd.merge(mosaik_data, polygon_data, on='shrid', how='inner')
     if output_file:
-        merged_data.to_csv(output_file, index=False)
+        write_table(merged_data, output_file)
     return merged_data
 
 def rename_mosaik_features(data: pd.DataFrame, 
@@ -76,7 +79,7 @@ def rename_mosaik_features(data: pd.DataFrame,
     prefix : str, optional
         The prefix for renamed columns.
     output_file : str, optional
-        If provided, save the renamed DataFrame to the given CSV file path.
+        If provided, save the renamed DataFrame to the given path (.csv, .parquet or .feather).
 
     Returns
     -------
@@ -86,14 +89,17 @@ def rename_mosaik_features(data: pd.DataFrame,
     for i, col in enumerate(data.columns[start_col_index:], start=1):
         data.rename(columns={col: f"{prefix}{i}"}, inplace=True)
     if output_file:
-        data.to_csv(output_file, index=False)
+        write_table(data, output_file)
     return data
 
 def save_shrid_images(data: pd.DataFrame, 
                       output_dir: str, 
                       urban_threshold_lat: float = 10.0,
                       urban_threshold_lon: float = 75.0,
-                      zoom_level: int = 15):
+                      zoom_level: int = 15,
+                      processes: int = None,
+                      tile_dir: str = "cache/basemap",
+                      offline: bool = False):
     """
     Save images of shrids (polygons) that meet an 'urban' threshold criterion.
 
@@ -109,30 +115,28 @@ def save_shrid_images(data: pd.DataFrame,
         Longitude threshold for defining urban shrids.
     zoom_level : int, optional
         Zoom level for the basemap.
+    processes : int, optional
+        Number of worker processes drawing images. Defaults to the CPU count.
+    tile_dir : str, optional
+        Directory of the imagery tile cache, shared across shrids and runs.
+    offline : bool, optional
+        Draw only from tiles already in ``tile_dir``, without any download.
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    # Ensure polygon_coordinates can be parsed into Polygon objects
-    data['geometry'] = data.apply(lambda row: Polygon(eval(row['polygon_coordinates'])), axis=1)
+    # Parse polygon_coordinates into Polygon objects in one vectorized pass
+    data['geometry'] = parse_polygons(data['polygon_coordinates'])
     gdf = gpd.GeoDataFrame(data, geometry='geometry', crs="EPSG:4326")
 
     # Determine urban shrids based on centroid
-    gdf['is_urban'] = gdf['geometry'].apply(
-        lambda poly: poly.centroid.y > urban_threshold_lat and poly.centroid.x > urban_threshold_lon
-    )
+    centroids = shapely.centroid(gdf['geometry'].values)
+    gdf['is_urban'] = (shapely.get_y(centroids) > urban_threshold_lat) & (shapely.get_x(centroids) > urban_threshold_lon)
     urban_gdf = gdf[gdf['is_urban']]
 
-    def plot_shrid(shrid_row):
-        fig, ax = plt.subplots(figsize=(10, 10))
-        gdf[gdf['shrid2'] == shrid_row['shrid2']].plot(ax=ax, facecolor="none", edgecolor="blue", linewidth=2)
-        ctx.add_basemap(ax, crs=gdf.crs.to_string(), source=ctx.providers.Esri.WorldImagery, attribution=False, zoom=zoom_level)
-        ax.axis("off")
-        sanitized_shrid = str(shrid_row['shrid2']).replace('-', '_')
-        plt.savefig(os.path.join(output_dir, f"shrid_{sanitized_shrid}.png"), dpi=300, bbox_inches='tight')
-        plt.close(fig)
-
-    for _, row in urban_gdf.iterrows():
-        plot_shrid(row)
+    # Each imagery tile is downloaded once into the tile cache, then images are drawn in parallel
+    paths = [os.path.join(output_dir, f"shrid_{str(shrid).replace('-', '_')}.png") for shrid in urban_gdf['shrid2']]
+    render_shrid_images(urban_gdf['geometry'].values, paths, BasemapTiles(cache_dir=tile_dir, offline=offline),
+                        zoom=zoom_level, processes=processes)
 
 def generate_heatmaps(data: pd.DataFrame,
                       output_folder: str,
@@ -140,7 +144,12 @@ def generate_heatmaps(data: pd.DataFrame,
                       lon_col: str = 'Lon_x',
                       polygon_col: str = 'polygon_coordinates', 
                       feature_start_idx: int = 4,
-                      zoom_start: int = 15):
+                      zoom_start: int = 15,
+                      processes: int = None,
+                      source: str = None,
+                      force: bool = False,
+                      projection_file: str = None,
+                      mode: str = 'html'):
     """
     Generate interactive HTML heatmaps for each unique shrid in the data.
 
@@ -160,44 +169,41 @@ def generate_heatmaps(data: pd.DataFrame,
         Index from which Mosaik features start.
     zoom_start : int, optional
         Initial zoom level for the folium map.
+    processes : int, optional
+        Number of worker processes rendering maps. Defaults to the CPU count.
+    source : str, optional
+        Path of the table ``data`` was loaded from; heatmaps newer than it
+        are not rendered again.
+    force : bool, optional
+        Re-render heatmaps even if they are up to date.
+    projection_file : str, optional
+        ``.npz`` file for the fitted PCA projection. If it exists the saved
+        projection is reused instead of refitting; otherwise it is fitted and
+        saved there.
+    mode : {'html', 'binary'}, optional
+        One standalone folium HTML per shrid, or a shared ``index.html``
+        viewer plus a compact ``data/<shrid>.bin`` per shrid (see
+        `mosaiks_query.heatmaps.export_heatmaps`), which is much smaller on
+        disk and is viewed with ``python -m http.server``.
     """
-    os.makedirs(output_folder, exist_ok=True)
-
-    # Convert polygon coordinates to geometry
-    data['geometry'] = data[polygon_col].apply(lambda coords: Polygon(eval(coords)))
-    gdf = gpd.GeoDataFrame(data, geometry="geometry", crs="EPSG:4326")
-
-    # Extract Mosaik features for PCA
+    # Extract Mosaik features for PCA, fitted in float32 batches
     mosaik_features = data.iloc[:, feature_start_idx:]
-    pca = PCA(n_components=1)
-    data['PCA_1'] = pca.fit_transform(mosaik_features)
-
-    # Generate heatmaps for each shrid
-    for shrid_id in gdf["shrid2"].unique():
-        selected_data = gdf[gdf["shrid2"] == shrid_id]
-        if selected_data.empty:
-            continue
-
-        selected_polygon = selected_data["geometry"].iloc[0]
-        heatmap_data = [
-            [row[lat_col], row[lon_col], row['PCA_1']]
-            for _, row in selected_data.iterrows()
-            if selected_polygon.contains(Point(row[lon_col], row[lat_col]))
-        ]
-
-        # If no data points fall inside the polygon, skip
-        if not heatmap_data:
-            continue
-
-        x_min, y_min, x_max, y_max = selected_polygon.bounds
-        map_center = [(y_min + y_max) / 2, (x_min + x_max) / 2]
-
-        m = folium.Map(location=map_center, zoom_start=zoom_start)
-        folium.Polygon(
-            locations=[(p[1], p[0]) for p in selected_polygon.exterior.coords],
-            color='blue', weight=2, fill=True, fill_opacity=0.2
-        ).add_to(m)
-        HeatMap(heatmap_data).add_to(m)
-
-        html_file = os.path.join(output_folder, f"polygon_with_heatmap_{shrid_id}.html")
-        m.save(html_file)
\ No newline at end of file
+    if projection_file:
+        projection = FeatureProjection.load_or_fit(projection_file, mosaik_features)
+    else:
+        projection = FeatureProjection.fit(mosaik_features)
+    data['PCA_1'] = projection.transform_source(mosaik_features)[:, 0]
+
+    # Every row of a shrid carries its polygon; parse it once per shrid
+    first_rows = data.drop_duplicates('shrid2')
+    polygons = pd.Series(parse_polygons(first_rows[polygon_col]), index=first_rows['shrid2'].to_numpy())
+
+    if mode == 'binary':
+        export_heatmaps(data['shrid2'], data[lat_col], data[lon_col], data['PCA_1'], polygons, output_folder,
+                        inside_only=True, source=source, force=force)
+        return
+
+    # Group once and render the shrids in parallel, keeping only points inside each polygon
+    render_heatmaps(data['shrid2'], data[lat_col], data[lon_col], data['PCA_1'], polygons, output_folder,
+                    file_pattern="polygon_with_heatmap_{id}.html", inside_only=True,
+                    zoom_start=zoom_start, processes=processes, source=source, force=force)
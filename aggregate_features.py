@@ -1,25 +1,29 @@
-import pandas as pd
+from mosaiks_query.pipeline import SHAPEFILE, aggregate_villages, open_dataset
+from mosaiks_query.pipeline import aggregate as aggregate_table
+from mosaiks_query.storage import output_path
 
-def aggregate(data, file=""):
-    # Load the dataset and rename duplicate columns
-    df = data
+def aggregate(data, file="", stats=('mean',)):
+    # The data can be a DataFrame, a table path (read in batches), a FeatureStore
+    # or any iterable of DataFrame chunks. Running per-village sums and counts
+    # replace the in-memory groupby; NaN values still count as 0
+    output_file = output_path(f"{file}average")
 
-    # Fill NaN values with 0 for averaging
-    df = df.fillna(0)
-
-    # Identify feature columns (all columns with 'X' in the name)
-    feature_columns = [col for col in df.columns if 'X' in col]
+    # Save the result to a new file (without Lat and Lon)
+    aggregate_table(data, output_file, id_column='v_shp_id', stats=stats)
 
-    # Group by 'v_id' and calculate the mean for each feature column
-    average_features_df = df.groupby('v_shp_id')[feature_columns].mean().reset_index()
+    print(f"Averaged features saved to {output_file}")
 
-    # Save the result to a new file (without Lat and Lon)
-    output_file = f"output/{file}average.csv"
-    average_features_df.to_csv(output_file, index=False)
+def aggregate_in_query(box=False, stats=('mean',)):
+    # Let Redivis average the points inside each village (or its bounding box) and download
+    # one row per village instead of every point; no coords_inside file is needed
+    output_file = output_path("coords_inside_box_average" if box else "coords_inside_average")
+    aggregate_villages(open_dataset(), SHAPEFILE, 'v_shp_id', bbox=box, output=output_file, stats=stats)
 
     print(f"Averaged features saved to {output_file}")
 
-# Example usage
-merged_file = "output/coords_inside.csv"
-df = pd.read_csv(merged_file)
-aggregate(df, "coords_inside_")
\ No newline at end of file
+# Example usage; also available as
+# `python -m mosaiks_query aggregate --input output/coords_inside.parquet --output output/coords_inside_average.parquet`;
+# `aggregate_in_query()` (or `python -m mosaiks_query query --aggregate --output ...`) skips downloading the points
+if __name__ == '__main__':
+    merged_file = output_path("coords_inside")
+    aggregate(merged_file, "coords_inside_")
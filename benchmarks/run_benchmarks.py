@@ -0,0 +1,178 @@
+"""End-to-end benchmarks of the query -> join -> aggregate -> render pipeline.
+
+Runs every stage on synthetic villages and a fake Redivis dataset (see
+`synthetic`), so no network access or credentials are needed, and reports
+wall time, throughput and peak memory per stage.
+
+Usage (from the repository root):
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --scales 1000 10000 100000 --features 256
+    python benchmarks/run_benchmarks.py --output before.jsonl
+    python benchmarks/run_benchmarks.py --compare before.jsonl
+
+Peak memory is the process peak RSS during each stage. On Linux the peak is
+reset before every stage through ``/proc/self/clear_refs``; elsewhere it is
+the peak of the run so far. At 4000 features every 10k villages need
+roughly 0.5 GB of feature rows; use ``--features`` for the larger scales.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mosaiks_query.aggregate import aggregate_stream
+from mosaiks_query.cache import TileCache
+from mosaiks_query.grid_join import CellMembership
+from mosaiks_query.heatmaps import export_heatmaps, render_heatmaps
+from mosaiks_query.index import CoordinateIndex
+from mosaiks_query.lattice import key_coords
+from mosaiks_query.planner import plan_cells
+from mosaiks_query.projection import FeatureProjection
+from mosaiks_query.scheduler import QueryScheduler
+
+from synthetic import SyntheticDataset, synthetic_villages
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _stage(results, scale, name, func, rows=None):
+    """Run ``func`` once, record its timing and memory, and return its result."""
+    _reset_peak_rss()
+    started = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - started
+    count = rows(value) if rows is not None else None
+    results.append({
+        'scale': scale, 'stage': name, 'seconds': round(seconds, 4), 'rows': count,
+        'rows_per_second': round(count / seconds) if count and seconds > 0 else None,
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    })
+    print(f"  {name:<16} {seconds:9.3f}s" + (f"  {count:>10,} rows" if count is not None else ""))
+    return value
+
+
+def run_scale(scale, args, workdir):
+    """Benchmark every stage for ``scale`` villages; return the stage records."""
+    print(f"{scale:,} villages")
+    results = []
+    dataset = SyntheticDataset(args.features, latency=args.latency)
+    villages = _stage(results, scale, 'villages', lambda: synthetic_villages(scale, seed=args.seed), len)
+    geometries, ids = villages.geometry.values, villages['v_shp_id'].to_numpy()
+
+    membership = _stage(results, scale, 'membership',
+                        lambda: CellMembership.from_geometries(geometries, ids, False), len)
+    if args.sjoin:
+        # The gpd.sjoin the scripts used before grid_join, on the same cells
+        lons, lats = key_coords(membership.keys)
+        points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(lons, lats), crs="EPSG:4326")
+        _stage(results, scale, 'sjoin', lambda: gpd.sjoin(points, villages, predicate='within'), len)
+
+    _stage(results, scale, 'plan', lambda: plan_cells(membership.keys), len)
+    cache = TileCache(dataset, cache_dir=os.path.join(workdir, f"cache_{scale}"),
+                      scheduler=QueryScheduler(max_workers=args.workers))
+    rows = _stage(results, scale, 'query', lambda: cache.get_cells(membership.keys), len)
+    results[-1]['queries'] = dataset.queries
+    _stage(results, scale, 'query_cached', lambda: cache.get_cells(membership.keys), len)
+
+    joined = _stage(results, scale, 'join', lambda: membership.join(rows, id_column='v_shp_id'), len)
+    index = _stage(results, scale, 'index', lambda: CoordinateIndex.from_frame(rows), len)
+    _stage(results, scale, 'lookup', lambda: index.lookup(joined['lon'], joined['lat']), len)
+
+    features = joined[dataset.columns]
+    _stage(results, scale, 'aggregate', lambda: aggregate_stream(joined, id_column='v_shp_id'), len)
+    projection = _stage(results, scale, 'pca_fit', lambda: FeatureProjection.fit(features), lambda _: len(features))
+    scores = _stage(results, scale, 'pca_transform', lambda: projection.transform_source(features)[:, 0], len)
+
+    polygons = villages.set_index('v_shp_id')['geometry']
+    _stage(results, scale, 'export_heatmaps',
+           lambda: export_heatmaps(joined['v_shp_id'], joined['lat'], joined['lon'], scores, polygons,
+                                   os.path.join(workdir, f"viewer_{scale}"), force=True), lambda n: n)
+    # folium rendering is slow, so only a sample of villages is drawn
+    sample = np.isin(joined['v_shp_id'].to_numpy(), ids[:args.render_sample])
+    _stage(results, scale, 'render_heatmaps',
+           lambda: render_heatmaps(joined['v_shp_id'][sample], joined['lat'][sample], joined['lon'][sample],
+                                   scores[sample], polygons, os.path.join(workdir, f"html_{scale}"),
+                                   processes=args.processes, force=True), lambda n: n)
+    return results
+
+
+def print_summary(results, baseline=None):
+    """Print one line per stage, with the speed-up over ``baseline`` if given."""
+    previous = {(r['scale'], r['stage']): r for r in baseline or []}
+    print(f"\n{'scale':>8} {'stage':<16} {'seconds':>9} {'rows/s':>12} {'peak MB':>9}"
+          + (f" {'vs base':>8}" if previous else ""))
+    for r in results:
+        line = (f"{r['scale']:>8,} {r['stage']:<16} {r['seconds']:>9.3f} {r['rows_per_second'] or '':>12}"
+                f" {r['peak_rss_mb']:>9.1f}")
+        before = previous.get((r['scale'], r['stage']))
+        if before and r['seconds'] > 0:
+            line += f" {before['seconds'] / r['seconds']:>7.2f}x"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000], help="numbers of villages")
+    parser.add_argument('--features', type=int, default=4000, help="X_* columns per point")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each fake query")
+    parser.add_argument('--workers', type=int, default=1, help="concurrent fake queries")
+    parser.add_argument('--processes', type=int, default=1, help="heatmap render processes")
+    parser.add_argument('--render-sample', type=int, default=100, help="villages drawn with folium")
+    parser.add_argument('--sjoin', action='store_true', help="also time the old gpd.sjoin")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results as JSON lines")
+    parser.add_argument('--compare', help="JSON lines from an earlier run to compare against")
+    parser.add_argument('--keep', action='store_true', help="keep the working directory")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="mosaiks_bench_")
+    try:
+        results = []
+        for scale in args.scales:
+            results += run_scale(scale, args, workdir)
+    finally:
+        if args.keep:
+            print(f"Working files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+    print_summary(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.writelines(json.dumps(r) + "\n" for r in results)
+
+
+if __name__ == '__main__':
+    main()
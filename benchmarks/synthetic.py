@@ -0,0 +1,163 @@
+"""Synthetic MOSAIKS data and village polygons for the benchmarks.
+
+`SyntheticDataset` stands in for ``redivis.organization(...).dataset(...)``:
+it answers the SQL that `TileCache` sends (whole tiles, range bands,
+``lon IN`` lists and ``lon = x AND lat = y`` terms) with a row for every
+lattice cell. The features are generated from the cell key, so they are
+always the same for a cell, and no national table has to exist in memory.
+It can also jitter its latency and fail on chosen calls, to exercise the
+retries and ordering of `QueryScheduler`.
+"""
+import re
+import threading
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from mosaiks_query.lattice import cell_keys, index_keys, key_coords
+
+_RANGE = re.compile(r"lat > (-?[\d.]+) AND lat < (-?[\d.]+) AND lon > (-?[\d.]+) AND lon < (-?[\d.]+)")
+_IN_LIST = re.compile(r"lat = (-?[\d.]+) AND lon IN \(([^)]*)\)")
+_BOX = re.compile(r"lon >= (-?[\d.]+) AND lon < (-?[\d.]+) AND lat >= (-?[\d.]+) AND lat < (-?[\d.]+)")
+_POINT = re.compile(r"lon = (-?[\d.]+) AND lat = (-?[\d.]+)")
+
+# Number of hidden factors the features are built from, so PCA has structure to find
+_FACTORS = 8
+
+
+class _Result:
+    def __init__(self, df):
+        self.df = df
+
+    def to_pandas_dataframe(self):
+        return self.df
+
+
+def _box_keys(lon_lo, lon_hi, lat_lo, lat_hi):
+    """Keys of the lattice centres inside a box whose edges fall between centres."""
+    cols = np.arange(int(np.ceil(lon_lo * 100 - 0.5)), int(np.ceil(lon_hi * 100 - 0.5)))
+    rows = np.arange(int(np.ceil(lat_lo * 100 - 0.5)), int(np.ceil(lat_hi * 100 - 0.5)))
+    grid_cols, grid_rows = np.meshgrid(cols, rows)
+    return index_keys(grid_cols.ravel(), grid_rows.ravel())
+
+
+class SyntheticDataset:
+    """
+    Fake Redivis dataset serving synthetic MOSAIKS rows for any cell.
+
+    Parameters
+    ----------
+    num_features : int, optional
+        Number of X_* columns.
+    latency : float, optional
+        Seconds each query sleeps before answering, to mimic a round trip.
+    seed : int, optional
+        Seed of the feature loadings, jitter and random failures.
+    jitter : float, optional
+        Extra random latency of up to this many seconds per query.
+    errors : dict of int to Exception, optional
+        Exceptions to raise on given calls, numbered from 1 in arrival order,
+        e.g. ``{1: ConnectionError("reset")}`` fails only the first call.
+    failure_rate : float, optional
+        Probability that any other call raises ``ConnectionError``.
+
+    Attributes
+    ----------
+    calls : int
+        Queries received, including failed ones.
+    queries, rows : int
+        Queries answered and rows returned.
+    """
+
+    def __init__(self, num_features: int = 4000, latency: float = 0.0, seed: int = 0,
+                 jitter: float = 0.0, errors=None, failure_rate: float = 0.0):
+        rng = np.random.default_rng(seed)
+        self.loadings = rng.standard_normal((_FACTORS, num_features)).astype(np.float32)
+        self.columns = [f'X_{i}' for i in range(num_features)]
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = dict(errors or {})
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.queries = 0
+        self.rows = 0
+
+    def features(self, keys):
+        """Deterministic (len(keys), num_features) float32 features of each cell."""
+        keys = np.asarray(keys, dtype=np.int64)
+        phases = (keys[:, None] % 7919) * np.arange(1, _FACTORS + 1) * 0.61803398875
+        factors = np.sin(phases).astype(np.float32)
+        return factors @ self.loadings
+
+    def rows_for(self, keys):
+        """MOSAIKS-shaped rows (lon, lat, X_0..) for the given cells."""
+        keys = np.unique(np.asarray(keys, dtype=np.int64))
+        lons, lats = key_coords(keys)
+        df = pd.DataFrame(self.features(keys), columns=self.columns)
+        df.insert(0, 'lat', lats)
+        df.insert(0, 'lon', lons)
+        return df
+
+    def query(self, sql):
+        """Answer a ``SELECT * ... WHERE`` query built by `TileCache`."""
+        # Queries may arrive from several scheduler threads at once
+        with self.lock:
+            self.calls += 1
+            error = self.errors.get(self.calls)
+            if error is None and self.failure_rate and self.rng.random() < self.failure_rate:
+                error = ConnectionError(f"synthetic failure of call {self.calls}")
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        if error is not None:
+            raise error
+
+        where = " ".join(sql.split('WHERE', 1)[1].split())
+        keys = []
+        boxes = [(lon_lo, lon_hi, lat_lo, lat_hi) for lat_lo, lat_hi, lon_lo, lon_hi in _RANGE.findall(where)]
+        for lon_lo, lon_hi, lat_lo, lat_hi in boxes + _BOX.findall(where):
+            keys.append(_box_keys(float(lon_lo), float(lon_hi), float(lat_lo), float(lat_hi)))
+        for lat, lons in _IN_LIST.findall(where):
+            lons = np.array(lons.split(','), dtype=np.float64)
+            keys.append(cell_keys(lons, np.full(len(lons), float(lat))))
+        points = _POINT.findall(where)
+        if points:
+            lons, lats = np.array(points, dtype=np.float64).T
+            keys.append(cell_keys(lons, lats))
+        df = self.rows_for(np.concatenate(keys) if keys else [])
+        with self.lock:
+            self.queries += 1
+            self.rows += len(df)
+        return _Result(df)
+
+
+def synthetic_villages(count: int, seed: int = 0, origin=(75.0, 20.0), spacing: float = 0.03,
+                       radius: float = 0.012, vertices: int = 12):
+    """
+    Irregular village polygons on a jittered grid, roughly square overall.
+
+    Each village is a star-shaped polygon of ``vertices`` points around its
+    centre, typically covering 2-4 lattice cells like a small Indian
+    village. Villages do not overlap.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Columns ``v_shp_id`` (1..count) and ``geometry`` in EPSG:4326.
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(count)))
+    index = np.arange(count)
+    centres = np.column_stack([origin[0] + (index % side) * spacing, origin[1] + (index // side) * spacing])
+    centres += rng.uniform(-0.2, 0.2, (count, 2)) * (spacing - 2 * radius)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, (count, vertices)), axis=1)
+    radii = radius * rng.uniform(0.5, 1.0, (count, vertices))
+    rings = np.stack([centres[:, None, 0] + radii * np.cos(angles),
+                      centres[:, None, 1] + radii * np.sin(angles)], axis=-1)
+    geometry = shapely.polygons(np.concatenate([rings, rings[:, :1]], axis=1))
+    return gpd.GeoDataFrame({'v_shp_id': index + 1}, geometry=geometry, crs="EPSG:4326")
@@ -0,0 +1 @@
+"""Shared building blocks for querying and processing MOSAIKS data."""
@@ -0,0 +1,3 @@
+from mosaiks_query.cli import main
+
+main()
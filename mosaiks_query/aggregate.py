@@ -0,0 +1,228 @@
+"""Out-of-core per-village aggregation of MOSAIKS features.
+
+`VillageAggregator` keeps running per-village sums, sums of squares, minima,
+maxima and point counts in NumPy arrays. Points can be fed in any number of
+chunks (CSV chunks, Parquet row groups, query tiles or feature store slices),
+so national-scale point sets never have to be loaded at once.
+"""
+import numpy as np
+import pandas as pd
+
+from mosaiks_query import metrics
+from mosaiks_query.feature_store import FeatureStore
+from mosaiks_query.storage import feature_columns, iter_table
+
+STATS = ('mean', 'std', 'min', 'max', 'count')
+
+
+class VillageAggregator:
+    """
+    Streaming group-by over village IDs.
+
+    Parameters
+    ----------
+    id_column : str, optional
+        Column holding the village/shrid ID.
+    stats : tuple of str, optional
+        Statistics to report, any of 'mean', 'std', 'min', 'max', 'count'.
+        Means are always tracked; the others only cost memory when requested.
+
+    Missing feature values are treated as 0, like the ``fillna(0)`` the
+    original in-memory aggregation did.
+    """
+
+    def __init__(self, id_column: str = 'v_shp_id', stats=('mean',)):
+        unknown = set(stats) - set(STATS)
+        if unknown:
+            raise ValueError(f"Unknown statistics: {sorted(unknown)}")
+        self.id_column = id_column
+        self.stats = tuple(stats)
+        self.feature_names = None
+        self.slots = {}
+        self.ids = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = None
+        self.sumsq = None
+        self.mins = None
+        self.maxs = None
+
+    def _grow(self, size, num_features):
+        """Make room for at least ``size`` villages, doubling the arrays."""
+        if self.sums is None:
+            capacity = max(size, 1024)
+            self.counts = np.zeros(capacity, dtype=np.int64)
+            self.sums = np.zeros((capacity, num_features))
+            if 'std' in self.stats:
+                self.sumsq = np.zeros((capacity, num_features))
+            if 'min' in self.stats:
+                self.mins = np.full((capacity, num_features), np.inf)
+            if 'max' in self.stats:
+                self.maxs = np.full((capacity, num_features), -np.inf)
+            return
+        if size <= len(self.counts):
+            return
+
+        capacity = max(size, 2 * len(self.counts))
+        extra = capacity - len(self.counts)
+        self.counts = np.concatenate([self.counts, np.zeros(extra, dtype=np.int64)])
+        self.sums = np.vstack([self.sums, np.zeros((extra, num_features))])
+        if self.sumsq is not None:
+            self.sumsq = np.vstack([self.sumsq, np.zeros((extra, num_features))])
+        if self.mins is not None:
+            self.mins = np.vstack([self.mins, np.full((extra, num_features), np.inf)])
+        if self.maxs is not None:
+            self.maxs = np.vstack([self.maxs, np.full((extra, num_features), -np.inf)])
+
+    def _slots(self, ids):
+        """Return the global slot of each distinct ID, registering new villages."""
+        slots = np.empty(len(ids), dtype=np.int64)
+        for i, village in enumerate(ids.tolist()):
+            slot = self.slots.get(village)
+            if slot is None:
+                slot = self.slots[village] = len(self.ids)
+                self.ids.append(village)
+            slots[i] = slot
+        return slots
+
+    def update(self, ids, features, feature_names=None):
+        """
+        Add a chunk of points.
+
+        Parameters
+        ----------
+        ids : array-like
+            Village ID of each point.
+        features : array-like
+            (points, features) matrix, e.g. a feature store slice.
+        feature_names : list of str, optional
+            Names of the feature columns; required on the first call if the
+            result should carry them.
+        """
+        features = np.nan_to_num(np.asarray(features, dtype=np.float64), nan=0.0)
+        if len(features) == 0:
+            return
+        if self.feature_names is None:
+            self.feature_names = (list(feature_names) if feature_names is not None
+                                  else [f'X_{i}' for i in range(features.shape[1])])
+
+        # Map this chunk's IDs to global slots, registering new villages
+        chunk_ids, inverse = np.unique(np.asarray(ids), return_inverse=True)
+        slots = self._slots(chunk_ids)
+        self._grow(len(self.ids), features.shape[1])
+
+        # Reduce the chunk per village with one sort and reduceat per statistic
+        order = np.argsort(inverse, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0])
+        sorted_features = features[order]
+        self.counts[slots] += np.diff(np.r_[starts, len(order)])
+        self.sums[slots] += np.add.reduceat(sorted_features, starts, axis=0)
+        if self.sumsq is not None:
+            self.sumsq[slots] += np.add.reduceat(sorted_features ** 2, starts, axis=0)
+        if self.mins is not None:
+            self.mins[slots] = np.minimum(self.mins[slots], np.minimum.reduceat(sorted_features, starts, axis=0))
+        if self.maxs is not None:
+            self.maxs[slots] = np.maximum(self.maxs[slots], np.maximum.reduceat(sorted_features, starts, axis=0))
+
+    def add_totals(self, ids, counts, sums, sumsq=None, mins=None, maxs=None, feature_names=None):
+        """
+        Add per-village totals that were reduced elsewhere, e.g. by a GROUP BY query.
+
+        Parameters
+        ----------
+        ids : array-like
+            Distinct village IDs.
+        counts : array-like
+            Points per village.
+        sums : array-like
+            (villages, features) feature sums, missing values counted as 0.
+        sumsq, mins, maxs : array-like, optional
+            Sums of squares, minima and maxima; required when 'std', 'min'
+            or 'max' is among the statistics.
+        feature_names : list of str, optional
+            As for `update`.
+        """
+        sums = np.nan_to_num(np.asarray(sums, dtype=np.float64), nan=0.0)
+        if len(sums) == 0:
+            return
+        extra = {'std': sumsq, 'min': mins, 'max': maxs}
+        missing = [stat for stat, values in extra.items() if stat in self.stats and values is None]
+        if missing:
+            raise ValueError(f"Totals for {missing} are required")
+        if self.feature_names is None:
+            self.feature_names = (list(feature_names) if feature_names is not None
+                                  else [f'X_{i}' for i in range(sums.shape[1])])
+
+        slots = self._slots(np.asarray(ids))
+        self._grow(len(self.ids), sums.shape[1])
+        self.counts[slots] += np.asarray(counts, dtype=np.int64)
+        self.sums[slots] += sums
+        if self.sumsq is not None:
+            self.sumsq[slots] += np.asarray(sumsq, dtype=np.float64)
+        if self.mins is not None:
+            self.mins[slots] = np.minimum(self.mins[slots], np.asarray(mins, dtype=np.float64))
+        if self.maxs is not None:
+            self.maxs[slots] = np.maximum(self.maxs[slots], np.asarray(maxs, dtype=np.float64))
+
+    def update_frame(self, df):
+        """Add a chunk of points from a DataFrame with an ID column and X_* columns."""
+        features = feature_columns(df.columns)
+        self.update(df[self.id_column].to_numpy(), df[features].to_numpy(dtype=np.float64), features)
+
+    def result(self):
+        """Return one row per village, sorted by ID, with the requested statistics."""
+        n = len(self.ids)
+        ids = pd.Series(self.ids, name=self.id_column)
+        order = np.argsort(ids.to_numpy(), kind='stable')
+        counts = self.counts[:n][order]
+        names = self.feature_names or []
+
+        columns = {self.id_column: ids.to_numpy()[order]}
+        if n == 0:
+            return pd.DataFrame(columns=[self.id_column] + names)
+        means = self.sums[:n][order] / counts[:, None]
+        frames = [pd.DataFrame(means, columns=names)]
+        if 'std' in self.stats:
+            # Sample standard deviation (ddof=1), matching pandas
+            with np.errstate(invalid='ignore', divide='ignore'):
+                variance = (self.sumsq[:n][order] - counts[:, None] * means ** 2) / (counts[:, None] - 1)
+            frames.append(pd.DataFrame(np.sqrt(np.clip(variance, 0, None)),
+                                       columns=[f'{name}_std' for name in names]))
+        if 'min' in self.stats:
+            frames.append(pd.DataFrame(self.mins[:n][order], columns=[f'{name}_min' for name in names]))
+        if 'max' in self.stats:
+            frames.append(pd.DataFrame(self.maxs[:n][order], columns=[f'{name}_max' for name in names]))
+        if 'count' in self.stats:
+            columns['count'] = counts
+        return pd.concat([pd.DataFrame(columns)] + frames, axis=1)
+
+
+@metrics.timed('aggregate')
+def aggregate_stream(source, id_column: str = 'v_shp_id', stats=('mean',), batch_rows: int = 65_536):
+    """
+    Aggregate features per village from any chunked source.
+
+    Parameters
+    ----------
+    source : str, FeatureStore, pd.DataFrame or iterable of pd.DataFrame
+        A table path (read in batches), a feature store, one frame, or a
+        generator of frames such as query tiles.
+    id_column : str, optional
+        Column holding the village/shrid ID.
+    stats : tuple of str, optional
+        Statistics to compute in the same pass, see `VillageAggregator`.
+    batch_rows : int, optional
+        Rows per batch when reading a table path or feature store.
+    """
+    aggregator = VillageAggregator(id_column, stats)
+    if isinstance(source, FeatureStore):
+        for index_chunk, features in source.iter_chunks(batch_rows):
+            aggregator.update(index_chunk[id_column].to_numpy(), features, source.feature_names)
+        return aggregator.result()
+
+    if isinstance(source, str):
+        source = iter_table(source, batch_rows=batch_rows)
+    elif isinstance(source, pd.DataFrame):
+        source = [source]
+    for chunk in source:
+        aggregator.update_frame(chunk)
+    return aggregator.result()
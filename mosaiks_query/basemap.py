@@ -0,0 +1,239 @@
+"""Satellite basemaps for shrid images from a shared on-disk XYZ tile cache.
+
+``contextily.add_basemap`` downloads every imagery tile under each plot,
+so neighbouring shrids keep re-requesting the same tiles and nothing is
+kept between runs. `BasemapTiles` stores each ``{z}/{x}/{y}`` tile once
+under ``cache/basemap/<provider>/``. `render_shrid_images` works out the
+tiles every image needs, downloads only the missing ones concurrently
+(through a `QueryScheduler`), and then draws the images on a process pool
+that reads tiles from disk only. With ``offline=True`` nothing is
+downloaded and every tile must already be in the cache directory.
+"""
+import io
+import os
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import shapely
+
+from mosaiks_query import metrics
+from mosaiks_query.scheduler import QueryScheduler
+
+ESRI_WORLD_IMAGERY = "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"
+
+TILE_PIXELS = 256
+
+# Half the width of the Web Mercator (EPSG:3857) world in metres
+ORIGIN = 20037508.342789244
+
+# Images sent to a render worker at once
+TASK_CHUNK_SIZE = 20
+
+
+def to_mercator(geometries):
+    """Project lon/lat shapely geometries to Web Mercator metres."""
+    def project(coords):
+        lon, lat = coords[:, 0], np.clip(coords[:, 1], -85.05112878, 85.05112878)
+        return np.column_stack([np.radians(lon) * 6378137.0,
+                                np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * 6378137.0])
+    return shapely.transform(geometries, project)
+
+
+def tiles_for_bounds(bounds, zoom: int):
+    """List the (x, y) tiles covering Web Mercator ``(xmin, ymin, xmax, ymax)`` at ``zoom``."""
+    size = 2 * ORIGIN / 2 ** zoom
+    last = 2 ** zoom - 1
+    x0, x1 = (min(max(int((v + ORIGIN) // size), 0), last) for v in (bounds[0], bounds[2]))
+    y0, y1 = (min(max(int((ORIGIN - v) // size), 0), last) for v in (bounds[3], bounds[1]))
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+class BasemapTiles:
+    """
+    XYZ imagery tiles cached on disk and shared across images and runs.
+
+    Parameters
+    ----------
+    url : str, optional
+        Tile URL template with ``{z}``, ``{x}`` and ``{y}``. Defaults to Esri
+        World Imagery, the source ``save_shrid_images`` always used.
+    cache_dir : str, optional
+        Tiles are stored as ``<cache_dir>/<name>/<z>/<x>/<y>``.
+    name : str, optional
+        Sub-directory of this provider.
+    offline : bool, optional
+        Never download; a tile missing from the cache raises FileNotFoundError.
+    scheduler : QueryScheduler, optional
+        Runs tile downloads concurrently with rate limiting and retries.
+        Defaults to 8 workers.
+    """
+
+    def __init__(self, url: str = ESRI_WORLD_IMAGERY, cache_dir: str = "cache/basemap",
+                 name: str = "esri_world_imagery", offline: bool = False, scheduler: QueryScheduler = None):
+        self.url = url
+        self.directory = os.path.join(cache_dir, name)
+        self.offline = offline
+        self.scheduler = scheduler if scheduler is not None else QueryScheduler(max_workers=8)
+
+    def path(self, zoom, x, y):
+        return os.path.join(self.directory, str(zoom), str(x), str(y))
+
+    def _download(self, tile):
+        zoom, x, y = tile
+        path = self.path(zoom, x, y)
+        request = urllib.request.Request(self.url.format(z=zoom, x=x, y=y),
+                                         headers={"User-Agent": "mosaiks_query"})
+
+        def run():
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.read()
+
+        content = self.scheduler.call(run)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+
+    def prefetch(self, tiles):
+        """
+        Make sure every ``(zoom, x, y)`` tile is on disk.
+
+        Returns
+        -------
+        (int, int)
+            Number of tiles already cached and number downloaded.
+        """
+        tiles = sorted(set(tiles))
+        missing = [tile for tile in tiles if not os.path.exists(self.path(*tile))]
+        if missing and self.offline:
+            raise FileNotFoundError(f"{len(missing)} basemap tiles are not in {self.directory} "
+                                    f"(offline mode), e.g. {self.path(*missing[0])}")
+        for _ in self.scheduler.map(self._download, missing):
+            pass
+        return len(tiles) - len(missing), len(missing)
+
+    def read(self, zoom, x, y):
+        """Decode one cached tile to an (H, W, 3) uint8 array."""
+        from PIL import Image
+
+        path = self.path(zoom, x, y)
+        if not os.path.exists(path):
+            if self.offline:
+                raise FileNotFoundError(f"Basemap tile {path} is not cached (offline mode)")
+            self._download((zoom, x, y))
+        with open(path, 'rb') as f:
+            return np.asarray(Image.open(io.BytesIO(f.read())).convert('RGB'))
+
+    def mosaic(self, bounds, zoom: int):
+        """
+        Stitch the tiles covering Web Mercator ``bounds`` into one image.
+
+        Returns
+        -------
+        (np.ndarray, tuple)
+            The image and its ``(left, right, bottom, top)`` extent in
+            metres, ready for ``ax.imshow(image, extent=extent)``.
+        """
+        tiles = tiles_for_bounds(bounds, zoom)
+        xs = sorted({x for x, _ in tiles})
+        ys = sorted({y for _, y in tiles})
+        image = np.zeros((len(ys) * TILE_PIXELS, len(xs) * TILE_PIXELS, 3), dtype=np.uint8)
+        for x, y in tiles:
+            tile = self.read(zoom, x, y)[:TILE_PIXELS, :TILE_PIXELS]
+            row, col = (y - ys[0]) * TILE_PIXELS, (x - xs[0]) * TILE_PIXELS
+            image[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+        size = 2 * ORIGIN / 2 ** zoom
+        extent = (-ORIGIN + xs[0] * size, -ORIGIN + (xs[-1] + 1) * size,
+                  ORIGIN - (ys[-1] + 1) * size, ORIGIN - ys[0] * size)
+        return image, extent
+
+
+def _plot_limits(bounds, margin=0.05):
+    """Axis limits matplotlib's default 5% margins give a plot of ``bounds``."""
+    dx, dy = (bounds[2] - bounds[0]) * margin, (bounds[3] - bounds[1]) * margin
+    return bounds[0] - dx, bounds[1] - dy, bounds[2] + dx, bounds[3] + dy
+
+
+def _render_chunk(tasks, tile_args, zoom, figsize, dpi):
+    import matplotlib.pyplot as plt
+
+    # Workers only read tiles the parent process already cached
+    tiles = BasemapTiles(**tile_args, offline=True)
+    for path, geometry, limits in tasks:
+        fig, ax = plt.subplots(figsize=figsize)
+        for part in shapely.get_parts(geometry):
+            ax.plot(*np.asarray(part.exterior.coords).T, color="blue", linewidth=2)
+        ax.set_aspect('equal')
+        image, extent = tiles.mosaic(limits, zoom)
+        ax.imshow(image, extent=extent, interpolation='bilinear')
+        ax.set_xlim(limits[0], limits[2])
+        ax.set_ylim(limits[1], limits[3])
+        ax.axis("off")
+        fig.savefig(f"{path}.tmp.png", dpi=dpi, bbox_inches='tight')
+        plt.close(fig)
+        os.replace(f"{path}.tmp.png", path)
+    return len(tasks)
+
+
+@metrics.timed('render')
+def render_shrid_images(geometries, paths, tiles: BasemapTiles = None, zoom: int = 15,
+                        processes: int = None, figsize=(10, 10), dpi: int = 300, force: bool = False):
+    """
+    Save a PNG of each polygon outlined in blue over satellite imagery.
+
+    Parameters
+    ----------
+    geometries : sequence of shapely geometries
+        Polygons in lon/lat (EPSG:4326).
+    paths : sequence of str
+        Output PNG path of each polygon.
+    tiles : BasemapTiles, optional
+        Tile cache to draw from. Defaults to Esri World Imagery under
+        ``cache/basemap/``.
+    zoom : int, optional
+        Tile zoom level.
+    processes : int, optional
+        Render worker processes. Defaults to the CPU count; 1 renders in this process.
+    figsize, dpi : optional
+        Matplotlib figure size and output resolution.
+    force : bool, optional
+        Redraw images that already exist.
+
+    Returns
+    -------
+    int
+        Number of images written.
+    """
+    tiles = tiles if tiles is not None else BasemapTiles()
+    geometries = to_mercator(np.asarray(geometries, dtype=object))
+    tasks = []
+    needed = set()
+    for geometry, path in zip(geometries, paths):
+        if not force and os.path.exists(path):
+            continue
+        limits = _plot_limits(geometry.bounds)
+        tasks.append((path, geometry, limits))
+        needed.update((zoom, x, y) for x, y in tiles_for_bounds(limits, zoom))
+
+    # Each tile is requested at most once, however many images share it
+    cached, downloaded = tiles.prefetch(needed)
+    print(f"Rendering {len(tasks)} images from {len(needed)} basemap tiles ({cached} cached, {downloaded} downloaded)")
+
+    tile_args = dict(url=tiles.url, cache_dir=os.path.dirname(tiles.directory), name=os.path.basename(tiles.directory))
+    chunks = [tasks[start:start + TASK_CHUNK_SIZE] for start in range(0, len(tasks), TASK_CHUNK_SIZE)]
+    done = 0
+    started = time.monotonic()
+    if processes == 1:
+        for chunk in chunks:
+            done += _render_chunk(chunk, tile_args, zoom, figsize, dpi)
+            print(f"Rendered {done} of {len(tasks)} images ({time.monotonic() - started:.0f}s)")
+        return done
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(_render_chunk, chunk, tile_args, zoom, figsize, dpi) for chunk in chunks]
+        for future in as_completed(futures):
+            done += future.result()
+            print(f"Rendered {done} of {len(tasks)} images ({time.monotonic() - started:.0f}s)")
+    return done
@@ -0,0 +1,271 @@
+"""Persistent local cache of MOSAIKS rows, keyed by lattice cell.
+
+Rows are stored on disk as one Parquet file per tile of ``tile_cells`` x
+``tile_cells`` lattice cells (0.3 degrees by default, the chunk size the
+scripts already use). A tile is either complete, meaning every row inside it
+has been downloaded, or partial, in which case a companion ``.cells.npy``
+file lists the cell keys that have been asked for so far (whether or not
+MOSAIKS had a row for them). Only cells that are not on disk are sent to
+Redivis, so re-running a pipeline over the same area costs no network I/O.
+
+Missing cells are planned across all tiles at once (see `planner`), so a
+request scattered over many tiles still costs only a few compact queries.
+"""
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from mosaiks_query import metrics
+from mosaiks_query.ingest import read_result
+from mosaiks_query.lattice import CELL_SIZE, cell_index, cell_keys, key_index
+from mosaiks_query.planner import AdaptiveBatchSize, plan_cells
+from mosaiks_query.scheduler import QueryScheduler
+
+TABLE_NAME = "mosaiks_2019_planet"
+
+# Tiles missing at least this fraction of their cells are downloaded whole
+TILE_FILL = 0.5
+
+
+def _atomic_write_parquet(df, path):
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def _atomic_write_keys(keys, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(keys, dtype=np.int64))
+    os.replace(tmp_path, path)
+
+
+class TileCache:
+    """
+    Local cache sitting between the scripts and a Redivis dataset.
+
+    Parameters
+    ----------
+    dataset : redivis.Dataset
+        Any object with ``dataset.query(sql).to_pandas_dataframe()``;
+        results with ``to_arrow_batch_iterator()`` are read as Arrow batches
+        (see `ingest`).
+    table_name : str, optional
+        MOSAIKS table to query.
+    cache_dir : str, optional
+        Root directory of the cache. Each table gets its own sub-directory.
+    tile_cells : int, optional
+        Width and height of a cache tile in lattice cells.
+    scheduler : QueryScheduler, optional
+        Runs tile downloads concurrently with rate limiting and retries.
+        Defaults to sequential queries.
+    batch_size : AdaptiveBatchSize, optional
+        Sizes the cell queries from observed latency. Defaults to starting at
+        1000 literals per query.
+    float32 : bool, optional
+        Downcast the features to float32 as results arrive, which also
+        halves the size of the cached tiles.
+    """
+
+    def __init__(self, dataset, table_name: str = TABLE_NAME,
+                 cache_dir: str = "cache", tile_cells: int = 30,
+                 scheduler: QueryScheduler = None, batch_size: AdaptiveBatchSize = None,
+                 float32: bool = True):
+        self.dataset = dataset
+        self.float32 = float32
+        self.scheduler = scheduler if scheduler is not None else QueryScheduler()
+        self.batch_size = batch_size if batch_size is not None else AdaptiveBatchSize()
+        self.table_name = table_name
+        self.tile_cells = tile_cells
+        self.directory = os.path.join(cache_dir, table_name)
+        os.makedirs(self.directory, exist_ok=True)
+
+    # Tile bookkeeping
+
+    def _tile_path(self, tile):
+        return os.path.join(self.directory, f"{tile[0]}_{tile[1]}.parquet")
+
+    def _cells_path(self, tile):
+        return os.path.join(self.directory, f"{tile[0]}_{tile[1]}.cells.npy")
+
+    def tile_bounds(self, tile):
+        """Return (min_lon, min_lat, max_lon, max_lat) of a tile, max exclusive."""
+        size = self.tile_cells * CELL_SIZE
+        return (round(tile[0] * size, 6), round(tile[1] * size, 6),
+                round((tile[0] + 1) * size, 6), round((tile[1] + 1) * size, 6))
+
+    def tiles_for_box(self, min_lon, min_lat, max_lon, max_lat):
+        """List the tiles overlapping a lon/lat box, ordered by lon then lat."""
+        tx0, tx1 = cell_index([min_lon, max_lon]) // self.tile_cells
+        ty0, ty1 = cell_index([min_lat, max_lat]) // self.tile_cells
+        return [(tx, ty) for tx in range(tx0, tx1 + 1) for ty in range(ty0, ty1 + 1)]
+
+    def tiles_for_keys(self, keys):
+        """Group cell keys by tile. Returns a dict of tile -> key array."""
+        keys = np.unique(np.asarray(keys, dtype=np.int64))
+        ix, iy = key_index(keys)
+        tx, ty = ix // self.tile_cells, iy // self.tile_cells
+        groups = {}
+        for tile_x, tile_y in set(zip(tx.tolist(), ty.tolist())):
+            groups[(tile_x, tile_y)] = keys[(tx == tile_x) & (ty == tile_y)]
+        return groups
+
+    def is_complete(self, tile):
+        return os.path.exists(self._tile_path(tile)) and not os.path.exists(self._cells_path(tile))
+
+    def _read_tile(self, tile):
+        """Return (rows, resolved cell keys) for a tile; keys is None if complete."""
+        if not os.path.exists(self._tile_path(tile)):
+            return None, np.empty(0, dtype=np.int64)
+        rows = pd.read_parquet(self._tile_path(tile))
+        if os.path.exists(self._cells_path(tile)):
+            return rows, np.load(self._cells_path(tile))
+        return rows, None
+
+    # Network fetches
+
+    def _query(self, where, size=None):
+        query_str = f"""
+            SELECT *
+            FROM {self.table_name}
+            WHERE {where}
+        """
+
+        def run():
+            start = time.monotonic()
+            rows = read_result(self.dataset.query(query_str), float32=self.float32)
+            seconds = time.monotonic() - start
+            if size is not None:
+                self.batch_size.observe(size, seconds)
+            metrics.query('tile' if size is None else 'cells', seconds, len(rows),
+                          int(rows.memory_usage(index=False).sum()), size)
+            return rows
+
+        return self.scheduler.call(run)
+
+    def _fetch_tile(self, tile):
+        min_lon, min_lat, max_lon, max_lat = self.tile_bounds(tile)
+        # Tile edges fall between lattice points, so half-open bounds never drop rows
+        rows = self._query(f"""lon >= {min_lon}
+              AND lon < {max_lon}
+              AND lat >= {min_lat}
+              AND lat < {max_lat}""")
+        rows = rows.sort_values(by=['lon', 'lat'], ignore_index=True)
+        _atomic_write_parquet(rows, self._tile_path(tile))
+        if os.path.exists(self._cells_path(tile)):
+            os.remove(self._cells_path(tile))
+        return rows
+
+    def _fetch_batch(self, clauses):
+        """Run one batch of planned clauses; return (rows, cell keys resolved)."""
+        rows = self._query(" OR ".join(clause.sql for clause in clauses),
+                           size=sum(clause.size for clause in clauses))
+        return rows, np.concatenate([clause.keys for clause in clauses])
+
+    def _add_cells(self, tile, rows, resolved, new_rows, keys):
+        """Merge newly fetched cells into a partial tile on disk; return its rows."""
+        rows = _concat([rows if rows is not None else pd.DataFrame(), new_rows])
+        if not rows.empty:
+            rows = rows.drop_duplicates(subset=['lon', 'lat']).sort_values(by=['lon', 'lat'], ignore_index=True)
+
+        # Register the tile as partial before its rows so a crash never looks complete
+        if not os.path.exists(self._cells_path(tile)):
+            _atomic_write_keys(resolved, self._cells_path(tile))
+        _atomic_write_parquet(rows, self._tile_path(tile))
+        _atomic_write_keys(np.union1d(resolved, keys), self._cells_path(tile))
+        return rows
+
+    # Lookups
+
+    def get_tile(self, tile):
+        """Return every row inside a tile, downloading it if it is not complete."""
+        rows, resolved = self._read_tile(tile)
+        if rows is not None and resolved is None:
+            metrics.add('cache.tiles', hits=1)
+            return rows
+        metrics.add('cache.tiles', misses=1)
+        return self._fetch_tile(tile)
+
+    def get_box(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        Return all rows strictly inside a lon/lat box.
+
+        Uses the same ``lon > min_lon AND lon < max_lon ...`` semantics as the
+        original bounding box queries.
+        """
+        tiles = self.tiles_for_box(min_lon, min_lat, max_lon, max_lat)
+        return _concat([clip_box(rows, min_lon, min_lat, max_lon, max_lat)
+                        for rows in self.scheduler.map(self.get_tile, tiles)])
+
+    def get_points(self, lons, lats):
+        """
+        Return the rows for the given lattice coordinates.
+
+        Each distinct cell is returned once; cells MOSAIKS has no data for are
+        simply absent from the result.
+        """
+        return self.get_cells(cell_keys(lons, lats))
+
+    def get_cells(self, keys):
+        """
+        Return the rows for a set of cell keys, fetching each cell at most once.
+
+        ``keys`` may repeat cells, e.g. the concatenated cells of overlapping
+        villages; the union is fetched once and every cell is returned once,
+        ready to be fanned back out with `CellMembership.join`. Tiles missing
+        most of their cells are downloaded whole with one range query.
+        """
+        groups = sorted(self.tiles_for_keys(keys).items())
+        tiles = {}
+        missing = {}
+        for tile, tile_keys in groups:
+            rows, resolved = self._read_tile(tile)
+            tiles[tile] = (rows, resolved)
+            if resolved is not None:
+                missing[tile] = np.setdiff1d(tile_keys, resolved)
+
+        dense = [tile for tile, tile_missing in missing.items()
+                 if len(tile_missing) >= TILE_FILL * self.tile_cells ** 2]
+        requested = sum(len(tile_keys) for _, tile_keys in groups)
+        fetched = sum(len(tile_missing) for tile_missing in missing.values())
+        incomplete = sum(len(tile_missing) > 0 for tile_missing in missing.values())
+        metrics.add('cache.cells', hits=requested - fetched, misses=fetched)
+        metrics.add('cache.tiles', hits=len(groups) - incomplete, misses=incomplete)
+        for tile, rows in zip(dense, self.scheduler.map(self._fetch_tile, dense)):
+            tiles[tile] = (rows, None)
+            del missing[tile]
+
+        # Plan the missing cells of every tile together, then file the results by tile.
+        # Ranges only bridge gaps between requested cells, so every resolved
+        # cell belongs to one of the partial tiles read above.
+        clauses = plan_cells(np.concatenate(list(missing.values()))) if missing else []
+        for new_rows, keys in self.scheduler.map(self._fetch_batch, self.batch_size.batches(clauses)):
+            for tile, tile_keys in self.tiles_for_keys(keys).items():
+                rows, resolved = tiles[tile]
+                rows = self._add_cells(tile, rows, resolved, _rows_in(new_rows, tile_keys), tile_keys)
+                tiles[tile] = (rows, np.union1d(resolved, tile_keys))
+
+        return _concat([_rows_in(tiles[tile][0], tile_keys) for tile, tile_keys in groups])
+
+
+def clip_box(rows, min_lon, min_lat, max_lon, max_lat):
+    """Keep the rows strictly inside a lon/lat box."""
+    inside = ((rows['lon'] > min_lon) & (rows['lon'] < max_lon)
+              & (rows['lat'] > min_lat) & (rows['lat'] < max_lat))
+    return rows[inside]
+
+
+def _rows_in(rows, keys):
+    """Keep the rows whose cell key is in ``keys``."""
+    if rows is None or rows.empty:
+        return pd.DataFrame()
+    return rows[np.isin(cell_keys(rows['lon'], rows['lat']), keys)]
+
+
+def _concat(frames):
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,94 @@
+"""Resumable, checkpointed downloads of large bounding box queries.
+
+The rows of every finished tile are already kept by the `TileCache` (one
+complete Parquet file per tile, written atomically), so the checkpoint only
+records which tiles are done in ``manifest.json``, together with the box
+being downloaded. After a crash a rerun simply skips the tiles already in
+the manifest, and `TileManifest.merge` stitches the cached tiles into one
+table sorted by lon and lat.
+"""
+import json
+import os
+
+import pandas as pd
+
+from mosaiks_query.cache import clip_box
+from mosaiks_query.storage import TableWriter
+
+
+class TileManifest:
+    """
+    Checkpoint of the tiles of a bounding box download that are done.
+
+    Parameters
+    ----------
+    directory : str
+        Where ``manifest.json`` is kept.
+    table_name : str
+        MOSAIKS table the tiles come from. Reusing a directory for another
+        table raises a ValueError instead of mixing the two.
+    bounds : tuple of float, optional
+        ``(min_lon, min_lat, max_lon, max_lat)`` of the download; the merged
+        rows are clipped to it. Defaults to the box saved by an earlier run.
+    """
+
+    def __init__(self, directory: str, table_name: str, bounds=None):
+        self.directory = directory
+        self.path = os.path.join(directory, "manifest.json")
+        os.makedirs(directory, exist_ok=True)
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.manifest = json.load(f)
+            if self.manifest['table_name'] != table_name:
+                raise ValueError(f"{directory} holds tiles from {self.manifest['table_name']}, "
+                                 f"not {table_name}; use another directory or delete it")
+        else:
+            self.manifest = {'table_name': table_name, 'tiles': {}}
+        if bounds is not None:
+            self.manifest['bounds'] = [float(v) for v in bounds]
+
+    @staticmethod
+    def _name(tile):
+        return f"{tile[0]}_{tile[1]}"
+
+    def is_done(self, tile):
+        return self._name(tile) in self.manifest['tiles']
+
+    def pending(self, tiles):
+        """Return the tiles that have not been recorded yet, in order."""
+        return [tile for tile in tiles if not self.is_done(tile)]
+
+    def record(self, tile, rows):
+        """Mark a tile as done; its rows are already in the tile cache."""
+        self.manifest['tiles'][self._name(tile)] = {'tile': list(tile), 'rows': len(rows)}
+        with open(f"{self.path}.tmp", 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def merge(self, output_file: str, cache):
+        """
+        Combine every recorded tile into one table sorted by lon, then lat.
+
+        The rows are read from ``cache``, the `TileCache` the tiles were
+        downloaded through (a recorded tile missing from it is downloaded
+        again), and clipped to the saved bounds. Tiles are merged one column
+        of tiles at a time (tiles sharing a lon range), so memory stays
+        bounded by a single column rather than the whole dataset. The output
+        format follows the file extension. Returns the number of rows written.
+        """
+        columns = {}
+        for entry in self.manifest['tiles'].values():
+            tile = tuple(entry['tile'])
+            columns.setdefault(tile[0], []).append(tile)
+        bounds = self.manifest.get('bounds')
+
+        with TableWriter(output_file) as writer:
+            for tile_x in sorted(columns):
+                parts = [cache.get_tile(tile) for tile in sorted(columns[tile_x])]
+                if bounds is not None:
+                    parts = [clip_box(part, *bounds) for part in parts]
+                parts = [part for part in parts if not part.empty]
+                if parts:
+                    writer.write(pd.concat(parts, ignore_index=True).sort_values(by=['lon', 'lat']))
+        return writer.rows
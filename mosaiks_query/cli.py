@@ -0,0 +1,221 @@
+"""Command line interface: ``python -m mosaiks_query <command>`` or ``mosaiks-query <command>``.
+
+Commands
+--------
+query
+    Fetch the MOSAIKS rows of the cells inside the polygons (through the
+    local tile cache) into a table, or with ``--aggregate`` only their
+    per-polygon statistics, computed by Redivis.
+join
+    Tag the rows from ``query`` with their polygons and write the joined
+    table plus its feature store.
+aggregate
+    Per-polygon feature statistics of a joined table or feature store.
+render
+    PCA_1 heatmaps per polygon.
+update
+    Patch the outputs of ``query --join`` and ``aggregate`` (and the
+    heatmaps) for only the polygons added, edited or removed since.
+batch
+    ``query --join`` plus ``aggregate`` for several MOSAIKS tables (e.g.
+    years) with the polygon work done once, writing ``<output-dir>/<table>/``.
+
+``query --join`` does query and join in one step without the intermediate
+table, like ``coords_inside_query.py``; ``query --stream`` also joins, but
+skips the cache and appends each batch of the results as it arrives. Every command prints its stage
+timings at exit; ``--metrics FILE`` also logs them as JSON lines.
+"""
+import argparse
+
+from mosaiks_query import metrics
+
+STATS = ['mean', 'std', 'min', 'max', 'count']
+
+
+def _add_polygon_arguments(parser):
+    parser.add_argument('--polygons', default=None,
+                        help="village shapefile or shrid CSV (default: villages_shapefiles/villages_shapefiles.shp)")
+    parser.add_argument('--id-column', default='v_shp_id', help="polygon ID column, e.g. v_shp_id or shrid2")
+    shape = parser.add_mutually_exclusive_group()
+    shape.add_argument('--bbox', action='store_true', help="use each polygon's bounding box")
+    shape.add_argument('--midpoint', action='store_true', help="use only the cell at each polygon's centroid")
+
+
+def _polygons(args):
+    from mosaiks_query.pipeline import SHAPEFILE
+
+    return args.polygons or SHAPEFILE
+
+
+def _query(args):
+    from mosaiks_query.pipeline import (aggregate_villages, join_cells, open_cache, open_dataset, query_cells,
+                                        stream_villages, write_joined)
+    from mosaiks_query.storage import write_table
+
+    if args.stream:
+        stream_villages(open_dataset(), _polygons(args), args.id_column, bbox=args.bbox, output=args.output,
+                        columns=args.select, table_name=args.table, max_workers=args.workers,
+                        requests_per_second=args.rate)
+        return
+    if args.aggregate:
+        aggregate_villages(open_dataset(), _polygons(args), args.id_column, bbox=args.bbox, output=args.output,
+                           stats=tuple(args.stats), table_name=args.table, max_workers=args.workers,
+                           requests_per_second=args.rate)
+        print(f"Aggregated features saved to {args.output}")
+        return
+    cache = open_cache(args.table, cache_dir=args.cache_dir, max_workers=args.workers,
+                       requests_per_second=args.rate)
+    rows = query_cells(cache, _polygons(args), args.id_column, bbox=args.bbox, midpoint=args.midpoint)
+    if not args.join:
+        write_table(rows, args.output)
+        return
+    joined = join_cells(rows, _polygons(args), args.id_column, bbox=args.bbox, midpoint=args.midpoint)
+    write_joined(joined, args.output, args.features, index=not args.midpoint)
+
+
+def _join(args):
+    from mosaiks_query.pipeline import join_cells, write_joined
+    from mosaiks_query.storage import read_table
+
+    joined = join_cells(read_table(args.cells), _polygons(args), args.id_column, bbox=args.bbox,
+                        midpoint=args.midpoint, attributes=not args.no_attributes)
+    write_joined(joined, args.output, args.features, index=not args.midpoint)
+
+
+def _aggregate(args):
+    from mosaiks_query.pipeline import aggregate
+
+    aggregate(args.input, args.output, id_column=args.id_column, stats=tuple(args.stats))
+    print(f"Aggregated features saved to {args.output}")
+
+
+def _render(args):
+    from mosaiks_query.pipeline import render
+
+    count = render(args.input, _polygons(args), args.output, id_column=args.id_column,
+                   features_dir=args.features, projection_file=args.projection, mode=args.mode,
+                   inside_only=args.inside_only, outline=args.outline, processes=args.processes,
+                   force=args.force)
+    print(f"Wrote {count} heatmaps to {args.output}")
+
+
+def _update(args):
+    from mosaiks_query.pipeline import open_cache, update_villages
+
+    cache = open_cache(args.table, cache_dir=args.cache_dir, max_workers=args.workers,
+                       requests_per_second=args.rate)
+    update_villages(cache, _polygons(args), args.id_column, bbox=args.bbox, output=args.output,
+                    features_dir=args.features, average_output=args.average, stats=tuple(args.stats),
+                    heatmap_folder=args.heatmaps, projection_file=args.projection, mode=args.mode)
+
+
+def _batch(args):
+    from mosaiks_query.pipeline import run_tables
+
+    outputs = run_tables(args.tables, _polygons(args), args.id_column, bbox=args.bbox, midpoint=args.midpoint,
+                         pushdown=args.aggregate, output_dir=args.output_dir, stats=tuple(args.stats),
+                         cache_dir=args.cache_dir, max_workers=args.workers, requests_per_second=args.rate,
+                         table_workers=args.table_workers)
+    for table, output in outputs.items():
+        print(f"{table}: {output}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='mosaiks-query', description="Query and process MOSAIKS features.")
+    parser.add_argument('--metrics', help="also write stage and query metrics to this JSON lines file")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    query = commands.add_parser('query', help="fetch the MOSAIKS rows inside the polygons")
+    _add_polygon_arguments(query)
+    query.add_argument('--output', required=True, help="output table (.parquet, .feather or .csv)")
+    query.add_argument('--join', action='store_true', help="also join the rows to the polygons")
+    query.add_argument('--features', help="with --join, build a feature store in this directory")
+    query.add_argument('--aggregate', action='store_true',
+                       help="download only per-polygon statistics, aggregated in the query")
+    query.add_argument('--stats', nargs='+', default=['mean'], choices=STATS, help="with --aggregate, statistics")
+    query.add_argument('--stream', action='store_true',
+                       help="skip the tile cache; join and write each result batch as it arrives (unsorted)")
+    query.add_argument('--select', nargs='+', metavar='COLUMN', help="with --stream, only keep these feature columns")
+    query.add_argument('--table', default='mosaiks_2019_planet', help="MOSAIKS table on Redivis")
+    query.add_argument('--cache-dir', default='cache', help="local tile cache directory")
+    query.add_argument('--workers', type=int, default=4, help="concurrent Redivis queries")
+    query.add_argument('--rate', type=float, default=2, help="maximum Redivis queries per second")
+    query.set_defaults(func=_query)
+
+    join = commands.add_parser('join', help="tag queried rows with the polygons containing them")
+    _add_polygon_arguments(join)
+    join.add_argument('--cells', required=True, help="table written by the query command")
+    join.add_argument('--output', required=True, help="joined output table")
+    join.add_argument('--features', help="build a feature store in this directory")
+    join.add_argument('--no-attributes', action='store_true', help="do not add the shapefile's attribute columns")
+    join.set_defaults(func=_join)
+
+    aggregate = commands.add_parser('aggregate', help="per-polygon feature statistics")
+    aggregate.add_argument('--input', required=True, help="joined table or feature store directory")
+    aggregate.add_argument('--output', required=True, help="output table")
+    aggregate.add_argument('--id-column', default='v_shp_id', help="polygon ID column")
+    aggregate.add_argument('--stats', nargs='+', default=['mean'], choices=STATS, help="statistics to compute")
+    aggregate.set_defaults(func=_aggregate)
+
+    render = commands.add_parser('render', help="PCA_1 heatmap per polygon")
+    render.add_argument('--input', required=True, help="joined table")
+    render.add_argument('--polygons', default=None, help="village shapefile or shrid CSV")
+    render.add_argument('--id-column', default='v_shp_id', help="polygon ID column")
+    render.add_argument('--output', required=True, help="output folder")
+    render.add_argument('--features', help="feature store of the joined table")
+    render.add_argument('--projection', help="saved PCA projection (.npz), fitted and saved if missing")
+    render.add_argument('--mode', choices=['html', 'binary'], default='html',
+                        help="standalone folium pages or shared viewer with binary data")
+    render.add_argument('--inside-only', action='store_true', help="only plot points inside each polygon")
+    render.add_argument('--outline', choices=['geojson', 'polygon'], default='geojson', help="polygon style")
+    render.add_argument('--processes', type=int, default=None, help="render worker processes")
+    render.add_argument('--force', action='store_true', help="redraw heatmaps that are up to date")
+    render.set_defaults(func=_render)
+
+    update = commands.add_parser('update', help="patch the outputs for changed polygons only")
+    _add_polygon_arguments(update)
+    update.add_argument('--output', default=None, help="joined table (default: output/coords_inside(_box).parquet)")
+    update.add_argument('--features', help="its feature store (default: <output>_features)")
+    update.add_argument('--average', help="per-polygon averages (default: <output>_average)")
+    update.add_argument('--stats', nargs='+', default=['mean'], choices=STATS, help="statistics in the averages")
+    update.add_argument('--heatmaps', help="also redraw the changed polygons' heatmaps in this folder")
+    update.add_argument('--projection', help="saved PCA projection (.npz) the heatmaps were drawn with")
+    update.add_argument('--mode', choices=['html', 'binary'], default='html', help="heatmap format")
+    update.add_argument('--table', default='mosaiks_2019_planet', help="MOSAIKS table on Redivis")
+    update.add_argument('--cache-dir', default='cache', help="local tile cache directory")
+    update.add_argument('--workers', type=int, default=4, help="concurrent Redivis queries")
+    update.add_argument('--rate', type=float, default=2, help="maximum Redivis queries per second")
+    update.set_defaults(func=_update)
+
+    batch = commands.add_parser('batch', help="query, join and aggregate several tables with shared geometry")
+    _add_polygon_arguments(batch)
+    batch.add_argument('--tables', nargs='+', required=True, help="MOSAIKS tables on Redivis")
+    batch.add_argument('--output-dir', default='output', help="per-table outputs go to <output-dir>/<table>/")
+    batch.add_argument('--aggregate', action='store_true',
+                       help="only download per-polygon statistics, aggregated in the query")
+    batch.add_argument('--stats', nargs='+', default=['mean'], choices=STATS, help="statistics to compute")
+    batch.add_argument('--cache-dir', default='cache', help="local tile cache directory")
+    batch.add_argument('--workers', type=int, default=4, help="concurrent Redivis queries, shared by all tables")
+    batch.add_argument('--rate', type=float, default=2, help="maximum Redivis queries per second")
+    batch.add_argument('--table-workers', type=int, default=2, help="tables processed at the same time")
+    batch.set_defaults(func=_batch)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'query' and args.aggregate and (args.join or args.midpoint or args.stream):
+        parser.error("--aggregate cannot be combined with --join, --midpoint or --stream")
+    if args.command == 'query' and args.stream and (args.midpoint or args.features):
+        parser.error("--stream cannot be combined with --midpoint or --features")
+    if args.command == 'update' and args.midpoint:
+        parser.error("update does not support --midpoint")
+    if args.command == 'batch' and args.aggregate and args.midpoint:
+        parser.error("--aggregate cannot be combined with --midpoint")
+    metrics.configure(args.metrics)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Tile-by-tile execution of large bounding box queries.
+
+Instead of concatenating every chunk of a country-wide query into one frame,
+`stream_box` yields the rows of one cache tile at a time and consumers such as
+`write_stream` process them incrementally, so peak memory is a single tile.
+`stream_query` skips the cache altogether and yields each Arrow batch of the
+query results as it arrives. `write_sorted_stream` writes such a stream
+sorted by polygon ID instead of in tile order.
+"""
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from mosaiks_query import metrics
+from mosaiks_query.cache import TABLE_NAME, clip_box
+from mosaiks_query.ingest import iter_frames
+from mosaiks_query.lattice import cell_keys
+from mosaiks_query.planner import AdaptiveBatchSize, plan_cells
+from mosaiks_query.scheduler import QueryScheduler
+from mosaiks_query.storage import TableWriter
+
+# Rows per bucket of `write_sorted_stream`, about a dozen full tiles
+SORT_BUCKET_ROWS = 10_000
+
+
+def stream_box(cache, min_lon, min_lat, max_lon, max_lat, tiles=None, verbose: bool = True):
+    """
+    Yield ``(tile, rows)`` for every cache tile overlapping a lon/lat box.
+
+    Rows are clipped to the box with the strict ``>``/``<`` bounds used by the
+    original queries. Tiles already on disk are read from the cache, the rest
+    are downloaded a few at a time on the cache's scheduler while earlier
+    tiles are being consumed. Tiles are always yielded in order.
+
+    Pass ``tiles`` to only visit a subset of the box, e.g. the tiles a
+    checkpoint has not recorded yet.
+    """
+    if tiles is None:
+        tiles = cache.tiles_for_box(min_lon, min_lat, max_lon, max_lat)
+    for n, (tile, rows) in enumerate(zip(tiles, cache.scheduler.map(cache.get_tile, tiles))):
+        if verbose:
+            print(f"Processing tile {n + 1} of {len(tiles)}")
+        yield tile, clip_box(rows, min_lon, min_lat, max_lon, max_lat)
+
+
+def stream_cells(cache, keys, verbose: bool = True):
+    """
+    Yield ``(tile, rows)`` for every cache tile holding some of the given cells.
+
+    Like `stream_box`, but only the requested cells are fetched and returned
+    (each once, however often it appears in ``keys``), so tiles no polygon
+    touches cost nothing.
+
+    Tiles are visited one at a time; the queries for each tile's missing
+    cells already run on ``cache.scheduler`` inside `TileCache.get_cells`,
+    so the scheduler's pool is never nested inside itself.
+    """
+    groups = sorted(cache.tiles_for_keys(keys).items())
+    for n, (tile, tile_keys) in enumerate(groups):
+        if verbose:
+            print(f"Processing tile {n + 1} of {len(groups)}")
+        yield tile, cache.get_cells(tile_keys)
+
+
+def stream_query(dataset, keys, table_name: str = TABLE_NAME, columns=None, scheduler: QueryScheduler = None,
+                 batch_size: AdaptiveBatchSize = None, float32: bool = True):
+    """
+    Yield the rows of the given cells as DataFrames, one per Arrow batch of the results.
+
+    Nothing is cached: the cells are planned like `TileCache.get_cells`,
+    only ``columns`` are selected, and every batch is downcast to float32
+    (see `ingest`) and yielded as it arrives, so the rows can go straight
+    to `CellMembership.join`, `aggregate_stream` or `write_stream` and peak
+    memory stays at a few batches. Each cell is yielded once; the gap cells
+    a range clause also returns are dropped.
+
+    Parameters
+    ----------
+    dataset : redivis.Dataset
+        Any object with ``dataset.query(sql)``.
+    keys : array-like
+        `lattice.cell_keys` of the cells to fetch.
+    table_name : str, optional
+        MOSAIKS table to query.
+    columns : list of str, optional
+        Feature columns to select; lon and lat are always included.
+        Defaults to every column.
+    scheduler : QueryScheduler, optional
+        Runs the queries concurrently; each worker holds the batches of one
+        query until they are consumed.
+    batch_size : AdaptiveBatchSize, optional
+        Sizes the queries from observed latency.
+    float32 : bool, optional
+        Downcast the features to float32.
+    """
+    keys = np.unique(np.asarray(keys, dtype=np.int64))
+    scheduler = scheduler if scheduler is not None else QueryScheduler()
+    batch_size = batch_size if batch_size is not None else AdaptiveBatchSize()
+    if columns is not None:
+        columns = ['lon', 'lat'] + [c for c in columns if c not in ('lon', 'lat')]
+    select = "*" if columns is None else ", ".join(columns)
+
+    def run(clauses):
+        size = sum(clause.size for clause in clauses)
+        query_str = f"""
+            SELECT {select}
+            FROM {table_name}
+            WHERE {" OR ".join(clause.sql for clause in clauses)}
+        """
+
+        def fetch():
+            start = time.monotonic()
+            # Projected again as each batch arrives, for datasets that answer with every column
+            frames = list(iter_frames(dataset.query(query_str), columns=columns, float32=float32))
+            seconds = time.monotonic() - start
+            batch_size.observe(size, seconds)
+            metrics.query('stream', seconds, sum(len(frame) for frame in frames),
+                          sum(int(frame.memory_usage(index=False).sum()) for frame in frames), size)
+            return frames
+
+        return scheduler.call(fetch)
+
+    for frames in scheduler.map(run, batch_size.batches(plan_cells(keys))):
+        for frame in frames:
+            frame = frame[np.isin(cell_keys(frame['lon'], frame['lat']), keys)]
+            if not frame.empty:
+                yield frame
+
+
+def write_stream(frames, path: str, index: bool = False):
+    """
+    Append an iterable of DataFrames to one output table as they arrive.
+
+    The format follows the path's extension (see `storage.TableWriter`).
+    Returns the number of rows written.
+    """
+    with TableWriter(path, index=index) as writer:
+        for frame in frames:
+            writer.write(frame)
+    return writer.rows
+
+
+def bucket_bounds(values, counts, bucket_rows: int = SORT_BUCKET_ROWS):
+    """
+    Split ``values`` into sorted ranges of about ``bucket_rows`` rows each.
+
+    ``counts`` is the (maximum) number of rows of each value, e.g. the cells
+    of each polygon. Returns the first value of every range but the first,
+    ready for `write_sorted_stream`.
+    """
+    order = np.argsort(values, kind='stable')
+    values, counts = np.asarray(values)[order], np.asarray(counts)[order]
+    bucket = (np.cumsum(counts) - counts) // bucket_rows
+    return values[np.flatnonzero(np.r_[False, bucket[1:] != bucket[:-1]])]
+
+
+def write_sorted_stream(frames, path: str, by, bounds, index: bool = False):
+    """
+    Write an iterable of DataFrames to one table sorted by the ``by`` columns.
+
+    Like `write_stream`, but the frames may arrive in any order, e.g. tile by
+    tile. Each frame is split at ``bounds`` (sorted values of ``by[0]``, see
+    `bucket_bounds`) and spilled to part files under ``<path>.parts/``. The
+    buckets are then sorted one at a time and appended in order, so memory
+    stays bounded by one bucket, as in `TileManifest.merge`. With
+    ``index=True`` the frames' index is written as a column and may be one of
+    ``by``. Returns the number of rows written.
+    """
+    by = list(by)
+    bounds = np.asarray(bounds)
+    parts_dir = f"{path}.parts"
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    buckets = set()
+    for n, frame in enumerate(frames):
+        if frame.empty:
+            continue
+        if index:
+            frame = frame.reset_index()
+        position = np.searchsorted(bounds, frame[by[0]].to_numpy(), side='right')
+        for bucket in np.unique(position).tolist():
+            directory = os.path.join(parts_dir, str(bucket))
+            os.makedirs(directory, exist_ok=True)
+            frame[position == bucket].to_parquet(os.path.join(directory, f"{n}.parquet"), index=False)
+            buckets.add(bucket)
+
+    with TableWriter(path) as writer:
+        for bucket in sorted(buckets):
+            directory = os.path.join(parts_dir, str(bucket))
+            parts = [pd.read_parquet(os.path.join(directory, name)) for name in sorted(os.listdir(directory))]
+            writer.write(pd.concat(parts, ignore_index=True).sort_values(by=by, kind='stable', ignore_index=True))
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return writer.rows
@@ -0,0 +1,154 @@
+"""Memory-mapped float32 store for the X_0..X_3999 feature matrix.
+
+After querying, the features are only ever used as one dense numeric matrix
+(PCA, per-village means), so a store keeps them as a single contiguous
+float32 ``features.npy`` next to a small ``index.parquet`` side table with the
+coordinates, village/shrid IDs and row offset of every point. Opening a store
+memory-maps the matrix, so consumers slice rows without loading a DataFrame
+and can work on datasets larger than RAM.
+
+A build writes all three files under temporary names and swaps them in with
+``meta.json`` last. The metadata records the size and modification time of
+the matrix and index it belongs to, so a store left half-replaced by an
+interrupted rebuild refuses to open instead of pairing new features with an
+old index.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from mosaiks_query.storage import count_rows, feature_columns, iter_table, read_schema
+
+FEATURES_FILE = "features.npy"
+INDEX_FILE = "index.parquet"
+META_FILE = "meta.json"
+
+# Non-feature columns copied into the side index when present
+KEY_COLUMNS = ['lon', 'lat', 'v_shp_id', 'shrid2']
+
+
+def _fingerprint(path):
+    """Size and modification time of a file, enough to tell two builds apart."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class FeatureStore:
+    """
+    Read-only view of a feature store directory.
+
+    Attributes
+    ----------
+    features : np.memmap
+        (rows, features) float32 matrix, memory-mapped from disk.
+    index : pd.DataFrame
+        Side table with one row per matrix row: the key columns and ``row``.
+    feature_names : list of str
+        Names of the matrix columns, e.g. ``['X_0', ..., 'X_3999']``.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        # Stores built before the files were fingerprinted have no 'files' entry
+        for name, fingerprint in meta.get('files', {}).items():
+            if _fingerprint(os.path.join(directory, name)) != fingerprint:
+                raise ValueError(f"{os.path.join(directory, name)} does not belong to this feature store "
+                                 f"(interrupted build?); rebuild it with FeatureStore.build")
+        self.features = np.load(os.path.join(directory, FEATURES_FILE), mmap_mode='r')
+        self.index = pd.read_parquet(os.path.join(directory, INDEX_FILE))
+        self.feature_names = meta['features']
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    @classmethod
+    def build(cls, table_path: str, directory: str, key_columns=None, batch_rows: int = 65_536):
+        """
+        Build a store from a feature table, streaming it in batches.
+
+        Parameters
+        ----------
+        table_path : str
+            Table written by the query scripts (.parquet, .feather or .csv).
+        directory : str
+            Output directory for the store. Existing files are replaced.
+        key_columns : list of str, optional
+            Columns kept in the side index. Defaults to whichever of
+            lon, lat, v_shp_id and shrid2 exist in the table.
+        batch_rows : int, optional
+            Rows read and written per batch; bounds peak memory.
+        """
+        columns = read_schema(table_path)
+        features = feature_columns(columns)
+        keys = [col for col in (key_columns or KEY_COLUMNS) if col in columns]
+        num_rows = count_rows(table_path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Fill the matrix batch by batch, written to a temporary file first
+        features_path = os.path.join(directory, FEATURES_FILE)
+        matrix = np.lib.format.open_memmap(f"{features_path}.tmp", mode='w+', dtype=np.float32,
+                                           shape=(num_rows, len(features)))
+        index_parts = []
+        start = 0
+        for batch in iter_table(table_path, columns=keys + features, batch_rows=batch_rows):
+            matrix[start:start + len(batch)] = batch[features].to_numpy(dtype=np.float32)
+            index_parts.append(batch[keys])
+            start += len(batch)
+        matrix.flush()
+        del matrix
+
+        index = pd.concat(index_parts, ignore_index=True) if index_parts else pd.DataFrame(columns=keys)
+        index['row'] = np.arange(len(index), dtype=np.int64)
+        index_path = os.path.join(directory, INDEX_FILE)
+        index.to_parquet(f"{index_path}.tmp", index=False)
+
+        # Replacing keeps each file's size and mtime, so the fingerprints taken now hold after the swap
+        meta_path = os.path.join(directory, META_FILE)
+        files = {FEATURES_FILE: _fingerprint(f"{features_path}.tmp"), INDEX_FILE: _fingerprint(f"{index_path}.tmp")}
+        with open(f"{meta_path}.tmp", 'w') as f:
+            json.dump({'features': features, 'source': table_path, 'files': files}, f)
+        os.replace(f"{features_path}.tmp", features_path)
+        os.replace(f"{index_path}.tmp", index_path)
+        # The metadata goes last and commits the build
+        os.replace(f"{meta_path}.tmp", meta_path)
+        return cls(directory)
+
+    def rows(self, start: int, stop: int):
+        """Return rows ``start:stop`` of the matrix as a zero-copy view."""
+        return self.features[start:stop]
+
+    def take(self, positions):
+        """Return the given rows of the matrix (a copy, in the given order)."""
+        return self.features[np.asarray(positions, dtype=np.int64)]
+
+    def groups(self, id_column: str):
+        """
+        Map each ID to the matrix rows it owns.
+
+        Values are ``slice`` objects when an ID's rows are contiguous (the
+        query scripts write points grouped by village), so ``rows_for`` can
+        return views; otherwise they are arrays of row positions.
+        """
+        groups = {}
+        for key, positions in self.index.groupby(id_column).indices.items():
+            if positions[-1] - positions[0] + 1 == len(positions):
+                groups[key] = slice(int(positions[0]), int(positions[-1]) + 1)
+            else:
+                groups[key] = positions
+        return groups
+
+    def rows_for(self, rows):
+        """Return the matrix rows for a value from `groups` (a view for slices)."""
+        if isinstance(rows, slice):
+            return self.features[rows]
+        return self.take(rows)
+
+    def iter_chunks(self, chunk_rows: int = 65_536):
+        """Yield ``(index_chunk, feature_chunk)`` pairs; feature chunks are views."""
+        for start in range(0, len(self), chunk_rows):
+            stop = min(start + chunk_rows, len(self))
+            yield self.index.iloc[start:stop], self.features[start:stop]
@@ -0,0 +1,284 @@
+"""Point-in-polygon joins on the MOSAIKS 0.01 degree lattice.
+
+MOSAIKS points are the centres of lattice cells, so there is no need to build
+a Point per row and run ``gpd.sjoin``. `polygon_cells` rasterizes every
+polygon onto the lattice with a scanline fill: each polygon edge is crossed
+with the rows of cell centres it spans, crossings are paired per row
+(even-odd rule, so holes and multipolygons work), and every cell centre
+strictly between a pair is inside. Only the few cells whose centre lies on or
+next to the boundary, or rows that pass through a vertex, are resolved with
+an exact ``shapely.contains_xy`` test. Membership comes out as integer cell
+keys, which `CellMembership.join` matches against query rows.
+
+`load_membership` persists the membership of a shapefile or shrid CSV under
+``cache/membership/``, keyed by a hash of the source files, so reruns (e.g.
+against another MOSAIKS table) skip the geometry work entirely.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from mosaiks_query import metrics
+from mosaiks_query.lattice import CELL_SIZE, cell_keys, index_keys
+from mosaiks_query.polygons import file_digest, read_polygons
+
+MEMBERSHIP_DIR = "cache/membership"
+
+# Crossings this close (in degrees) to a cell centre are settled by an exact test
+_EPS = 1e-9
+
+
+def _expand(starts, stops):
+    """Concatenate ``range(start, stop)`` for every pair; return (owner, values)."""
+    lengths = np.maximum(stops - starts, 0)
+    owner = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return owner, starts[owner] + offsets
+
+
+def _centre(indices):
+    """Coordinate of the centre of each lattice column/row, as stored by MOSAIKS."""
+    return (np.asarray(indices, dtype=np.int64) * 10 + 5) / 1000
+
+
+def _first_above(values, strict):
+    """First lattice index whose centre is > (strict) or >= each value."""
+    index = np.floor(np.asarray(values) / CELL_SIZE - 0.5).astype(np.int64)
+    # The estimate can be one off either way around exact centres
+    for _ in range(2):
+        centre = _centre(index)
+        index = np.where(centre > values if strict else centre >= values, index, index + 1)
+    centre = _centre(index - 1)
+    return np.where(centre > values if strict else centre >= values, index - 1, index)
+
+
+def _centre_range(lo, hi):
+    """Return [start, stop) of the indices whose centres lie strictly between lo and hi."""
+    return _first_above(lo, strict=True), _first_above(hi, strict=False)
+
+
+def _box_cells(bounds, owners):
+    """Cells whose centres lie strictly inside each bounding box."""
+    col_start, col_stop = _centre_range(bounds[:, 0], bounds[:, 2])
+    row_start, row_stop = _centre_range(bounds[:, 1], bounds[:, 3])
+    box, rows = _expand(row_start, row_stop)
+    line, cols = _expand(col_start[box], col_stop[box])
+    return owners[box[line]], cols, rows[line]
+
+
+def _polygon_cells(geometries):
+    """Scanline fill of every polygon; returns (owner, column, row) of inside cells."""
+    parts, part_owner = shapely.get_parts(geometries, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    coord_owner = part_owner[ring_part[coord_ring]]
+
+    # Edges join consecutive coordinates of the same (closed) ring
+    same_ring = coord_ring[:-1] == coord_ring[1:]
+    x0, y0 = coords[:-1][same_ring].T
+    x1, y1 = coords[1:][same_ring].T
+    edge_owner = coord_owner[:-1][same_ring]
+    sloped = y0 != y1
+    x0, y0, x1, y1, edge_owner = x0[sloped], y0[sloped], x1[sloped], y1[sloped], edge_owner[sloped]
+
+    # Rows whose centre y satisfies min(y0, y1) <= y < max(y0, y1) cross the edge once
+    row_start = _first_above(np.minimum(y0, y1), strict=False)
+    row_stop = _first_above(np.maximum(y0, y1), strict=False)
+    edge, rows = _expand(row_start, row_stop)
+    y = _centre(rows)
+    xs = x0[edge] + (y - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+    owners = edge_owner[edge]
+
+    # Pair crossings left to right within each (polygon, row)
+    order = np.lexsort((xs, rows, owners))
+    owners, rows, xs = owners[order], rows[order], xs[order]
+    new_group = np.r_[True, (owners[1:] != owners[:-1]) | (rows[1:] != rows[:-1])][:len(xs)]
+    group = np.cumsum(new_group) - 1
+    rank = np.arange(len(xs)) - np.flatnonzero(new_group)[group]
+    group_size = np.bincount(group)
+
+    # Rows through a vertex or with an odd number of crossings are tested exactly
+    vertex_rows = np.rint(coords[:, 1] / CELL_SIZE - 0.5).astype(np.int64)
+    on_vertex = np.abs(_centre(vertex_rows) - coords[:, 1]) < _EPS
+    flagged = {(o, r) for o, r in zip(coord_owner[on_vertex].tolist(), vertex_rows[on_vertex].tolist())}
+    odd = group_size[group] % 2 == 1
+    flagged.update(zip(owners[new_group & odd].tolist(), rows[new_group & odd].tolist()))
+    if flagged:
+        flagged_groups = np.fromiter(((o, r) in flagged for o, r in zip(owners[new_group].tolist(),
+                                                                         rows[new_group].tolist())),
+                                     dtype=bool, count=int(new_group.sum()))
+    else:
+        flagged_groups = np.zeros(int(new_group.sum()), dtype=bool)
+
+    left = (rank % 2 == 0) & ~flagged_groups[group]
+    left &= np.r_[~new_group[1:], False][:len(xs)]
+    xa, xb = xs[left], xs[np.flatnonzero(left) + 1]
+    span_owner, span_row = owners[left], rows[left]
+
+    # Centres on (or within _EPS of) a crossing are left out of the span and tested
+    near_a = np.rint(xa / CELL_SIZE - 0.5).astype(np.int64)
+    near_b = np.rint(xb / CELL_SIZE - 0.5).astype(np.int64)
+    close_a = np.abs(_centre(near_a) - xa) < _EPS
+    close_b = np.abs(_centre(near_b) - xb) < _EPS
+    col_start, col_stop = _centre_range(xa, xb)
+    col_start = np.where(close_a, near_a + 1, col_start)
+    col_stop = np.where(close_b, near_b, col_stop)
+    span, cols = _expand(col_start, col_stop)
+    inside = [(span_owner[span], cols, span_row[span])]
+
+    test_owner = [span_owner[close_a], span_owner[close_b]]
+    test_col = [near_a[close_a], near_b[close_b]]
+    test_row = [span_row[close_a], span_row[close_b]]
+    if flagged:
+        flag_owner, flag_row = (np.array(v, dtype=np.int64) for v in zip(*sorted(flagged)))
+        bounds = shapely.bounds(geometries[flag_owner])
+        start, stop = _centre_range(bounds[:, 0], bounds[:, 2])
+        line, cols = _expand(start, stop)
+        test_owner.append(flag_owner[line])
+        test_col.append(cols)
+        test_row.append(flag_row[line])
+
+    test_owner = np.concatenate(test_owner)
+    test_col = np.concatenate(test_col)
+    test_row = np.concatenate(test_row)
+    hit = shapely.contains_xy(geometries[test_owner], _centre(test_col), _centre(test_row))
+    inside.append((test_owner[hit], test_col[hit], test_row[hit]))
+    return tuple(np.concatenate(values) for values in zip(*inside))
+
+
+def polygon_cells(geometries, bbox: bool = False):
+    """
+    Enumerate the lattice cells whose centres fall inside each geometry.
+
+    Parameters
+    ----------
+    geometries : array-like of shapely geometries
+        Polygons or multipolygons in lon/lat (EPSG:4326).
+    bbox : bool, optional
+        Use each geometry's bounding box instead of its exact outline, like
+        joining against ``box(*geom.bounds)``.
+
+    Returns
+    -------
+    owners : np.ndarray
+        Position of the owning geometry for each cell.
+    keys : np.ndarray
+        `lattice.cell_keys` key of each cell. Pairs are unique and sorted by
+        owner, then key. Centres exactly on a boundary are outside, as with
+        ``predicate='within'``.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    bounds = shapely.bounds(geometries)
+    valid = np.flatnonzero(np.isfinite(bounds).all(axis=1))
+    if bbox:
+        owners, cols, rows = _box_cells(bounds[valid], valid)
+    else:
+        owners, cols, rows = _polygon_cells(geometries)
+    keys = index_keys(cols, rows)
+
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs = np.unique(np.stack([owners.astype(np.int64), keys]), axis=1)
+    return pairs[0], pairs[1]
+
+
+class CellMembership:
+    """
+    Polygon to lattice cell membership, ready to join against query rows.
+
+    Parameters
+    ----------
+    ids : array-like
+        ID of each polygon, e.g. ``v_shp_id`` or ``shrid2`` values.
+    owners, keys : np.ndarray
+        Output of `polygon_cells`.
+    """
+
+    def __init__(self, ids, owners, keys):
+        self.ids = np.asarray(ids)
+        order = np.argsort(keys, kind='stable')
+        self.keys = np.asarray(keys, dtype=np.int64)[order]
+        self.owners = np.asarray(owners, dtype=np.int64)[order]
+
+    @classmethod
+    def from_geometries(cls, geometries, ids, bbox: bool = False):
+        """Rasterize ``geometries`` (see `polygon_cells`) and label cells with ``ids``."""
+        return cls(ids, *polygon_cells(geometries, bbox=bbox))
+
+    @classmethod
+    def from_frame(cls, df, id_column: str):
+        """Inverse of `to_frame`."""
+        ids, owners = np.unique(df[id_column].to_numpy(), return_inverse=True)
+        return cls(ids, owners, df['cell'].to_numpy())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def to_frame(self, id_column: str = 'id'):
+        """Return one row per (polygon, cell) pair, sorted by polygon then cell key."""
+        order = np.lexsort((self.keys, self.owners))
+        return pd.DataFrame({id_column: self.ids[self.owners[order]], 'cell': self.keys[order]})
+
+    def join(self, rows, id_column: str = 'v_shp_id', lon_col: str = 'lon', lat_col: str = 'lat'):
+        """
+        Tag query rows with the polygons containing them.
+
+        Equivalent to an inner ``gpd.sjoin(..., predicate='within')`` of the
+        rows' points: a row inside several (overlapping) polygons is repeated
+        once per polygon, and rows outside every polygon are dropped. The
+        polygon ID is added as ``id_column``.
+        """
+        keys = cell_keys(rows[lon_col], rows[lat_col])
+        start = np.searchsorted(self.keys, keys, side='left')
+        stop = np.searchsorted(self.keys, keys, side='right')
+        row_pos, member = _expand(start, stop)
+
+        joined = rows.iloc[row_pos].reset_index(drop=True)
+        joined[id_column] = self.ids[self.owners[member]]
+        return joined
+
+
+def _source_files(path):
+    """A shapefile is hashed together with its sidecar files (the .dbf holds the IDs)."""
+    stem, ext = os.path.splitext(path)
+    if ext.lower() != '.shp':
+        return [path]
+    return [f"{stem}{side}" for side in ('.shp', '.shx', '.dbf', '.prj') if os.path.exists(f"{stem}{side}")]
+
+
+def load_membership(path: str, id_column: str, bbox: bool = False, cache_dir: str = MEMBERSHIP_DIR):
+    """
+    Return the `CellMembership` of the polygons in a shapefile or shrid CSV.
+
+    The membership is computed once and saved as a Parquet table of
+    ``(id_column, cell)`` pairs, keyed by a hash of the source files, so
+    edits to the polygons invalidate it automatically.
+
+    Parameters
+    ----------
+    path : str
+        ``villages_shapefiles.shp`` (or any file geopandas reads), or a shrid
+        CSV with a ``polygon_coordinates`` column.
+    id_column : str
+        Polygon ID column, e.g. 'v_shp_id' or 'shrid2'.
+    bbox : bool, optional
+        Use each polygon's bounding box instead of its exact outline.
+    cache_dir : str, optional
+        Where membership tables are kept.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(path))[0]
+    variant = 'bbox' if bbox else 'exact'
+    cache_path = os.path.join(cache_dir, f"{name}.{id_column}.{variant}.{file_digest(*_source_files(path))}.parquet")
+    if os.path.exists(cache_path):
+        metrics.add('membership_cache', hits=1)
+        return CellMembership.from_frame(pd.read_parquet(cache_path), id_column)
+
+    metrics.add('membership_cache', misses=1)
+    polygons = read_polygons(path)
+    membership = CellMembership.from_geometries(polygons.geometry.values, polygons[id_column].to_numpy(), bbox=bbox)
+    membership.to_frame(id_column).to_parquet(f"{cache_path}.tmp", index=False)
+    os.replace(f"{cache_path}.tmp", cache_path)
+    return membership
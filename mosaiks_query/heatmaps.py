@@ -0,0 +1,245 @@
+"""Batch rendering of per-village folium heatmaps.
+
+The points are grouped by village once (a single stable sort) instead of
+filtering the whole frame for every village, points inside each polygon are
+found with one vectorized ``shapely.contains_xy`` call, and villages are
+spread over a process pool whose workers each write their own HTML files.
+Heatmaps that already exist and are newer than the source data are skipped,
+so re-runs only render what changed.
+
+`export_heatmaps` is a lighter alternative to standalone HTML files: one
+shared viewer page (``templates/heatmap_viewer.html``) plus a small packed
+float32 data file per village, and optionally a tiled national layer.
+"""
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from mosaiks_query import metrics
+
+# Villages sent to a worker at once; amortizes pickling and process start-up
+TASK_CHUNK_SIZE = 50
+
+
+def _render_chunk(tasks, zoom_start, outline):
+    # folium is only needed for standalone HTML pages, not for `export_heatmaps`
+    import folium
+    import geopandas as gpd
+    from folium.plugins import HeatMap
+
+    for path, polygon, points, popup in tasks:
+        x_min, y_min, x_max, y_max = polygon.bounds
+        m = folium.Map(location=[(y_min + y_max) / 2, (x_min + x_max) / 2], zoom_start=zoom_start)
+        if outline == 'geojson':
+            # Simplified, unfilled outline as drawn by heatmap.ipynb
+            geo_j = folium.GeoJson(data=gpd.GeoSeries(polygon).simplify(tolerance=0.001).to_json(),
+                                   style_function=lambda x: {"fillOpacity": "0%"})
+            folium.Popup(popup).add_to(geo_j)
+            geo_j.add_to(m)
+        else:
+            for part in shapely.get_parts(polygon):
+                folium.Polygon(
+                    locations=[(p[1], p[0]) for p in part.exterior.coords],
+                    color='blue', weight=2, fill=True, fill_opacity=0.2
+                ).add_to(m)
+        HeatMap(points.tolist()).add_to(m)
+        m.save(f"{path}.tmp.html")
+        os.replace(f"{path}.tmp.html", path)
+    return len(tasks)
+
+
+def _is_up_to_date(path, since):
+    return os.path.exists(path) and (since is None or os.path.getmtime(path) >= since)
+
+
+def _village_tasks(ids, lats, lons, scores, polygons, output_folder, file_pattern, inside_only, source, force):
+    """
+    Group the points by village once and return ``(tasks, skipped)``.
+
+    Each task is ``(path, polygon, points, position)`` with ``points`` an
+    (n, 3) array of lat, lon, score; villages whose file is up to date are
+    counted in ``skipped`` instead.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    sources = [source] if isinstance(source, str) else list(source or [])
+    since = max((os.path.getmtime(path) for path in sources), default=None)
+
+    # Codes follow the order in which villages first appear
+    codes, villages = pd.factorize(np.asarray(ids))
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(villages) + 1))
+    points = np.column_stack([np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64),
+                              np.asarray(scores, dtype=np.float64)])[order]
+
+    tasks = []
+    skipped = 0
+    for i, village in enumerate(villages):
+        polygon = polygons.get(village)
+        if polygon is None:
+            continue
+        path = os.path.join(output_folder, file_pattern.format(id=village))
+        if not force and _is_up_to_date(path, since):
+            skipped += 1
+            continue
+        village_points = points[bounds[i]:bounds[i + 1]]
+        if inside_only:
+            village_points = village_points[shapely.contains_xy(polygon, village_points[:, 1], village_points[:, 0])]
+        # If no data points fall inside the polygon, skip
+        if len(village_points) == 0:
+            continue
+        tasks.append((path, polygon, village_points, i))
+    return tasks, skipped
+
+
+def heatmap_paths(output_folder: str, ids, mode: str = 'html', file_pattern: str = "heatmap_{id}.html"):
+    """Return the file of each village's heatmap: an HTML page, or its binary data for ``mode='binary'``."""
+    if mode == 'binary':
+        return [os.path.join(output_folder, "data", f"{village}.bin") for village in ids]
+    return [os.path.join(output_folder, file_pattern.format(id=village)) for village in ids]
+
+
+@metrics.timed('render')
+def render_heatmaps(ids, lats, lons, scores, polygons, output_folder: str,
+                    file_pattern: str = "heatmap_{id}.html", inside_only: bool = False,
+                    zoom_start: int = 15, outline: str = 'polygon', processes: int = None,
+                    source=None, force: bool = False):
+    """
+    Render one HTML heatmap per village.
+
+    Parameters
+    ----------
+    ids, lats, lons, scores : array-like
+        Village ID, coordinates and heatmap weight (e.g. PCA_1) of each point.
+    polygons : mapping
+        Village ID -> shapely polygon, e.g. a GeoSeries indexed by ID.
+        Villages without a polygon are skipped.
+    output_folder : str
+        Directory for the HTML files.
+    file_pattern : str, optional
+        File name, formatted with the village ``id``.
+    inside_only : bool, optional
+        Only plot points inside the polygon (fine-grained version); otherwise
+        plot every point of the village (bounding box version).
+    zoom_start : int, optional
+        Initial zoom level of the folium map.
+    outline : {'polygon', 'geojson'}, optional
+        Filled folium polygon as in ``img_generation_heatmap``, or the
+        simplified GeoJSON outline with a popup used by ``heatmap.ipynb``.
+    processes : int, optional
+        Worker processes. Defaults to the CPU count; 1 renders in this process.
+    source : str or list of str, optional
+        Input file(s) the heatmaps are made from. Existing heatmaps newer than
+        all of them are skipped; without ``source`` any existing file is.
+    force : bool, optional
+        Re-render every heatmap.
+
+    Returns
+    -------
+    int
+        Number of heatmaps written.
+    """
+    tasks, skipped = _village_tasks(ids, lats, lons, scores, polygons, output_folder, file_pattern,
+                                    inside_only, source, force)
+    print(f"Rendering {len(tasks)} heatmaps ({skipped} up to date)")
+    chunks = [tasks[start:start + TASK_CHUNK_SIZE] for start in range(0, len(tasks), TASK_CHUNK_SIZE)]
+    done = 0
+    started = time.monotonic()
+    if processes == 1:
+        for chunk in chunks:
+            done += _render_chunk(chunk, zoom_start, outline)
+            print(f"Rendered {done} of {len(tasks)} heatmaps ({time.monotonic() - started:.0f}s)")
+        return done
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(_render_chunk, chunk, zoom_start, outline) for chunk in chunks]
+        for future in as_completed(futures):
+            done += future.result()
+            print(f"Rendered {done} of {len(tasks)} heatmaps ({time.monotonic() - started:.0f}s)")
+    return done
+
+
+VIEWER_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "heatmap_viewer.html")
+
+# Degrees per national layer tile
+NATIONAL_TILE_SIZE = 1
+
+
+def _write_village(path, polygon, points, simplify):
+    """Pack a village's points and simplified outline into one small binary file."""
+    outline = shapely.simplify(polygon, simplify) if simplify else polygon
+    rings = [np.asarray(part.exterior.coords)[:, ::-1] for part in shapely.get_parts(outline) if not part.is_empty]
+    header = np.array([len(points), len(rings), sum(len(ring) for ring in rings)] + [len(ring) for ring in rings],
+                      dtype='<u4')
+    with open(f"{path}.tmp", 'wb') as f:
+        f.write(header.tobytes())
+        f.write(points.astype('<f4').tobytes())
+        for ring in rings:
+            f.write(ring.astype('<f4').tobytes())
+    os.replace(f"{path}.tmp", path)
+
+
+def _write_national_layer(lats, lons, scores, output_folder):
+    """Write every distinct point once into 1 degree tiles plus a ``tiles.json`` listing."""
+    directory = os.path.join(output_folder, "national")
+    os.makedirs(directory, exist_ok=True)
+    points = pd.DataFrame({'lat': np.asarray(lats, dtype=np.float64), 'lon': np.asarray(lons, dtype=np.float64),
+                           'score': np.asarray(scores, dtype=np.float64)}).drop_duplicates(subset=['lat', 'lon'])
+    points['tile'] = [f"{x}_{y}" for x, y in zip(np.floor(points['lon'] / NATIONAL_TILE_SIZE).astype(int).tolist(),
+                                                  np.floor(points['lat'] / NATIONAL_TILE_SIZE).astype(int).tolist())]
+    names = []
+    for name, tile in points.groupby('tile', sort=True):
+        path = os.path.join(directory, f"{name}.bin")
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(np.array([len(tile)], dtype='<u4').tobytes())
+            f.write(tile[['lat', 'lon', 'score']].to_numpy(dtype='<f4').tobytes())
+        os.replace(f"{path}.tmp", path)
+        names.append(name)
+    with open(os.path.join(directory, "tiles.json"), 'w') as f:
+        json.dump(names, f)
+
+
+@metrics.timed('render')
+def export_heatmaps(ids, lats, lons, scores, polygons, output_folder: str, inside_only: bool = False,
+                    simplify: float = 0.001, national_layer: bool = False, source=None, force: bool = False):
+    """
+    Write one shared viewer page plus a compact binary data file per village.
+
+    A standalone folium HTML repeats the whole leaflet boilerplate and the
+    points as JSON text in every file. Here ``index.html`` is written once
+    and each village gets ``data/<id>.bin`` with its points as float32
+    (lat, lon, score) and its simplified outline; the viewer fetches only the
+    village being viewed (``index.html?id=<id>``, served over HTTP).
+
+    Parameters
+    ----------
+    ids, lats, lons, scores, polygons, inside_only, source, force
+        As for `render_heatmaps`.
+    output_folder : str
+        Directory for ``index.html``, ``data/`` and ``national/``.
+    simplify : float, optional
+        Outline simplification tolerance in degrees; 0 keeps every vertex.
+    national_layer : bool, optional
+        Also write every point once into 1 degree tiles under ``national/``,
+        which the viewer loads for the visible area (``index.html?layer=national``).
+
+    Returns
+    -------
+    int
+        Number of village files written.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    shutil.copyfile(VIEWER_TEMPLATE, os.path.join(output_folder, "index.html"))
+    tasks, skipped = _village_tasks(ids, lats, lons, scores, polygons, os.path.join(output_folder, "data"),
+                                    "{id}.bin", inside_only, source, force)
+    print(f"Exporting {len(tasks)} heatmaps ({skipped} up to date)")
+    for path, polygon, points, _ in tasks:
+        _write_village(path, polygon, points, simplify)
+    if national_layer:
+        _write_national_layer(lats, lons, scores, output_folder)
+    return len(tasks)
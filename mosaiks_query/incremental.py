@@ -0,0 +1,63 @@
+"""Change detection for incremental reruns after polygon edits.
+
+Every polygon gets a hash of its normalized geometry and its attribute
+values. The hashes of the polygons an output was built from are saved next
+to it (``output/coords_inside.hashes.parquet`` for
+``output/coords_inside.parquet``), so a later run can tell which polygons
+were added, edited or removed and only redo those (see
+`pipeline.update_villages`).
+"""
+import hashlib
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import shapely
+
+# IDs of the polygons that are new, whose geometry or attributes changed, or that are gone
+Changes = namedtuple('Changes', ['added', 'modified', 'removed'])
+
+
+def polygon_hashes(polygons, id_column: str):
+    """
+    Return a Series of per-polygon hashes indexed by ID.
+
+    Geometries are normalized first, so rewriting a shapefile with the same
+    rings in another order or starting vertex does not count as a change.
+    """
+    geometry = polygons.geometry.values
+    wkb = shapely.to_wkb(shapely.normalize(geometry))
+    attributes = pd.DataFrame(polygons.drop(columns=[polygons.geometry.name]))
+    attribute_hashes = pd.util.hash_pandas_object(attributes, index=False).to_numpy()
+    hashes = [hashlib.sha1(shape + int(attribute).to_bytes(8, 'little')).hexdigest()[:16]
+              for shape, attribute in zip(wkb, attribute_hashes)]
+    return pd.Series(hashes, index=polygons[id_column].to_numpy(), name='hash')
+
+
+def hashes_path(output: str):
+    """Where the hashes of an output table are kept."""
+    return f"{os.path.splitext(output)[0]}.hashes.parquet"
+
+
+def load_hashes(output: str, id_column: str):
+    """Return the saved hashes of an output table, or None if there are none."""
+    path = hashes_path(output)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path).set_index(id_column)['hash']
+
+
+def save_hashes(hashes, output: str, id_column: str):
+    """Save the hashes an output table was built from."""
+    path = hashes_path(output)
+    hashes.rename_axis(id_column).reset_index().to_parquet(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def diff_hashes(old, new):
+    """Compare two hash Series and return the `Changes`."""
+    common = old.index.intersection(new.index)
+    modified = common[old.loc[common].to_numpy() != new.loc[common].to_numpy()]
+    return Changes(added=np.asarray(new.index.difference(old.index)), modified=np.asarray(modified),
+                   removed=np.asarray(old.index.difference(new.index)))
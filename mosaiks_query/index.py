@@ -0,0 +1,47 @@
+"""Vectorized coordinate lookups against a table of MOSAIKS rows."""
+import numpy as np
+
+from mosaiks_query.lattice import cell_keys
+
+
+class CoordinateIndex:
+    """
+    Sorted index of lattice cell keys built once from a table of coordinates.
+
+    Replaces per-row binary searches over ``list(zip(df['lon'], df['lat']))``:
+    the keys are sorted a single time and whole frames are looked up with one
+    ``np.searchsorted`` call.
+
+    Parameters
+    ----------
+    lons, lats : array-like
+        Coordinates of the indexed rows, in row order.
+    """
+
+    def __init__(self, lons, lats):
+        keys = cell_keys(lons, lats)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    @classmethod
+    def from_frame(cls, df, lon_col: str = 'lon', lat_col: str = 'lat'):
+        """Build an index over the rows of a DataFrame."""
+        return cls(df[lon_col].to_numpy(), df[lat_col].to_numpy())
+
+    def __len__(self):
+        return len(self.sorted_keys)
+
+    def lookup(self, lons, lats):
+        """
+        Return the row position of each (lon, lat) pair, or -1 if it is absent.
+
+        Positions refer to the order of the rows the index was built from, so
+        they can be passed straight to ``df.iloc`` or ``ndarray.take``.
+        """
+        keys = cell_keys(lons, lats)
+        if len(self.sorted_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.searchsorted(self.sorted_keys, keys)
+        pos = np.minimum(pos, len(self.sorted_keys) - 1)
+        found = self.sorted_keys[pos] == keys
+        return np.where(found, self.order[pos], -1)
@@ -0,0 +1,82 @@
+"""Arrow-native ingestion of Redivis query results.
+
+``query.to_pandas_dataframe()`` builds a float64 frame of every column
+before anything else can happen, so each 4000-feature chunk briefly exists
+twice: once as Arrow data and once as float64 pandas blocks. The helpers
+here consume the result as Arrow record batches instead
+(``query.to_arrow_batch_iterator()``), select the needed columns and cast
+the X_* features to float32 batch by batch, and only then convert to
+pandas, so peak memory per chunk is roughly halved and no full-width
+float64 copy is ever made.
+
+Results without an Arrow iterator (e.g. the offline stand-ins) fall back to
+``to_pandas_dataframe()`` with the same projection and downcast.
+"""
+import pandas as pd
+import pyarrow as pa
+
+from mosaiks_query.storage import feature_columns, to_float32
+
+
+def _prepare(batch, columns, float32):
+    """Project and downcast one record batch."""
+    if columns is not None:
+        batch = batch.select(columns)
+    if not float32:
+        return batch
+    features = set(feature_columns(batch.schema.names))
+    arrays = [array.cast(pa.float32()) if name in features and pa.types.is_floating(array.type) else array
+              for name, array in zip(batch.schema.names, batch.columns)]
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+def iter_batches(result, columns=None, float32: bool = True):
+    """
+    Yield a query result as Arrow record batches, projected and downcast as they arrive.
+
+    Parameters
+    ----------
+    result : redivis.Query
+        Result of ``dataset.query(sql)``.
+    columns : list of str, optional
+        Columns to keep, in this order.
+    float32 : bool, optional
+        Cast the X_* feature columns to float32.
+    """
+    if hasattr(result, 'to_arrow_batch_iterator'):
+        for batch in result.to_arrow_batch_iterator():
+            yield _prepare(batch, columns, float32)
+        return
+
+    df = result.to_pandas_dataframe()
+    if columns is not None:
+        df = df[columns]
+    if float32:
+        df = to_float32(df)
+    yield pa.RecordBatch.from_pandas(df, preserve_index=False)
+
+
+def _to_pandas(table):
+    # self_destruct frees each Arrow column as soon as it is converted
+    return table.to_pandas(self_destruct=True)
+
+
+def iter_frames(result, columns=None, float32: bool = True):
+    """Yield a query result as one DataFrame per record batch; see `iter_batches`."""
+    for batch in iter_batches(result, columns, float32):
+        if batch.num_rows:
+            yield _to_pandas(pa.Table.from_batches([batch]))
+
+
+def read_result(result, columns=None, float32: bool = True):
+    """
+    Return a whole query result as one DataFrame, converted from Arrow once.
+
+    Drop-in replacement for ``result.to_pandas_dataframe()``; see
+    `iter_batches` for the parameters. An empty result gives an empty frame.
+    """
+    batches = list(iter_batches(result, columns, float32))
+    if not batches:
+        # No batch means no schema either; every MOSAIKS result has at least lon and lat
+        return pd.DataFrame(columns=columns if columns is not None else ['lon', 'lat'])
+    return _to_pandas(pa.Table.from_batches(batches))
@@ -0,0 +1,58 @@
+"""Helpers for the MOSAIKS 0.01 degree lattice.
+
+MOSAIKS points sit at the centres of a 0.01 degree grid, so every coordinate
+ends in 5 at the third decimal (e.g. 77.125, 28.635). A cell is identified by
+a single int64 key built from its lon/lat scaled by 1000, which lets us join
+and look up cells with integer arithmetic instead of float comparisons.
+"""
+import numpy as np
+
+CELL_SIZE = 0.01
+
+# lon/lat * 1000 are integers on the lattice; offsets keep both parts positive
+_SCALE = 1000
+_LON_OFFSET = 180_000
+_LAT_OFFSET = 90_000
+_LAT_SPAN = 1_000_000
+
+
+def cell_keys(lons, lats):
+    """Return the int64 cell key of each (lon, lat) lattice coordinate."""
+    lon_i = np.rint(np.asarray(lons, dtype=np.float64) * _SCALE).astype(np.int64)
+    lat_i = np.rint(np.asarray(lats, dtype=np.float64) * _SCALE).astype(np.int64)
+    return (lon_i + _LON_OFFSET) * _LAT_SPAN + (lat_i + _LAT_OFFSET)
+
+
+def key_coords(keys):
+    """Inverse of `cell_keys`: return (lons, lats) arrays for the given keys."""
+    keys = np.asarray(keys, dtype=np.int64)
+    lon_i = keys // _LAT_SPAN - _LON_OFFSET
+    lat_i = keys % _LAT_SPAN - _LAT_OFFSET
+    return lon_i / _SCALE, lat_i / _SCALE
+
+
+def cell_index(values):
+    """Return the integer column (lon) or row (lat) index containing each value."""
+    return np.floor(np.asarray(values, dtype=np.float64) / CELL_SIZE).astype(np.int64)
+
+
+def key_index(keys):
+    """Return the (column, row) lattice indices of each cell key."""
+    lons, lats = key_coords(keys)
+    return cell_index(lons), cell_index(lats)
+
+
+def index_keys(columns, rows):
+    """Inverse of `key_index`: return the key of the cell centred in each (column, row)."""
+    lon_i = np.asarray(columns, dtype=np.int64) * 10 + 5
+    lat_i = np.asarray(rows, dtype=np.int64) * 10 + 5
+    return (lon_i + _LON_OFFSET) * _LAT_SPAN + (lat_i + _LAT_OFFSET)
+
+
+def snap(values):
+    """Snap coordinates to the lattice the same way the midpoint scripts do.
+
+    Truncates to 2 decimals and adds 0.005, i.e. ``round(truncate(x, 2) + 0.005, 3)``.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.round(np.trunc(values * 100) / 100 + 0.005, 3)
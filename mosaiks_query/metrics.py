@@ -0,0 +1,207 @@
+"""Lightweight per-stage instrumentation for the pipeline scripts.
+
+Stages (query, join, aggregate, render, ...) are timed with `stage`, which
+also records rows and the peak RSS of the process. Lower-level events are
+accumulated with `add`: every Redivis query records its latency, rows and
+bytes, the tile cache records cell and tile hits and misses, and table
+reads/writes record their I/O time. This is enough to tell Redivis latency
+from geometry work or file I/O in a slow run.
+
+Collection is always on and costs a few dictionary updates per event.
+Scripts call `configure` to print a summary table at exit and, with
+``path`` or the ``MOSAIKS_METRICS`` environment variable, to stream every
+stage and query as a JSON line:
+
+    MOSAIKS_METRICS=run.jsonl python coords_inside_query.py
+"""
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+_lock = threading.Lock()
+_stages = []
+_counters = {}
+_sink = None
+_configured = False
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _emit(record):
+    if _sink is not None:
+        with _lock:
+            _sink.write(json.dumps(record) + "\n")
+            _sink.flush()
+
+
+class Stage:
+    """Timing record of one pipeline stage; set ``rows`` inside the block."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.seconds = None
+        self.peak_rss_mb = None
+
+    def as_dict(self):
+        return {'type': 'stage', 'stage': self.name, 'seconds': round(self.seconds, 4),
+                'rows': self.rows, 'peak_rss_mb': round(self.peak_rss_mb, 1)}
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block as pipeline stage ``name``.
+
+    Examples
+    --------
+    >>> with metrics.stage('query') as s:
+    ...     df = cache.get_cells(membership.keys)
+    ...     s.rows = len(df)
+    """
+    record = Stage(name)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - started
+        record.peak_rss_mb = _peak_rss_mb()
+        with _lock:
+            _stages.append(record)
+        _emit(record.as_dict())
+
+
+def timed(name: str):
+    """
+    Decorator recording every call of a function as stage ``name``.
+
+    The stage's rows are the result if it is an int (e.g. files written) or
+    its length if it has one (e.g. a DataFrame).
+    """
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as record:
+                result = func(*args, **kwargs)
+                if isinstance(result, int):
+                    record.rows = result
+                elif hasattr(result, '__len__'):
+                    record.rows = len(result)
+                return result
+        return wrapper
+    return decorate
+
+
+def add(name: str, **amounts):
+    """Accumulate ``amounts`` (e.g. ``hits=3, seconds=0.2``) and a call count under ``name``."""
+    with _lock:
+        counter = _counters.setdefault(name, {'calls': 0})
+        counter['calls'] += 1
+        for key, value in amounts.items():
+            counter[key] = counter.get(key, 0) + value
+
+
+def query(kind: str, seconds: float, rows: int, nbytes: int, literals: int = None):
+    """Record one Redivis query: its latency, result rows and result bytes."""
+    add('queries', seconds=seconds, rows=rows, bytes=nbytes)
+    add(f'queries.{kind}', seconds=seconds, rows=rows, bytes=nbytes)
+    _emit({'type': 'query', 'kind': kind, 'seconds': round(seconds, 4), 'rows': rows, 'bytes': nbytes,
+           'literals': literals})
+
+
+def counters():
+    """Return a copy of the accumulated counters."""
+    with _lock:
+        return {name: dict(values) for name, values in _counters.items()}
+
+
+def reset():
+    """Forget every recorded stage and counter."""
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+def _rate(hits, misses):
+    total = hits + misses
+    return f"{hits / total:.1%}" if total else "-"
+
+
+def summary():
+    """Return the stages, queries, cache hit rates and I/O as a text table."""
+    lines = [f"{'stage':<20} {'calls':>6} {'seconds':>10} {'rows':>12} {'peak MB':>9}"]
+    totals = {}
+    for record in _stages:
+        total = totals.setdefault(record.name, [0, 0.0, None, 0.0])
+        total[0] += 1
+        total[1] += record.seconds
+        if record.rows is not None:
+            total[2] = (total[2] or 0) + record.rows
+        total[3] = max(total[3], record.peak_rss_mb)
+    for name, (calls, seconds, rows, peak) in totals.items():
+        lines.append(f"{name:<20} {calls:>6} {seconds:>10.2f} {rows if rows is not None else '':>12} {peak:>9.1f}")
+
+    values = counters()
+    lines.append("")
+    lines.append(f"{'event':<20} {'calls':>6} {'seconds':>10} {'rows':>12} {'MB':>9}")
+    for name in sorted(values):
+        counter = values[name]
+        if 'seconds' in counter:
+            lines.append(f"{name:<20} {counter['calls']:>6} {counter['seconds']:>10.2f}"
+                         f" {counter.get('rows', ''):>12} {counter.get('bytes', 0) / 2 ** 20:>9.1f}")
+
+    cells, tiles = values.get('cache.cells', {}), values.get('cache.tiles', {})
+    membership = values.get('membership_cache', {})
+    lines.append("")
+    lines.append(f"cell cache hit rate: {_rate(cells.get('hits', 0), cells.get('misses', 0))}"
+                 f" ({cells.get('hits', 0)} cached, {cells.get('misses', 0)} fetched)")
+    lines.append(f"tile cache hit rate: {_rate(tiles.get('hits', 0), tiles.get('misses', 0))}"
+                 f" ({tiles.get('hits', 0)} cached, {tiles.get('misses', 0)} fetched)")
+    if membership:
+        lines.append(f"membership cache hit rate: {_rate(membership.get('hits', 0), membership.get('misses', 0))}")
+    if 'query_retries' in values:
+        lines.append(f"query retries: {values['query_retries']['calls']}")
+    return "\n".join(lines)
+
+
+def _report():
+    if _stages or _counters:
+        print("\n" + summary())
+    _emit({'type': 'counters', **counters()})
+    if _sink is not None:
+        _sink.close()
+
+
+def configure(path: str = None, print_summary: bool = True):
+    """
+    Report the metrics of this run at exit.
+
+    The query scripts call this on startup, so every run prints per-stage
+    timings, query latencies and cache hit rates when it exits; setting
+    ``MOSAIKS_METRICS=<file>.jsonl`` also logs them as JSON lines.
+
+    Parameters
+    ----------
+    path : str, optional
+        JSON lines file that receives every stage and query as it completes
+        and the counters at exit. Defaults to ``$MOSAIKS_METRICS``.
+    print_summary : bool, optional
+        Print the summary table at exit.
+    """
+    global _sink, _configured
+    path = path or os.environ.get('MOSAIKS_METRICS')
+    if path and _sink is None:
+        _sink = open(path, 'a')
+    if not _configured:
+        _configured = True
+        atexit.register(_report if print_summary else lambda: _emit({'type': 'counters', **counters()}))
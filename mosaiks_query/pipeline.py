@@ -0,0 +1,579 @@
+"""The query -> join -> aggregate -> render pipeline as importable functions.
+
+These are the steps the top-level scripts used to run at import time. Each
+function does its own work only when called, and the heavy or optional
+dependencies (``redivis``, ``geopandas``, ``sklearn``, ``folium``) are
+imported inside the functions that need them, so importing this module or
+running ``python -m mosaiks_query aggregate`` costs no network setup. The
+same functions back the CLI (see `mosaiks_query.cli`).
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from mosaiks_query import metrics
+from mosaiks_query.cache import TABLE_NAME
+from mosaiks_query.storage import output_path, read_schema, read_table, write_table
+
+# Redivis owner and dataset holding the MOSAIKS tables
+DATASET_USER = "sdss"
+DATASET_NAME = "mosaiks"
+
+SHAPEFILE = "villages_shapefiles/villages_shapefiles.shp"
+
+
+def open_dataset(user: str = DATASET_USER, dataset_name: str = DATASET_NAME):
+    """Connect to the MOSAIKS dataset on Redivis."""
+    # Library used for Redivis API to query MOSAIKS data
+    # https://github.com/Global-Policy-Lab/mosaiks_tutorials/blob/main/01_querying_redivis.ipynb
+    import redivis
+
+    return redivis.user(user).dataset(dataset_name)
+
+
+def open_cache(table_name: str = TABLE_NAME, user: str = DATASET_USER, dataset_name: str = DATASET_NAME,
+               cache_dir: str = "cache", max_workers: int = 4, requests_per_second: float = 2):
+    """
+    Connect to the MOSAIKS dataset on Redivis behind the local tile cache.
+
+    By default up to 4 queries run at once, at most 2 per second, and
+    transient failures are retried.
+    """
+    from mosaiks_query.cache import TileCache
+    from mosaiks_query.scheduler import QueryScheduler
+
+    scheduler = QueryScheduler(max_workers=max_workers, requests_per_second=requests_per_second)
+    return TileCache(open_dataset(user, dataset_name), table_name, cache_dir=cache_dir, scheduler=scheduler)
+
+
+def _membership(polygons_path, id_column, bbox):
+    from mosaiks_query.grid_join import load_membership
+
+    # Lattice cells inside each polygon (or its bounding box), computed once per file and kept under cache/
+    with metrics.stage('geometry') as s:
+        membership = load_membership(polygons_path, id_column, bbox=bbox)
+        s.rows = len(membership)
+    return membership
+
+
+def _midpoints(polygons_path):
+    """Polygon attributes plus the lattice cell (centroid_x, centroid_y) of each centroid."""
+    import shapely
+
+    from mosaiks_query.lattice import snap
+    from mosaiks_query.polygons import read_polygons
+
+    with metrics.stage('geometry') as s:
+        polygons = read_polygons(polygons_path)
+        centroids = shapely.centroid(polygons.geometry.values)
+        # Snap each centroid to the nearest MOSAIKS lattice point
+        polygons['centroid_x'] = snap(shapely.get_x(centroids))
+        polygons['centroid_y'] = snap(shapely.get_y(centroids))
+        s.rows = len(polygons)
+    return polygons.drop(columns=[polygons.geometry.name])
+
+
+def _query_midpoints(cache, midpoints):
+    with metrics.stage('query') as s:
+        rows = cache.get_points(midpoints['centroid_x'], midpoints['centroid_y'])
+        s.rows = len(rows)
+    return rows
+
+
+def _join_midpoints(rows, midpoints):
+    with metrics.stage('join') as s:
+        rows = rows.rename(columns={'lon': 'centroid_x', 'lat': 'centroid_y'})
+        joined = midpoints.merge(rows, how='inner', on=['centroid_x', 'centroid_y'])
+        s.rows = len(joined)
+    return joined
+
+
+def query_cells(cache, polygons_path: str = SHAPEFILE, id_column: str = 'v_shp_id', bbox: bool = False,
+                midpoint: bool = False):
+    """
+    Return the MOSAIKS rows of every cell the polygons need, each cell once.
+
+    Parameters
+    ----------
+    cache : TileCache
+        Source of the rows, e.g. `open_cache()`. Only cells not cached yet
+        are queried.
+    polygons_path : str, optional
+        Village shapefile or shrid CSV.
+    id_column : str, optional
+        Polygon ID column, 'v_shp_id' or 'shrid2'.
+    bbox : bool, optional
+        Cells inside each polygon's bounding box instead of its outline.
+    midpoint : bool, optional
+        Only the cell at each polygon's centroid.
+    """
+    if midpoint:
+        return _query_midpoints(cache, _midpoints(polygons_path))
+
+    membership = _membership(polygons_path, id_column, bbox)
+    # Fetch the union of all polygons' cells, each cell once however many polygons overlap it
+    with metrics.stage('query') as s:
+        rows = cache.get_cells(membership.keys)
+        s.rows = len(rows)
+    return rows
+
+
+def join_cells(rows, polygons_path: str = SHAPEFILE, id_column: str = 'v_shp_id', bbox: bool = False,
+               midpoint: bool = False, attributes: bool = True):
+    """
+    Tag MOSAIKS rows with the polygons containing them.
+
+    Every point is fanned out to the polygons containing it by lattice cell
+    key (the same result as ``gpd.sjoin(..., predicate='within')`` without
+    building Point objects). Returns the points grouped by polygon ID, each
+    polygon's points sorted by lon and lat, with the ID as index.
+
+    Parameters
+    ----------
+    rows : pd.DataFrame
+        Output of `query_cells`.
+    polygons_path, id_column, bbox, midpoint
+        As for `query_cells`.
+    attributes : bool, optional
+        Also join the shapefile's attribute columns (ignored for a CSV).
+    """
+    if midpoint:
+        return _join_midpoints(rows, _midpoints(polygons_path))
+
+    attributes = _attributes(polygons_path, id_column) if attributes else None
+    return _join(rows, _membership(polygons_path, id_column, bbox), id_column, attributes)
+
+
+def _attributes(polygons_path, id_column):
+    """Attribute columns of a shapefile indexed by ID, or None for a shrid CSV."""
+    if polygons_path.lower().endswith('.csv'):
+        return None
+    import geopandas as gpd
+
+    # Attribute columns only; the polygons are not parsed again
+    return gpd.read_file(polygons_path, ignore_geometry=True).set_index(id_column)
+
+
+def _join(rows, membership, id_column, attributes=None):
+    with metrics.stage('join') as s:
+        joined = membership.join(rows, id_column=id_column)
+        if attributes is not None:
+            joined = joined.join(attributes, on=id_column)
+        joined = joined.sort_values(by=[id_column, 'lon', 'lat']).set_index(id_column)
+        s.rows = len(joined)
+    return joined
+
+
+def write_joined(joined, output: str, features_dir: str = None, index: bool = True):
+    """
+    Write a joined table and, if ``features_dir`` is given, build its feature store.
+
+    The feature store keeps the features as a memory-mapped float32 matrix
+    for PCA and aggregation.
+    """
+    from mosaiks_query.feature_store import FeatureStore
+
+    with metrics.stage('write') as s:
+        write_table(joined, output, index=index)
+        if features_dir:
+            FeatureStore.build(output, features_dir)
+        s.rows = len(joined)
+    return output
+
+
+def query_villages(cache, polygons_path: str = SHAPEFILE, id_column: str = 'v_shp_id', bbox: bool = False,
+                   output: str = None, features_dir: str = None):
+    """
+    Query, join and write the points inside each polygon (or bounding box).
+
+    This is what ``coords_inside_query.py`` and ``coords_inside_box.py`` do.
+    ``output`` defaults to ``output/coords_inside(_box).parquet`` and
+    ``features_dir`` to ``output/coords_inside(_box)_features``.
+    """
+    name = "coords_inside_box" if bbox else "coords_inside"
+    output = output or output_path(name)
+    rows = query_cells(cache, polygons_path, id_column, bbox=bbox)
+    joined = join_cells(rows, polygons_path, id_column, bbox=bbox)
+    return write_joined(joined, output, features_dir or os.path.join(os.path.dirname(output), f"{name}_features"))
+
+
+def stream_villages(dataset, polygons_path: str = SHAPEFILE, id_column: str = 'v_shp_id', bbox: bool = False,
+                    output: str = None, columns=None, table_name: str = TABLE_NAME, max_workers: int = 4,
+                    requests_per_second: float = 2):
+    """
+    Query, join and write the points inside each polygon without the tile cache.
+
+    Every Arrow batch of the results is downcast to float32, joined to the
+    polygons and appended to ``output`` as it arrives (see
+    `executor.stream_query`), so memory stays at a few batches however
+    large the area. Unlike `query_villages` the output is in arrival order,
+    not sorted by polygon; `aggregate` does not need it sorted.
+
+    Parameters
+    ----------
+    dataset : redivis.Dataset
+        E.g. `open_dataset()`.
+    polygons_path, id_column, bbox
+        As for `query_cells`.
+    output : str, optional
+        Defaults to ``output/coords_inside(_box).parquet``.
+    columns : list of str, optional
+        Feature columns to keep; all by default.
+    """
+    from mosaiks_query.executor import stream_query, write_stream
+    from mosaiks_query.scheduler import QueryScheduler
+
+    output = output or output_path("coords_inside_box" if bbox else "coords_inside")
+    membership = _membership(polygons_path, id_column, bbox)
+    scheduler = QueryScheduler(max_workers=max_workers, requests_per_second=requests_per_second)
+    batches = stream_query(dataset, membership.keys, table_name, columns=columns, scheduler=scheduler)
+    with metrics.stage('query') as s:
+        s.rows = write_stream((membership.join(rows, id_column=id_column) for rows in batches), output)
+    return output
+
+
+def update_villages(cache, polygons_path: str = SHAPEFILE, id_column: str = 'v_shp_id', bbox: bool = False,
+                    output: str = None, features_dir: str = None, average_output: str = None, stats=('mean',),
+                    heatmap_folder: str = None, projection_file: str = None, mode: str = 'html'):
+    """
+    Bring the outputs of `query_villages` up to date after the polygons changed.
+
+    Polygons are compared by the geometry and attribute hashes saved next
+    to ``output`` (see `incremental`). Only added and edited polygons are
+    rasterized, queried and joined; their rows (and the rows of removed
+    polygons) are patched into the output table and the per-polygon
+    averages, and the feature store is rebuilt from the patched table.
+    Without saved hashes (a first run, or outputs from before hashes were
+    kept), everything is computed as by `query_villages` and `aggregate`.
+
+    Parameters
+    ----------
+    cache : TileCache
+        Source of the rows, e.g. `open_cache()`.
+    polygons_path, id_column, bbox
+        As for `query_cells`.
+    output : str, optional
+        Joined table; defaults to ``output/coords_inside(_box).parquet``.
+    features_dir : str, optional
+        Its feature store; defaults to ``<output>_features``.
+    average_output : str, optional
+        Per-polygon averages; defaults to ``<output>_average.parquet``.
+    stats : tuple of str, optional
+        Statistics in the averages; must match the existing file.
+    heatmap_folder : str, optional
+        Also redraw the heatmaps of the changed polygons here (and delete
+        those of removed polygons); the others are left untouched.
+    projection_file : str, optional
+        Saved PCA projection for the heatmaps. Reuse the one the existing
+        heatmaps were drawn with so their scores stay comparable.
+    mode : {'html', 'binary'}, optional
+        Heatmap format, as for `render`.
+
+    Returns
+    -------
+    Changes
+        IDs of the added, modified and removed polygons.
+    """
+    from mosaiks_query.aggregate import aggregate_stream
+    from mosaiks_query.feature_store import FeatureStore
+    from mosaiks_query.grid_join import CellMembership
+    from mosaiks_query.incremental import Changes, diff_hashes, load_hashes, polygon_hashes, save_hashes
+    from mosaiks_query.polygons import read_polygons
+    from mosaiks_query.storage import patch_table
+
+    name = "coords_inside_box" if bbox else "coords_inside"
+    output = output or output_path(name)
+    stem, ext = os.path.splitext(output)
+    features_dir = features_dir or f"{stem}_features"
+    average_output = average_output or f"{stem}_average{ext}"
+
+    with metrics.stage('geometry') as s:
+        polygons = read_polygons(polygons_path)
+        hashes = polygon_hashes(polygons, id_column)
+        s.rows = len(polygons)
+    previous = load_hashes(output, id_column)
+    if previous is None or not os.path.exists(output) or not os.path.exists(average_output):
+        query_villages(cache, polygons_path, id_column, bbox=bbox, output=output, features_dir=features_dir)
+        aggregate(features_dir, average_output, id_column=id_column, stats=stats)
+        none = hashes.index[:0].to_numpy()
+        changes = Changes(added=hashes.index.to_numpy(), modified=none, removed=none)
+        redraw = None
+    else:
+        changes = diff_hashes(previous, hashes)
+        changed = np.concatenate([changes.added, changes.modified])
+        stale = np.concatenate([changed, changes.removed])
+        print(f"{len(changes.added)} added, {len(changes.modified)} modified and {len(changes.removed)} removed polygons")
+        if len(stale) == 0:
+            return changes
+
+        # Only the changed polygons are rasterized, queried and joined
+        subset = polygons[polygons[id_column].isin(changed)]
+        with metrics.stage('geometry') as s:
+            membership = CellMembership.from_geometries(subset.geometry.values, subset[id_column].to_numpy(), bbox)
+            s.rows = len(membership)
+        rows = None
+        if len(membership):
+            with metrics.stage('query') as s:
+                rows = cache.get_cells(membership.keys)
+                s.rows = len(rows)
+        if rows is not None and not rows.empty:
+            attributes = _attributes(polygons_path, id_column)
+            if attributes is not None:
+                attributes = attributes.loc[attributes.index.isin(changed)]
+            joined = _join(rows, membership, id_column, attributes).reset_index()
+            averages = aggregate_stream(joined, id_column=id_column, stats=stats)
+        else:
+            # Only removed polygons, or changed ones without any MOSAIKS rows: nothing to
+            # join, but the stale rows still have to be dropped from both tables
+            joined = pd.DataFrame(columns=read_schema(output))
+            averages = pd.DataFrame(columns=read_schema(average_output))
+
+        with metrics.stage('write') as s:
+            s.rows = patch_table(output, joined, stale, id_column, sort_columns=('lon', 'lat'))
+            FeatureStore.build(output, features_dir)
+        patch_table(average_output, averages, stale, id_column)
+        redraw = changed
+
+    if heatmap_folder:
+        from mosaiks_query.heatmaps import heatmap_paths
+
+        for path in heatmap_paths(heatmap_folder, changes.removed, mode):
+            if os.path.exists(path):
+                os.remove(path)
+        render(output, polygons_path, heatmap_folder, id_column, features_dir=features_dir,
+               projection_file=projection_file, mode=mode, only=redraw)
+
+    # Hashes go last, so an interrupted update is simply redone
+    save_hashes(hashes, output, id_column)
+    return changes
+
+
+def query_midpoints(cache, polygons_path: str = SHAPEFILE, output: str = None, merged_output: str = None):
+    """
+    Query the cell at each polygon's centroid and merge it with the polygon attributes.
+
+    This is what ``midpoint_query.py`` does; the raw rows go to ``output``
+    (default ``output/midpoint_query``) and the merged table to
+    ``merged_output`` (default ``output/midpoint_merged``).
+    """
+    midpoints = _midpoints(polygons_path)
+    rows = _query_midpoints(cache, midpoints)
+    write_table(rows, output or output_path("midpoint_query"))
+    merged = _join_midpoints(rows, midpoints)
+    write_table(merged, merged_output or output_path("midpoint_merged"))
+    return merged
+
+
+def aggregate_villages(dataset, polygons_path: str = SHAPEFILE, id_column: str = 'v_shp_id', bbox: bool = False,
+                       output: str = None, stats=('mean',), table_name: str = TABLE_NAME, max_workers: int = 4,
+                       requests_per_second: float = 2):
+    """
+    Aggregate the features inside each polygon in the query itself and write the result.
+
+    Only one row per polygon is downloaded instead of every point (see
+    `pushdown`); the output matches `aggregate` run on the output of
+    `query_villages`. ``output`` defaults to
+    ``output/coords_inside(_box)_average.parquet``.
+
+    Parameters
+    ----------
+    dataset : redivis.Dataset or LocalDataset
+        E.g. `open_dataset()`.
+    polygons_path, id_column, bbox
+        As for `query_cells`.
+    stats : tuple of str, optional
+        Statistics to compute, see `VillageAggregator`.
+    """
+    from mosaiks_query.pushdown import aggregate_in_query
+    from mosaiks_query.scheduler import QueryScheduler
+
+    output = output or output_path("coords_inside_box_average" if bbox else "coords_inside_average")
+    membership = _membership(polygons_path, id_column, bbox)
+    scheduler = QueryScheduler(max_workers=max_workers, requests_per_second=requests_per_second)
+    with metrics.stage('query') as s:
+        result = aggregate_in_query(dataset, membership, table_name, id_column=id_column, stats=stats,
+                                    scheduler=scheduler)
+        s.rows = len(result)
+    write_table(result, output)
+    return result
+
+
+def aggregate(source, output: str, id_column: str = 'v_shp_id', stats=('mean',), batch_rows: int = 65_536):
+    """
+    Aggregate features per polygon and write the result.
+
+    ``source`` is a table path (read in batches), a feature store directory
+    or a `FeatureStore`.
+    """
+    from mosaiks_query.aggregate import aggregate_stream
+    from mosaiks_query.feature_store import FeatureStore
+
+    if isinstance(source, str) and os.path.isdir(source):
+        source = FeatureStore(source)
+    result = aggregate_stream(source, id_column=id_column, stats=stats, batch_rows=batch_rows)
+    write_table(result, output)
+    return result
+
+
+def run_tables(tables, polygons_path: str = SHAPEFILE, id_column: str = 'v_shp_id', bbox: bool = False,
+               midpoint: bool = False, pushdown: bool = False, output_dir: str = "output", stats=('mean',),
+               dataset=None, cache_dir: str = "cache", max_workers: int = 4, requests_per_second: float = 2,
+               table_workers: int = 2):
+    """
+    Run the pipeline for several MOSAIKS tables (e.g. years), doing the geometry work once.
+
+    The polygons are rasterized (or their centroids snapped) and their
+    attributes read a single time, then every table is queried, joined and
+    aggregated on its own thread. All tables share one scheduler, so the
+    Redivis rate limit holds for the whole run, and while one table is
+    being joined or written the next one is already downloading.
+
+    Every table's outputs go to ``<output_dir>/<table>/`` with the same
+    names as the single-table scripts: ``coords_inside(_box).parquet``, its
+    ``_features`` store and ``_average.parquet`` (only the average with
+    ``pushdown``), or ``midpoint_query.parquet`` and
+    ``midpoint_merged.parquet`` with ``midpoint``.
+
+    Parameters
+    ----------
+    tables : list of str
+        MOSAIKS tables, e.g. ``['mosaiks_2019_planet', 'mosaiks_2020_planet']``.
+    polygons_path, id_column, bbox, midpoint
+        As for `query_cells`.
+    pushdown : bool, optional
+        Aggregate inside the queries instead of downloading the points
+        (see `aggregate_villages`).
+    output_dir : str, optional
+        Root of the per-table output directories.
+    stats : tuple of str, optional
+        Statistics for the per-polygon averages.
+    dataset : redivis.Dataset or LocalDataset, optional
+        Defaults to `open_dataset()`.
+    cache_dir : str, optional
+        Tile cache root; every table gets its own sub-directory.
+    max_workers, requests_per_second : optional
+        Limits of the shared query scheduler.
+    table_workers : int, optional
+        Tables processed at the same time.
+
+    Returns
+    -------
+    dict
+        Main output path of each table.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from mosaiks_query.cache import TileCache
+    from mosaiks_query.scheduler import QueryScheduler
+
+    if midpoint and pushdown:
+        raise ValueError("pushdown needs the cells inside each polygon, not midpoints")
+    dataset = dataset if dataset is not None else open_dataset()
+    scheduler = QueryScheduler(max_workers=max_workers, requests_per_second=requests_per_second)
+
+    # Geometry work, shared by every table
+    if midpoint:
+        midpoints = _midpoints(polygons_path)
+    else:
+        membership = _membership(polygons_path, id_column, bbox)
+        attributes = None if pushdown else _attributes(polygons_path, id_column)
+    name = "coords_inside_box" if bbox else "coords_inside"
+
+    def run(table):
+        directory = os.path.join(output_dir, table)
+        os.makedirs(directory, exist_ok=True)
+        if pushdown:
+            from mosaiks_query.pushdown import aggregate_in_query
+
+            output = output_path(f"{name}_average", directory)
+            with metrics.stage('query') as s:
+                result = aggregate_in_query(dataset, membership, table, id_column=id_column, stats=stats,
+                                            scheduler=scheduler)
+                s.rows = len(result)
+            write_table(result, output)
+            return output
+
+        cache = TileCache(dataset, table, cache_dir=cache_dir, scheduler=scheduler)
+        if midpoint:
+            rows = _query_midpoints(cache, midpoints)
+            write_table(rows, output_path("midpoint_query", directory))
+            output = output_path("midpoint_merged", directory)
+            write_table(_join_midpoints(rows, midpoints), output)
+            return output
+
+        with metrics.stage('query') as s:
+            rows = cache.get_cells(membership.keys)
+            s.rows = len(rows)
+        output = output_path(name, directory)
+        features_dir = os.path.join(directory, f"{name}_features")
+        write_joined(_join(rows, membership, id_column, attributes), output, features_dir)
+        aggregate(features_dir, output_path(f"{name}_average", directory), id_column=id_column, stats=stats)
+        return output
+
+    with ThreadPoolExecutor(max_workers=max(1, table_workers)) as pool:
+        return dict(zip(tables, pool.map(run, tables)))
+
+
+def render(table: str, polygons_path: str, output_folder: str, id_column: str = 'v_shp_id',
+           features_dir: str = None, projection_file: str = None, mode: str = 'html', inside_only: bool = False,
+           outline: str = 'geojson', processes: int = None, force: bool = False, only=None):
+    """
+    Score every point with PCA_1 and draw one heatmap per polygon.
+
+    Parameters
+    ----------
+    table : str
+        Joined table written by `query_villages` (lon, lat, ``id_column`` and features).
+    polygons_path : str
+        Village shapefile or shrid CSV.
+    output_folder : str
+        Directory for the heatmaps.
+    id_column : str, optional
+        Polygon ID column.
+    features_dir : str, optional
+        Feature store of ``table``; the features are then read from the
+        memory-mapped matrix instead of the table.
+    projection_file : str, optional
+        ``.npz`` PCA projection, reused if it exists and saved there otherwise.
+    mode : {'html', 'binary'}, optional
+        Standalone folium pages (`render_heatmaps`) or the shared viewer
+        with per-village binary data (`export_heatmaps`).
+    inside_only, outline, processes, force
+        As for `render_heatmaps`.
+    only : array-like, optional
+        IDs of the polygons to redraw, e.g. the changed ones from
+        `update_villages`; only their points are scored and their heatmaps
+        are always rewritten. The other heatmaps are left untouched.
+    """
+    from mosaiks_query.feature_store import FeatureStore
+    from mosaiks_query.heatmaps import export_heatmaps, render_heatmaps
+    from mosaiks_query.polygons import read_polygons
+    from mosaiks_query.projection import FeatureProjection
+
+    data = read_table(table, columns=[id_column, 'lon', 'lat'])
+    source = FeatureStore(features_dir) if features_dir else table
+    if projection_file:
+        projection = FeatureProjection.load_or_fit(projection_file, source)
+    else:
+        projection = FeatureProjection.fit(source)
+    if only is None:
+        scores = projection.transform_source(source)[:, 0]
+    else:
+        positions = np.flatnonzero(data[id_column].isin(np.asarray(only)).to_numpy())
+        data = data.iloc[positions]
+        if features_dir:
+            features = source.take(positions)
+        else:
+            features = read_table(table, columns=projection.feature_names).to_numpy()[positions]
+        scores = projection.transform(features)[:, 0]
+        force = True
+
+    polygon_data = read_polygons(polygons_path)
+    polygons = polygon_data.set_index(polygon_data[id_column].to_numpy())[polygon_data.geometry.name]
+    if mode == 'binary':
+        return export_heatmaps(data[id_column], data['lat'], data['lon'], scores, polygons, output_folder,
+                               inside_only=inside_only, source=table, force=force)
+    return render_heatmaps(data[id_column], data['lat'], data['lon'], scores, polygons, output_folder,
+                           inside_only=inside_only, outline=outline, processes=processes, source=table,
+                           force=force)
@@ -0,0 +1,151 @@
+"""Compact SQL for fetching sets of individual MOSAIKS cells.
+
+The original point queries sent one ``(lon = x AND lat = y)`` term per cell,
+1000-5000 of them OR-ed together per query. `plan_cells` instead sorts the
+requested cells into lattice rows and emits:
+
+* range scans for runs of nearby cells, merged across consecutive rows into
+  lat bands (``lat > a AND lat < b AND lon > c AND lon < d``); the few gap
+  cells a range also covers are cached like any other cell, and
+* one ``lat = y AND lon IN (...)`` list per row for the remaining cells.
+
+Range bounds fall between lattice points, so they never depend on float
+equality. `AdaptiveBatchSize` then packs clauses into queries, growing or
+shrinking the batch from the latency of completed queries.
+"""
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from mosaiks_query.lattice import CELL_SIZE, index_keys, key_coords, key_index
+
+# Cells at most this many columns apart are fetched with one range
+MAX_GAP = 2
+
+# Shorter runs go into the row's IN list instead, which costs fewer literals
+MIN_RUN = 3
+
+# A WHERE clause, its size in literals, and the cell keys it fully resolves
+Clause = namedtuple('Clause', ['sql', 'size', 'keys'])
+
+
+def _edge(index):
+    """Grid line below a lattice column/row, halfway between two centres."""
+    return round(int(index) * CELL_SIZE, 6)
+
+
+def plan_cells(keys, max_gap: int = MAX_GAP, min_run: int = MIN_RUN):
+    """
+    Turn a set of cell keys into range and IN-list clauses.
+
+    Parameters
+    ----------
+    keys : array-like
+        `lattice.cell_keys` of the requested cells; duplicates are dropped.
+    max_gap : int, optional
+        Largest number of unrequested cells a range may bridge.
+    min_run : int, optional
+        Minimum number of requested cells for a range to replace IN entries.
+
+    Returns
+    -------
+    list of Clause
+        Ordered by lat, then lon, so batches stay spatially compact.
+    """
+    keys = np.unique(np.asarray(keys, dtype=np.int64))
+    if len(keys) == 0:
+        return []
+    cols, rows = key_index(keys)
+    order = np.lexsort((cols, rows))
+    keys, cols, rows = keys[order], cols[order], rows[order]
+
+    # Split each row into runs of cells at most max_gap apart
+    new_run = np.r_[True, (rows[1:] != rows[:-1]) | (np.diff(cols) > max_gap + 1)]
+    starts = np.flatnonzero(new_run)
+    stops = np.r_[starts[1:], len(keys)]
+    is_range = stops - starts >= min_run
+
+    # Merge identical column ranges on consecutive rows into lat bands
+    bands = {}
+    for start, stop in zip(starts[is_range].tolist(), stops[is_range].tolist()):
+        span = (int(cols[start]), int(cols[stop - 1]))
+        row = int(rows[start])
+        band = bands.get(span)
+        if band is not None and band[-1][1] == row:
+            band[-1][1] = row + 1
+        else:
+            bands.setdefault(span, []).append([row, row + 1])
+
+    clauses = []
+    for (col_lo, col_hi), spans in bands.items():
+        for row_lo, row_hi in spans:
+            band_cols, band_rows = np.meshgrid(np.arange(col_lo, col_hi + 1), np.arange(row_lo, row_hi))
+            sql = (f"(lat > {_edge(row_lo)} AND lat < {_edge(row_hi)}"
+                   f" AND lon > {_edge(col_lo)} AND lon < {_edge(col_hi + 1)})")
+            clauses.append((row_lo, col_lo, Clause(sql, 4, index_keys(band_cols.ravel(), band_rows.ravel()))))
+
+    # Everything outside a range goes into one IN list per row
+    single = np.repeat(~is_range, stops - starts)
+    single_keys, single_cols, single_rows = keys[single], cols[single], rows[single]
+    lons, lats = key_coords(single_keys)
+    for row in np.unique(single_rows).tolist():
+        in_row = single_rows == row
+        values = ", ".join(str(lon) for lon in lons[in_row].tolist())
+        sql = f"(lat = {float(lats[in_row][0])} AND lon IN ({values}))"
+        clauses.append((row, int(single_cols[in_row][0]), Clause(sql, int(in_row.sum()) + 1, single_keys[in_row])))
+
+    clauses.sort(key=lambda item: item[:2])
+    return [clause for _, _, clause in clauses]
+
+
+class AdaptiveBatchSize:
+    """
+    Number of SQL literals per query, steered towards a target latency.
+
+    After each query, `observe` halves the size if the query took longer
+    than ``target_seconds`` and grows it by half if a full batch finished in
+    under half the target. Shared safely between worker threads.
+
+    Parameters
+    ----------
+    initial : int, optional
+        Starting size, matching the old 1000 pairs per query.
+    minimum, maximum : int, optional
+        Bounds on the size.
+    target_seconds : float, optional
+        Desired duration of one query.
+    """
+
+    def __init__(self, initial: int = 1000, minimum: int = 100, maximum: int = 20_000,
+                 target_seconds: float = 10.0):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.lock = threading.Lock()
+
+    def observe(self, size: int, seconds: float):
+        """Record that a query of ``size`` literals took ``seconds``."""
+        with self.lock:
+            if seconds > self.target_seconds:
+                self.size = max(self.minimum, self.size // 2)
+            elif seconds < self.target_seconds / 2 and size >= 0.9 * self.size:
+                self.size = min(self.maximum, int(self.size * 1.5))
+
+    def batches(self, clauses):
+        """
+        Yield lists of clauses totalling at most the current size.
+
+        The size is read again for every batch, so batches generated after a
+        query completes already reflect its latency.
+        """
+        batch, total = [], 0
+        for clause in clauses:
+            if batch and total + clause.size > self.size:
+                yield batch
+                batch, total = [], 0
+            batch.append(clause)
+            total += clause.size
+        if batch:
+            yield batch
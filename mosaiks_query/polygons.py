@@ -0,0 +1,98 @@
+"""Bulk parsing of the shrid ``polygon_coordinates`` column.
+
+The shrid CSVs store each polygon as the text of a Python list of (lon, lat)
+tuples. Instead of ``Polygon(eval(...))`` row by row, `parse_polygons` pulls
+every number out of the column into one flat array and builds all polygons
+with a single vectorized ``shapely.polygons`` call. Nothing is evaluated, so
+malformed or malicious cells raise a ValueError instead of running code.
+"""
+import hashlib
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+# Brackets, parentheses and commas become whitespace; only numbers remain
+_SEPARATORS = str.maketrans("[](),", "     ")
+
+
+def parse_polygons(strings):
+    """
+    Parse coordinate list strings like ``"[(77.1, 28.2), (77.3, 28.2), ...]"``.
+
+    Parameters
+    ----------
+    strings : iterable of str
+        One polygon shell per string; rings are closed automatically.
+
+    Returns
+    -------
+    np.ndarray of shapely.Polygon
+    """
+    tokens = [str(s).translate(_SEPARATORS).split() for s in strings]
+    counts = np.fromiter((len(t) for t in tokens), dtype=np.int64, count=len(tokens))
+    invalid = (counts % 2 == 1) | (counts < 6)
+    if invalid.any():
+        bad = int(np.flatnonzero(invalid)[0])
+        raise ValueError(f"Row {bad} is not a list of at least 3 (lon, lat) pairs")
+
+    coords = np.array([value for t in tokens for value in t], dtype=np.float64).reshape(-1, 2)
+    ring_index = np.repeat(np.arange(len(tokens)), counts // 2)
+    rings = shapely.linearrings(coords, indices=ring_index)
+    return shapely.polygons(rings)
+
+
+def polygon_frame(df, polygon_col: str = 'polygon_coordinates'):
+    """
+    Return a GeoDataFrame of ``df`` with parsed geometry, bounds and centroids.
+
+    Adds ``min_lon, min_lat, max_lon, max_lat`` and ``centroid_lon,
+    centroid_lat`` columns, each computed in one vectorized call.
+    """
+    geometry = parse_polygons(df[polygon_col])
+    bounds = shapely.bounds(geometry)
+    centroids = shapely.centroid(geometry)
+
+    gdf = gpd.GeoDataFrame(df.copy(), geometry=geometry, crs="EPSG:4326")
+    gdf['min_lon'], gdf['min_lat'], gdf['max_lon'], gdf['max_lat'] = bounds.T
+    gdf['centroid_lon'] = shapely.get_x(centroids)
+    gdf['centroid_lat'] = shapely.get_y(centroids)
+    return gdf
+
+
+def file_digest(*paths):
+    """Return a short sha1 of the contents of one or more files, used as a cache key."""
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def load_polygons(path: str, polygon_col: str = 'polygon_coordinates', cache_dir: str = "cache/polygons"):
+    """
+    Load a shrid CSV as a GeoDataFrame, caching the parsed result as GeoParquet.
+
+    The cache file is keyed by a hash of the CSV contents, so edits to the
+    CSV invalidate it automatically and unchanged inputs skip parsing.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, f"{name}.{file_digest(path)}.parquet")
+    if os.path.exists(cache_path):
+        return gpd.read_parquet(cache_path)
+
+    gdf = polygon_frame(pd.read_csv(path), polygon_col)
+    gdf.to_parquet(f"{cache_path}.tmp")
+    os.replace(f"{cache_path}.tmp", cache_path)
+    return gdf
+
+
+def read_polygons(path: str):
+    """Read a shrid CSV (through `load_polygons`) or any file geopandas reads, e.g. a shapefile."""
+    if path.lower().endswith('.csv'):
+        return load_polygons(path)
+    return gpd.read_file(path)
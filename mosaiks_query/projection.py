@@ -0,0 +1,163 @@
+"""Streaming PCA scores (PCA_1) for MOSAIKS features.
+
+Instead of fitting ``sklearn.decomposition.PCA`` on the whole float64
+feature frame on every run, `FeatureProjection.fit` reads float32 batches
+from a feature store, table or array and fits either an ``IncrementalPCA``
+or, with ``method='randomized'``, accumulates the 4000 x 4000 covariance in
+one pass and takes its leading components with a randomized SVD. The fitted
+mean and components are saved to a small ``.npz`` file, so later runs and
+newly queried tiles are scored with a single matrix-vector product.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from mosaiks_query import metrics
+from mosaiks_query.feature_store import FeatureStore
+from mosaiks_query.storage import feature_columns, iter_table, read_schema
+
+# Rows per batch; 8192 x 4000 float32 features is 128 MB
+BATCH_ROWS = 8192
+
+
+def _batches(source, batch_rows):
+    """Yield (feature names, float32 batch) pairs from any supported source."""
+    if isinstance(source, FeatureStore):
+        for start in range(0, len(source), batch_rows):
+            yield source.feature_names, np.asarray(source.rows(start, start + batch_rows), dtype=np.float32)
+    elif isinstance(source, str):
+        names = feature_columns(read_schema(source))
+        for batch in iter_table(source, columns=names, batch_rows=batch_rows):
+            yield names, batch.to_numpy(dtype=np.float32)
+    elif isinstance(source, pd.DataFrame):
+        names = list(source.columns)
+        for start in range(0, len(source), batch_rows):
+            yield names, source.iloc[start:start + batch_rows].to_numpy(dtype=np.float32)
+    else:
+        source = np.asarray(source)
+        names = [f'X_{i}' for i in range(source.shape[1])]
+        for start in range(0, len(source), batch_rows):
+            yield names, np.asarray(source[start:start + batch_rows], dtype=np.float32)
+
+
+class FeatureProjection:
+    """
+    Fitted principal components of the MOSAIKS features.
+
+    Attributes
+    ----------
+    mean : np.ndarray
+        Per-feature mean of the fitted data.
+    components : np.ndarray
+        (n_components, features) unit vectors. Each is signed so that its
+        largest loading is positive, which keeps scores comparable across
+        refits and methods.
+    explained_variance : np.ndarray
+        Variance of the data along each component.
+    feature_names : list of str
+        Feature columns the components refer to.
+    """
+
+    def __init__(self, mean, components, explained_variance, feature_names):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.components = np.asarray(components, dtype=np.float64)
+        self.explained_variance = np.asarray(explained_variance, dtype=np.float64)
+        self.feature_names = list(feature_names)
+
+    @classmethod
+    @metrics.timed('pca')
+    def fit(cls, source, n_components: int = 1, method: str = 'incremental', batch_rows: int = BATCH_ROWS):
+        """
+        Fit the projection without loading the features as one float64 frame.
+
+        Parameters
+        ----------
+        source : FeatureStore, str, pd.DataFrame or np.ndarray
+            Feature store, feature table path (only X_* columns are read),
+            or an in-memory feature matrix.
+        n_components : int, optional
+            Number of components; PCA_1 needs one.
+        method : {'incremental', 'randomized'}, optional
+            ``IncrementalPCA.partial_fit`` on each batch, or one pass
+            accumulating the covariance followed by a randomized SVD.
+        batch_rows : int, optional
+            Rows per float32 batch.
+        """
+        if method not in ('incremental', 'randomized'):
+            raise ValueError(f"Unknown method: {method}")
+        # sklearn is only needed for fitting; scoring with a saved projection does not import it
+        from sklearn.decomposition import IncrementalPCA
+        from sklearn.utils.extmath import randomized_svd
+
+        names = None
+        if method == 'incremental':
+            ipca = IncrementalPCA(n_components=n_components)
+            for names, batch in _batches(source, batch_rows):
+                # partial_fit needs at least n_components rows; a short tail adds nothing useful
+                if len(batch) >= n_components:
+                    ipca.partial_fit(batch)
+            return cls._signed(ipca.mean_, ipca.components_, ipca.explained_variance_, names)
+
+        # Sums are taken around the first batch's mean to keep the covariance accurate
+        count, shift, total, cross = 0, None, None, None
+        for names, batch in _batches(source, batch_rows):
+            if shift is None:
+                shift = batch.mean(axis=0, dtype=np.float64)
+                total = np.zeros_like(shift)
+                cross = np.zeros((len(shift), len(shift)))
+            centred = batch.astype(np.float64) - shift
+            count += len(batch)
+            total += centred.sum(axis=0)
+            cross += centred.T @ centred
+        offset = total / count
+        covariance = (cross - count * np.outer(offset, offset)) / (count - 1)
+        _, variance, components = randomized_svd(covariance, n_components, random_state=0)
+        return cls._signed(shift + offset, components, variance, names)
+
+    @classmethod
+    def _signed(cls, mean, components, explained_variance, names):
+        components = np.array(components, dtype=np.float64)
+        largest = np.abs(components).argmax(axis=1)
+        components *= np.sign(components[np.arange(len(components)), largest])[:, None]
+        return cls(mean, components, explained_variance, names)
+
+    def transform(self, features):
+        """
+        Score a (rows, features) block, e.g. a feature store slice or new tile.
+
+        Computed as ``features @ components.T - mean @ components.T`` so the
+        centred matrix is never materialized.
+        """
+        features = np.asarray(features, dtype=np.float32)
+        weights = self.components.T.astype(np.float32)
+        return features @ weights - (self.mean @ self.components.T).astype(np.float32)
+
+    def transform_source(self, source, batch_rows: int = BATCH_ROWS):
+        """Score every row of a feature store, table path or matrix in batches."""
+        parts = [self.transform(batch) for _, batch in _batches(source, batch_rows)]
+        return np.concatenate(parts) if parts else np.zeros((0, len(self.components)), dtype=np.float32)
+
+    def save(self, path: str):
+        """Save the projection as ``.npz``."""
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, mean=self.mean, components=self.components,
+                 explained_variance=self.explained_variance, feature_names=np.array(self.feature_names))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as f:
+            return cls(f['mean'], f['components'], f['explained_variance'], f['feature_names'].tolist())
+
+    @classmethod
+    def load_or_fit(cls, path: str, source, refit: bool = False, **fit_kwargs):
+        """
+        Load the projection saved at ``path``, fitting and saving it first if
+        it does not exist (or ``refit`` is set). ``fit_kwargs`` go to `fit`.
+        """
+        if os.path.exists(path) and not refit:
+            return cls.load(path)
+        projection = cls.fit(source, **fit_kwargs)
+        projection.save(path)
+        return projection
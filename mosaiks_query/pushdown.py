@@ -0,0 +1,302 @@
+"""Per-village feature statistics computed by the database instead of locally.
+
+The point scripts download every 4000-feature row inside the villages and
+only then average them (see `aggregate`). `aggregate_in_query` sends the
+village to cell mapping along with the query instead, so Redivis joins,
+groups and sums the rows itself and returns one row per village: the
+transfer shrinks by the average number of points per village.
+
+The mapping is inlined compactly as runs of consecutive lattice cells, one
+``(village, row, first column, last column)`` tuple per village and lattice
+row, taken from the same `CellMembership` the local join uses, so both paths
+see exactly the same points. The query returns per-village counts and sums
+(plus sums of squares, minima and maxima when requested), which
+`VillageAggregator.add_totals` turns into the usual output. Missing feature
+values count as 0, as in the local aggregation.
+
+`LocalDataset` answers the same SQL from a SQLite (or DuckDB) table, so the
+pushdown can be run and checked offline.
+"""
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from mosaiks_query import metrics
+from mosaiks_query.aggregate import VillageAggregator
+from mosaiks_query.cache import TABLE_NAME
+from mosaiks_query.lattice import CELL_SIZE, key_index
+from mosaiks_query.planner import AdaptiveBatchSize
+from mosaiks_query.scheduler import QueryScheduler
+from mosaiks_query.storage import feature_columns, read_table
+
+# Result columns per query; BigQuery (behind Redivis) allows 10,000
+MAX_COLUMNS = 8000
+
+# Villages are batched by block of this many lattice cells (the cache tile size)
+# so each query's bounding box stays compact
+BLOCK_CELLS = 30
+
+# Literals per village run in the inlined mapping
+RUN_SIZE = 4
+
+# A village's runs in the spatially ordered run table
+_Village = namedtuple('_Village', ['size', 'start', 'stop'])
+
+_INTEGER = {'bigquery': 'INT64', 'sqlite': 'INTEGER', 'duckdb': 'INTEGER'}
+
+
+def membership_runs(membership):
+    """
+    Compress a `CellMembership` into runs of consecutive cells per village and lattice row.
+
+    Returns a DataFrame with columns ``owner`` (position of the village in
+    ``membership.ids``), ``row``, ``col_lo`` and ``col_hi`` (inclusive),
+    ordered by owner, row and column.
+    """
+    cols, rows = key_index(membership.keys)
+    owners = membership.owners
+    order = np.lexsort((cols, rows, owners))
+    owners, cols, rows = owners[order], cols[order], rows[order]
+    new_run = np.r_[True, (owners[1:] != owners[:-1]) | (rows[1:] != rows[:-1]) | (np.diff(cols) != 1)]
+    starts = np.flatnonzero(new_run)
+    stops = np.r_[starts[1:], len(cols)]
+    return pd.DataFrame({'owner': owners[starts], 'row': rows[starts],
+                         'col_lo': cols[starts], 'col_hi': cols[stops - 1]})
+
+
+def _spatial_order(runs):
+    """Reorder the runs so villages in the same block are adjacent; return (runs, villages)."""
+    first = runs.groupby('owner', sort=True).agg(row=('row', 'min'), col=('col_lo', 'min'))
+    block_order = np.lexsort((first.index.to_numpy(), first['col'].to_numpy() // BLOCK_CELLS,
+                              first['row'].to_numpy() // BLOCK_CELLS))
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[block_order] = np.arange(len(first))
+    position = pd.Series(rank, index=first.index)
+
+    runs = runs.assign(rank=position.loc[runs['owner']].to_numpy())
+    runs = runs.sort_values(by=['rank', 'row', 'col_lo'], kind='stable', ignore_index=True)
+    bounds = np.flatnonzero(np.r_[True, np.diff(runs['rank'].to_numpy()) != 0, True])
+    villages = [_Village(RUN_SIZE * (stop - start), start, stop)
+                for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+    return runs.drop(columns='rank'), villages
+
+
+def _edge(index):
+    return round(int(index) * CELL_SIZE, 6)
+
+
+def _aggregates(names, stats):
+    """SELECT terms returning the totals `VillageAggregator.add_totals` needs."""
+    terms = []
+    for name in names:
+        terms.append(f"SUM(t.{name}) AS {name}_sum")
+        if 'std' in stats:
+            terms.append(f"SUM(t.{name} * t.{name}) AS {name}_sumsq")
+        if 'min' in stats:
+            terms.append(f"MIN(COALESCE(t.{name}, 0)) AS {name}_min")
+        if 'max' in stats:
+            terms.append(f"MAX(COALESCE(t.{name}, 0)) AS {name}_max")
+    return terms
+
+
+def aggregate_sql(runs, names, table_name: str = TABLE_NAME, stats=('mean',), dialect: str = 'bigquery'):
+    """
+    Build one GROUP BY query over the villages in ``runs``.
+
+    Parameters
+    ----------
+    runs : pd.DataFrame
+        Rows of `membership_runs`; ``owner`` is returned as ``village``.
+    names : list of str
+        Feature columns to aggregate.
+    table_name : str, optional
+        MOSAIKS table to query.
+    stats : tuple of str, optional
+        Statistics the totals are for, see `VillageAggregator`.
+    dialect : {'bigquery', 'sqlite', 'duckdb'}, optional
+        SQL dialect; Redivis runs BigQuery SQL.
+    """
+    integer = _INTEGER[dialect]
+    values = ", ".join(f"({owner}, {row}, {lo}, {hi})" for owner, row, lo, hi in zip(
+        runs['owner'].tolist(), runs['row'].tolist(), runs['col_lo'].tolist(), runs['col_hi'].tolist()))
+    if dialect == 'bigquery':
+        cells = (f"cells AS (SELECT * FROM UNNEST(ARRAY<STRUCT<village {integer}, cell_row {integer},"
+                 f" col_lo {integer}, col_hi {integer}>>[{values}]))")
+    else:
+        cells = f"cells(village, cell_row, col_lo, col_hi) AS (VALUES {values})"
+
+    # Lattice centres sit half a cell above the grid lines, so rounding recovers the row/column index
+    scale = round(1 / CELL_SIZE)
+    terms = ",\n               ".join(['COUNT(*) AS n_points'] + _aggregates(names, stats))
+    return f"""
+        WITH {cells}
+        SELECT cells.village,
+               {terms}
+        FROM {table_name} AS t
+        JOIN cells
+          ON CAST(ROUND(t.lat * {scale} - 0.5) AS {integer}) = cells.cell_row
+          AND CAST(ROUND(t.lon * {scale} - 0.5) AS {integer}) BETWEEN cells.col_lo AND cells.col_hi
+        WHERE t.lat > {_edge(runs['row'].min())} AND t.lat < {_edge(runs['row'].max() + 1)}
+          AND t.lon > {_edge(runs['col_lo'].min())} AND t.lon < {_edge(runs['col_hi'].max() + 1)}
+        GROUP BY cells.village
+    """
+
+
+def _feature_names(dataset, table_name):
+    rows = dataset.query(f"SELECT * FROM {table_name} LIMIT 1").to_pandas_dataframe()
+    return feature_columns(rows.columns)
+
+
+def _column_groups(names, stats, max_columns):
+    """Split the features so no query returns more than ``max_columns`` columns."""
+    per_feature = 1 + sum(stat in stats for stat in ('std', 'min', 'max'))
+    size = max(1, (max_columns - 2) // per_feature)
+    return [names[i:i + size] for i in range(0, len(names), size)]
+
+
+def aggregate_in_query(dataset, membership, table_name: str = TABLE_NAME, id_column: str = 'v_shp_id',
+                       stats=('mean',), feature_names=None, scheduler: QueryScheduler = None,
+                       batch_size: AdaptiveBatchSize = None):
+    """
+    Aggregate features per village inside the query; only one row per village is downloaded.
+
+    Villages are batched spatially, each batch's village to cell mapping is
+    inlined into one ``GROUP BY`` query, and the totals are combined
+    locally. The result matches ``aggregate_stream(membership.join(rows))``
+    on the same rows.
+
+    Parameters
+    ----------
+    dataset : redivis.Dataset or LocalDataset
+        Any object with ``dataset.query(sql).to_pandas_dataframe()``. Its
+        ``dialect`` and ``max_columns`` attributes are used if present
+        (default BigQuery SQL and `MAX_COLUMNS`).
+    membership : CellMembership
+        Cells inside each village, e.g. from `load_membership`.
+    table_name : str, optional
+        MOSAIKS table to query.
+    id_column : str, optional
+        Name of the ID column in the result.
+    stats : tuple of str, optional
+        Any of 'mean', 'std', 'min', 'max', 'count', see `VillageAggregator`.
+    feature_names : list of str, optional
+        Features to aggregate. By default all X_* columns of the table,
+        looked up with a one-row query.
+    scheduler : QueryScheduler, optional
+        Runs the batches concurrently with rate limiting and retries.
+    batch_size : AdaptiveBatchSize, optional
+        Sizes the inlined mapping of each query (4 literals per run) from
+        observed latency.
+    """
+    aggregator = VillageAggregator(id_column, stats)
+    scheduler = scheduler if scheduler is not None else QueryScheduler()
+    batch_size = batch_size if batch_size is not None else AdaptiveBatchSize()
+    dialect = getattr(dataset, 'dialect', 'bigquery')
+    if feature_names is None:
+        feature_names = scheduler.call(_feature_names, dataset, table_name)
+    feature_names = list(feature_names)
+    groups = _column_groups(feature_names, stats, getattr(dataset, 'max_columns', MAX_COLUMNS))
+
+    if len(membership) == 0:
+        return aggregator.result()
+    runs, villages = _spatial_order(membership_runs(membership))
+
+    def query(sql, size):
+        start = time.monotonic()
+        totals = dataset.query(sql).to_pandas_dataframe()
+        seconds = time.monotonic() - start
+        batch_size.observe(size, seconds)
+        metrics.query('aggregate', seconds, len(totals), int(totals.memory_usage(index=False).sum()), size)
+        return totals.sort_values(by='village', ignore_index=True)
+
+    def run(batch):
+        batch_runs = runs.iloc[batch[0].start:batch[-1].stop]
+        return [scheduler.call(query, aggregate_sql(batch_runs, names, table_name, stats, dialect),
+                               RUN_SIZE * len(batch_runs))
+                for names in groups]
+
+    for parts in scheduler.map(run, batch_size.batches(villages)):
+        if parts[0].empty:
+            continue
+        totals = pd.concat([parts[0]] + [part.drop(columns=['village', 'n_points']) for part in parts[1:]], axis=1)
+
+        def stat(suffix):
+            return totals[[f'{name}_{suffix}' for name in feature_names]].to_numpy(dtype=np.float64)
+
+        aggregator.add_totals(membership.ids[totals['village'].to_numpy(dtype=np.int64)],
+                              totals['n_points'].to_numpy(), stat('sum'),
+                              sumsq=stat('sumsq') if 'std' in stats else None,
+                              mins=stat('min') if 'min' in stats else None,
+                              maxs=stat('max') if 'max' in stats else None,
+                              feature_names=feature_names)
+    return aggregator.result()
+
+
+class _Result:
+    def __init__(self, df):
+        self.df = df
+
+    def to_pandas_dataframe(self):
+        return self.df
+
+
+class LocalDataset:
+    """
+    Offline stand-in for the Redivis dataset, backed by SQLite or DuckDB.
+
+    Answers ``dataset.query(sql).to_pandas_dataframe()`` like Redivis, so
+    `aggregate_in_query` (and `TileCache`) can run against local tables.
+    SQLite tables hold at most 2000 columns by default; use
+    ``engine='duckdb'`` (if installed) for the full 4000 features.
+
+    Parameters
+    ----------
+    path : str, optional
+        Database file, or ':memory:'.
+    engine : {'sqlite', 'duckdb'}, optional
+        Database engine.
+
+    Examples
+    --------
+    >>> dataset = LocalDataset()
+    >>> dataset.add_table('mosaiks_2019_planet', 'output/coords_inside_box.parquet')
+    >>> aggregate_in_query(dataset, load_membership(SHAPEFILE, 'v_shp_id'))
+    """
+
+    def __init__(self, path: str = ':memory:', engine: str = 'sqlite'):
+        if engine == 'duckdb':
+            import duckdb
+
+            self.connection = duckdb.connect(path)
+            self.max_columns = MAX_COLUMNS
+        elif engine == 'sqlite':
+            import sqlite3
+
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.max_columns = 1900
+        else:
+            raise ValueError(f"Unknown engine: {engine}")
+        self.dialect = engine
+        self.lock = threading.Lock()
+
+    def add_table(self, name: str, rows):
+        """Create (or replace) table ``name`` from a DataFrame or table path."""
+        if isinstance(rows, str):
+            rows = read_table(rows)
+        rows = rows.reset_index(drop=True)
+        with self.lock:
+            if self.dialect == 'duckdb':
+                self.connection.register('_rows', rows)
+                self.connection.execute(f"CREATE OR REPLACE TABLE {name} AS SELECT * FROM _rows")
+                self.connection.unregister('_rows')
+            else:
+                rows.to_sql(name, self.connection, index=False, if_exists='replace')
+
+    def query(self, sql: str):
+        with self.lock:
+            if self.dialect == 'duckdb':
+                return _Result(self.connection.execute(sql).df())
+            return _Result(pd.read_sql_query(sql, self.connection))
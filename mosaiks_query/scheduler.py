@@ -0,0 +1,121 @@
+"""Concurrent dispatch of Redivis queries with rate limiting and retries.
+
+Queries are I/O-bound, so a small thread pool cuts wall time roughly by the
+number of workers. A token bucket caps the request rate across all workers
+and transient failures are retried with exponential backoff.
+"""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+
+from mosaiks_query import metrics
+
+# Failures worth retrying: dropped connections, timeouts and network errors
+# (URLError also covers the HTTP errors of basemap downloads). Anything else,
+# such as a malformed query, is raised on the first attempt.
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, URLError)
+try:
+    # redivis talks to its API through requests, whose errors are not builtin ConnectionErrors
+    import requests
+    TRANSIENT_ERRORS += (requests.ConnectionError, requests.Timeout)
+except ImportError:
+    pass
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing ``rate`` requests per second on average.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+    capacity : float, optional
+        Maximum burst size. Defaults to one second worth of tokens.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QueryScheduler:
+    """
+    Run queries on a worker pool with a shared rate limit and retries.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of queries in flight at once. 1 runs everything in the caller.
+    requests_per_second : float, optional
+        Average request rate across all workers. None disables rate limiting.
+    max_retries : int, optional
+        Number of retries after the first failed attempt.
+    backoff : float, optional
+        Base delay in seconds; attempt ``n`` waits about ``backoff * 2 ** n``.
+    retry_on : tuple of Exception types, optional
+        Exceptions treated as transient. Defaults to `TRANSIENT_ERRORS`.
+    """
+
+    def __init__(self, max_workers: int = 1, requests_per_second: float = None,
+                 max_retries: int = 3, backoff: float = 1.0, retry_on=TRANSIENT_ERRORS):
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(requests_per_second) if requests_per_second else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retry_on = retry_on
+
+    def call(self, func, *args, **kwargs):
+        """Call ``func`` once the rate limit allows, retrying transient failures."""
+        for attempt in range(self.max_retries + 1):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                return func(*args, **kwargs)
+            except self.retry_on as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt + random.uniform(0, self.backoff)
+                metrics.add('query_retries', seconds=delay)
+                print(f"Query failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def map(self, func, items):
+        """
+        Apply ``func`` to every item on the worker pool, yielding results in order.
+
+        At most ``2 * max_workers`` items are in flight, so results are
+        consumed as a stream instead of being held all at once.
+        """
+        if self.max_workers <= 1:
+            for item in items:
+                yield func(item)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = deque()
+            for item in items:
+                pending.append(pool.submit(func, item))
+                if len(pending) >= 2 * self.max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
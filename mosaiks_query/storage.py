@@ -0,0 +1,299 @@
+"""Reading and writing MOSAIKS feature tables.
+
+The file format is picked from the extension: ``.parquet`` (the default for
+outputs), ``.feather``/``.arrow`` (Arrow IPC) or ``.csv``. Binary formats keep
+the X_0..X_3999 features as float32, which halves file size and skips text
+parsing, and let readers load only the columns they need.
+"""
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from mosaiks_query import metrics
+
+OUTPUT_DIR = "output"
+OUTPUT_FORMAT = "parquet"
+
+_FEATURE_PATTERN = re.compile(r"X_\d+")
+
+
+def output_path(name: str, directory: str = OUTPUT_DIR, fmt: str = OUTPUT_FORMAT):
+    """Return the path of an output table, e.g. ``output/coords_inside.parquet``."""
+    return os.path.join(directory, f"{name}.{fmt}")
+
+
+def _format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        return "parquet"
+    if ext in (".feather", ".arrow"):
+        return "feather"
+    if ext == ".csv":
+        return "csv"
+    raise ValueError(f"Unsupported table format: {path}")
+
+
+def feature_columns(columns):
+    """Return the MOSAIKS feature columns (X_0, X_1, ...) in their original order."""
+    return [col for col in columns if _FEATURE_PATTERN.fullmatch(str(col))]
+
+
+def to_float32(df):
+    """Downcast the feature columns of a DataFrame to float32."""
+    features = feature_columns(df.columns)
+    if not features:
+        return df
+    return df.astype({col: np.float32 for col in features})
+
+
+def write_table(df, path: str, index: bool = False, float32: bool = True):
+    """
+    Write a DataFrame in the format given by the path's extension.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Table to write. Geometry columns must be dropped or converted first.
+    path : str
+        Output path ending in .parquet, .feather/.arrow or .csv.
+    index : bool, optional
+        Whether to keep the index as a column.
+    float32 : bool, optional
+        Store feature columns as float32 (ignored for CSV).
+    """
+    fmt = _format(path)
+    tmp_path = f"{path}.tmp"
+    started = time.perf_counter()
+    rows = len(df)
+    if fmt == "csv":
+        df.to_csv(tmp_path, index=index)
+    else:
+        if float32:
+            df = to_float32(df)
+        if index:
+            df = df.reset_index()
+        if fmt == "parquet":
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.reset_index(drop=True).to_feather(tmp_path)
+    os.replace(tmp_path, path)
+    metrics.add('table.write', seconds=time.perf_counter() - started, rows=rows, bytes=os.path.getsize(path))
+
+
+def read_table(path: str, columns=None):
+    """
+    Read a table written by `write_table`, optionally loading only some columns.
+
+    Parameters
+    ----------
+    path : str
+        Input path ending in .parquet, .feather/.arrow or .csv.
+    columns : list of str, optional
+        Columns to load, e.g. ``['lon', 'lat', 'v_shp_id', 'X_0', 'X_1']``.
+        Binary formats read only these columns from disk.
+    """
+    fmt = _format(path)
+    started = time.perf_counter()
+    if fmt == "parquet":
+        df = pd.read_parquet(path, columns=columns)
+    elif fmt == "feather":
+        df = pd.read_feather(path, columns=columns)
+    else:
+        df = pd.read_csv(path, usecols=columns)
+    metrics.add('table.read', seconds=time.perf_counter() - started, rows=len(df), bytes=os.path.getsize(path))
+    return df
+
+
+def read_schema(path: str):
+    """Return the column names of a table without loading its rows."""
+    fmt = _format(path)
+    if fmt == "csv":
+        return list(pd.read_csv(path, nrows=0).columns)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt == "parquet":
+        return pq.read_schema(path).names
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def count_rows(path: str):
+    """Return the number of rows in a table, reading only metadata where possible."""
+    fmt = _format(path)
+    if fmt == "csv":
+        return sum(len(chunk) for chunk in pd.read_csv(path, usecols=[0], chunksize=100_000))
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt == "parquet":
+        return pq.ParquetFile(path).metadata.num_rows
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+
+def iter_table(path: str, columns=None, batch_rows: int = 65_536):
+    """
+    Yield a table as a sequence of DataFrames without loading it all at once.
+
+    Parquet and CSV files are read ``batch_rows`` rows at a time; Arrow IPC
+    files are read one record batch at a time (one per frame written by
+    `TableWriter`).
+    """
+    batches = _iter_batches(path, columns, batch_rows)
+    while True:
+        started = time.perf_counter()
+        frame = next(batches, None)
+        if frame is None:
+            return
+        metrics.add('table.read', seconds=time.perf_counter() - started, rows=len(frame))
+        yield frame
+
+
+def _iter_batches(path, columns, batch_rows):
+    fmt = _format(path)
+    if fmt == "csv":
+        yield from pd.read_csv(path, usecols=columns, chunksize=batch_rows)
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt == "parquet":
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=columns):
+            yield batch.to_pandas()
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if columns is not None:
+                batch = batch.select(columns)
+            yield batch.to_pandas()
+
+
+def patch_table(path: str, rows, drop_ids, id_column: str, sort_columns=(), batch_rows: int = 65_536):
+    """
+    Replace the rows of some IDs in a table sorted by ``id_column``.
+
+    The table is streamed batch by batch: rows whose ID is in ``drop_ids``
+    are removed and ``rows`` are merged in at their sorted position, so the
+    result stays sorted and memory stays at one batch. The patched table
+    replaces ``path`` atomically; if no rows are left it is an empty table
+    with the same columns.
+
+    Parameters
+    ----------
+    path : str
+        Table sorted by ``id_column`` (then ``sort_columns``), e.g. the
+        output of `pipeline.query_villages`.
+    rows : pd.DataFrame
+        New rows with the table's columns; their IDs must be in ``drop_ids``
+        or absent from the table.
+    drop_ids : array-like
+        IDs whose rows are removed (changed and deleted polygons).
+    id_column : str
+        Column the table is sorted by.
+    sort_columns : tuple of str, optional
+        Secondary sort columns, e.g. ``('lon', 'lat')``.
+    batch_rows : int, optional
+        Rows per batch read.
+    """
+    order = [id_column] + list(sort_columns)
+    rows = rows[read_schema(path)].sort_values(by=order, ignore_index=True)
+    new_ids = rows[id_column].to_numpy()
+    drop_ids = pd.unique(np.asarray(drop_ids))
+    start = 0
+    empty = None
+    with TableWriter(path) as writer:
+        for batch in iter_table(path, batch_rows=batch_rows):
+            if empty is None:
+                empty = batch.iloc[:0]
+            batch = batch[~batch[id_column].isin(drop_ids)]
+            if batch.empty:
+                continue
+            # New rows sorting before this batch's last ID go in with it
+            stop = int(np.searchsorted(new_ids, batch[id_column].iloc[-1], side='right'))
+            if stop > start:
+                batch = pd.concat([batch, rows.iloc[start:stop]], ignore_index=True)
+                batch = batch.sort_values(by=order, kind='stable', ignore_index=True)
+                start = stop
+            writer.write(batch)
+        writer.write(rows.iloc[start:])
+    if writer.rows == 0:
+        # The writer only replaces the table once it has rows; write an empty one in its place
+        write_table(empty if empty is not None else rows, path)
+    return writer.rows
+
+
+class TableWriter:
+    """
+    Append DataFrames to one table file as they arrive.
+
+    Parquet files get one row group per frame and Arrow IPC files one record
+    batch per frame, so writers never hold more than the current frame. Every
+    frame must have the same columns as the first one.
+
+    Use as a context manager; the file only appears at ``path`` once the
+    writer is closed without an error.
+    """
+
+    def __init__(self, path: str, index: bool = False, float32: bool = True):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.format = _format(path)
+        self.index = index
+        self.float32 = float32
+        self.rows = 0
+        self.seconds = 0.0
+        self._writer = None
+        self._schema = None
+
+    def write(self, frame):
+        if frame.empty:
+            return
+        started = time.perf_counter()
+        self._write(frame)
+        self.rows += len(frame)
+        self.seconds += time.perf_counter() - started
+
+    def _write(self, frame):
+        if self.format == "csv":
+            frame.to_csv(self.tmp_path, mode='w' if self.rows == 0 else 'a',
+                         header=self.rows == 0, index=self.index)
+            return
+
+        import pyarrow as pa
+
+        if self.float32:
+            frame = to_float32(frame)
+        if self.index:
+            frame = frame.reset_index()
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema.remove_metadata()
+            if self.format == "parquet":
+                import pyarrow.parquet as pq
+                self._writer = pq.ParquetWriter(self.tmp_path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self.tmp_path, self._schema)
+        self._writer.write_table(table.replace_schema_metadata(None).cast(self._schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self.rows > 0:
+            os.replace(self.tmp_path, self.path)
+            metrics.add('table.write', seconds=self.seconds, rows=self.rows, bytes=os.path.getsize(self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._writer is not None:
+            self._writer.close()
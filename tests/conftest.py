@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The tests import the mosaiks_query package from the checkout and the
+# synthetic dataset from benchmarks/, the same way run_benchmarks.py does
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+from mosaiks_query import metrics  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
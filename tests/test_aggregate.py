@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from mosaiks_query.aggregate import STATS, VillageAggregator, aggregate_stream
+from mosaiks_query.feature_store import FeatureStore
+from mosaiks_query.storage import write_table
+
+FEATURES = ['X_0', 'X_1', 'X_2']
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(5)
+    # Village 9 has a single point, so its std is undefined
+    ids = np.r_[np.repeat([4, 1, 7, 3], [11, 6, 9, 13]), 9]
+    df = pd.DataFrame(rng.standard_normal((len(ids), 3)).astype(np.float32), columns=FEATURES)
+    df.insert(0, 'v_shp_id', ids)
+    df.loc[[2, 15, 30], 'X_1'] = np.nan
+    return df
+
+
+def expected(points, stats):
+    """The in-memory groupby the aggregator replaces; missing values count as 0."""
+    groups = points.fillna(0).astype({name: np.float64 for name in FEATURES}).groupby('v_shp_id')
+    columns = [groups[FEATURES].mean()]
+    if 'count' in stats:
+        columns.insert(0, groups.size().rename('count'))
+    for stat in ('std', 'min', 'max'):
+        if stat in stats:
+            columns.append(getattr(groups[FEATURES], stat)().add_suffix(f'_{stat}'))
+    return pd.concat(columns, axis=1).reset_index()
+
+
+def chunks(points, size):
+    return (points.iloc[start:start + size] for start in range(0, len(points), size))
+
+
+@pytest.mark.parametrize('stats', [('mean',), STATS])
+@pytest.mark.parametrize('chunk_rows', [1, 5, 1000])
+def test_chunks_match_groupby(points, stats, chunk_rows):
+    # Shuffled, so chunk boundaries split villages and villages come back in later chunks
+    shuffled = points.sample(frac=1, random_state=0)
+
+    result = aggregate_stream(chunks(shuffled, chunk_rows), stats=stats)
+
+    pd.testing.assert_frame_equal(result, expected(points, stats), check_dtype=False, rtol=1e-6)
+
+
+def test_table_path_is_read_in_batches(points, tmp_path):
+    path = str(tmp_path / 'points.parquet')
+    write_table(points, path)
+
+    result = aggregate_stream(path, stats=STATS, batch_rows=4)
+
+    pd.testing.assert_frame_equal(result, expected(points, STATS), check_dtype=False, rtol=1e-6)
+
+
+def test_feature_store_matches_groupby(points, tmp_path):
+    path = str(tmp_path / 'points.parquet')
+    write_table(points.sort_values(by='v_shp_id', kind='stable'), path)
+    store = FeatureStore.build(path, str(tmp_path / 'features'))
+
+    result = aggregate_stream(store, stats=STATS, batch_rows=4)
+
+    pd.testing.assert_frame_equal(result, expected(points, STATS), check_dtype=False, rtol=1e-6)
+
+
+def test_unknown_statistic_is_rejected():
+    with pytest.raises(ValueError, match="median"):
+        VillageAggregator(stats=('mean', 'median'))
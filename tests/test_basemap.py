@@ -0,0 +1,78 @@
+import os
+import urllib.request
+
+import numpy as np
+import pytest
+import shapely
+
+from mosaiks_query.basemap import (ORIGIN, TILE_PIXELS, BasemapTiles, _plot_limits, render_shrid_images,
+                                   tiles_for_bounds, to_mercator)
+
+pytest.importorskip('matplotlib')
+Image = pytest.importorskip('PIL.Image')
+
+ZOOM = 15
+
+SHRID = shapely.Polygon([(75.001, 20.001), (75.009, 20.002), (75.008, 20.009), (75.002, 20.007)])
+
+# The (x, y) tiles an image of SHRID covers, margins included
+NEEDED = tiles_for_bounds(_plot_limits(to_mercator(np.array([SHRID], dtype=object))[0].bounds), ZOOM)
+
+
+@pytest.fixture(autouse=True)
+def no_network(monkeypatch):
+    def urlopen(*args, **kwargs):
+        raise AssertionError("offline mode tried to download a tile")
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+
+
+@pytest.fixture
+def tiles(tmp_path):
+    """An offline tile cache seeded with one flat-coloured PNG per tile under SHRID."""
+    tiles = BasemapTiles(cache_dir=str(tmp_path / 'basemap'), name='test', offline=True)
+    for n, (x, y) in enumerate(NEEDED):
+        path = tiles.path(ZOOM, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.new('RGB', (TILE_PIXELS, TILE_PIXELS), (40 * n, 100, 200)).save(path, format='PNG')
+    return tiles
+
+
+# 2 renders on the worker pool, whose workers always run offline
+@pytest.mark.parametrize('processes', [1, 2])
+def test_render_from_seeded_cache(tiles, tmp_path, processes):
+    output = str(tmp_path / 'shrid.png')
+
+    written = render_shrid_images([SHRID], [output], tiles=tiles, zoom=ZOOM, processes=processes,
+                                  figsize=(2, 2), dpi=50)
+
+    assert written == 1
+    with Image.open(output) as image:
+        assert image.size[0] > 0
+    assert not os.path.exists(f"{output}.tmp.png")
+    # Existing images are skipped
+    assert render_shrid_images([SHRID], [output], tiles=tiles, zoom=ZOOM, processes=1) == 0
+
+
+def test_mosaic_stitches_cached_tiles(tiles):
+    x, y = NEEDED[0]
+    size = 2 * ORIGIN / 2 ** ZOOM
+    bounds = (-ORIGIN + (x + 0.25) * size, ORIGIN - (y + 0.75) * size,
+              -ORIGIN + (x + 0.75) * size, ORIGIN - (y + 0.25) * size)
+
+    image, extent = tiles.mosaic(bounds, ZOOM)
+
+    assert image.shape == (TILE_PIXELS, TILE_PIXELS, 3)
+    assert (image == [0, 100, 200]).all()
+    assert extent[1] - extent[0] == pytest.approx(size)
+
+
+def test_missing_tile_fails_without_download(tiles, tmp_path):
+    x, y = NEEDED[-1]
+    os.remove(tiles.path(ZOOM, x, y))
+    output = str(tmp_path / 'shrid.png')
+
+    with pytest.raises(FileNotFoundError, match="offline mode"):
+        render_shrid_images([SHRID], [output], tiles=tiles, zoom=ZOOM, processes=1)
+    with pytest.raises(FileNotFoundError, match="offline mode"):
+        tiles.read(ZOOM, x, y)
+    assert not os.path.exists(output)
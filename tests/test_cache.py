@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+from synthetic import SyntheticDataset
+
+from mosaiks_query.cache import TileCache
+from mosaiks_query.lattice import cell_keys, index_keys
+
+
+@pytest.fixture
+def dataset():
+    return SyntheticDataset(num_features=3)
+
+
+@pytest.fixture
+def cache(dataset, tmp_path):
+    return TileCache(dataset, table_name='t', cache_dir=str(tmp_path))
+
+
+def keys_of(rows):
+    return np.sort(cell_keys(rows['lon'], rows['lat']))
+
+
+def test_second_box_query_hits_the_cache(cache, dataset):
+    rows = cache.get_box(75.0, 20.0, 75.5, 20.4)
+    queries = dataset.queries
+
+    again = cache.get_box(75.0, 20.0, 75.5, 20.4)
+    inner = cache.get_box(75.1, 20.05, 75.35, 20.2)
+
+    assert len(rows) == 50 * 40
+    assert np.array_equal(keys_of(again), keys_of(rows))
+    assert len(inner) == 25 * 15
+    assert dataset.queries == queries
+
+
+def test_second_cell_query_hits_the_cache(cache, dataset):
+    keys = index_keys(np.arange(7500, 7540), np.full(40, 2015))
+    rows = cache.get_cells(keys)
+    queries = dataset.queries
+
+    again = cache.get_cells(np.concatenate([keys, keys[::3]]))
+
+    assert np.array_equal(keys_of(rows), np.sort(keys))
+    assert np.array_equal(keys_of(again), np.sort(keys))
+    assert dataset.queries == queries
+
+
+def test_partial_tile_is_completed(cache, dataset):
+    # Tile (250, 67) covers lon 75.0-75.3 and lat 20.1-20.4
+    tile = (250, 67)
+    first = index_keys(np.arange(7500, 7510), np.full(10, 2015))
+    second = index_keys(np.arange(7505, 7515), np.full(10, 2020))
+
+    cache.get_cells(first)
+    assert not cache.is_complete(tile)
+    assert np.array_equal(np.load(cache._cells_path(tile)), np.sort(first))
+
+    queries = dataset.queries
+    rows = cache.get_cells(np.concatenate([first[:5], second]))
+    assert dataset.queries > queries
+    assert np.array_equal(keys_of(rows), np.sort(np.concatenate([first[:5], second])))
+    assert np.array_equal(np.load(cache._cells_path(tile)), np.union1d(first, second))
+
+    # Everything asked for so far is on disk
+    queries = dataset.queries
+    cache.get_cells(np.concatenate([first, second]))
+    assert dataset.queries == queries
+
+    # Downloading the whole tile drops the cell list and marks it complete
+    assert len(cache.get_tile(tile)) == 30 * 30
+    assert cache.is_complete(tile)
+    assert not os.path.exists(cache._cells_path(tile))
+    queries = dataset.queries
+    cache.get_cells(index_keys(np.arange(7520, 7530), np.full(10, 2039)))
+    assert dataset.queries == queries
+
+
+@pytest.mark.parametrize('lons, lats', [
+    # Either side of the tile corner at lon 75.3, lat 20.1, plus a repeat and an interior cell
+    ([75.295, 75.305, 75.295, 75.305, 75.295, 75.145], [20.095, 20.095, 20.105, 20.105, 20.095, 20.245]),
+    # Either side of the equator and the prime meridian
+    ([-0.005, 0.005, -0.005, 0.005], [-0.005, -0.005, 0.005, 0.005]),
+])
+def test_get_points_returns_exactly_the_requested_cells(cache, lons, lats):
+    rows = cache.get_points(lons, lats)
+
+    expected = np.unique(cell_keys(lons, lats))
+    assert len(rows) == len(expected)
+    assert np.array_equal(keys_of(rows), expected)
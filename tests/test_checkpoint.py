@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from synthetic import SyntheticDataset
+
+from mosaiks_query.cache import TileCache
+from mosaiks_query.checkpoint import TileManifest
+from mosaiks_query.executor import stream_box
+
+BOUNDS = (74.95, 19.95, 75.65, 20.35)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return TileCache(SyntheticDataset(num_features=3), table_name='t', cache_dir=str(tmp_path / 'cache'))
+
+
+def download(cache, manifest, limit=None):
+    tiles = manifest.pending(cache.tiles_for_box(*BOUNDS))[:limit]
+    for tile, rows in stream_box(cache, *BOUNDS, tiles=tiles, verbose=False):
+        manifest.record(tile, rows)
+
+
+def test_resumed_download_merges_cached_tiles(cache, tmp_path):
+    directory = str(tmp_path / 'parts')
+    download(cache, TileManifest(directory, 't', BOUNDS), limit=4)
+
+    # A rerun picks up the remaining tiles and remembers the box
+    manifest = TileManifest(directory, 't')
+    assert len(manifest.pending(cache.tiles_for_box(*BOUNDS))) == len(cache.tiles_for_box(*BOUNDS)) - 4
+    download(cache, manifest)
+    queries = cache.dataset.queries
+
+    output = str(tmp_path / 'merged.parquet')
+    count = TileManifest(directory, 't').merge(output, cache)
+
+    merged = pd.read_parquet(output)
+    expected = cache.get_box(*BOUNDS).sort_values(by=['lon', 'lat'], ignore_index=True)
+    assert count == len(merged) == 70 * 40
+    assert np.array_equal(merged[['lon', 'lat']].to_numpy(), expected[['lon', 'lat']].to_numpy())
+    assert merged[['lon', 'lat']].equals(merged[['lon', 'lat']].sort_values(by=['lon', 'lat'], ignore_index=True))
+    # The rows live in the tile cache only
+    assert cache.dataset.queries == queries
+    assert os.listdir(directory) == ['manifest.json']
+
+
+def test_manifest_rejects_another_table(tmp_path):
+    TileManifest(str(tmp_path), 't', BOUNDS).record((0, 0), [])
+
+    with pytest.raises(ValueError):
+        TileManifest(str(tmp_path), 'other')
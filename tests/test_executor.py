@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from synthetic import SyntheticDataset
+
+from mosaiks_query.cache import TileCache
+from mosaiks_query.executor import bucket_bounds, stream_cells, stream_query, write_sorted_stream
+from mosaiks_query.lattice import cell_keys, index_keys
+from mosaiks_query.scheduler import QueryScheduler
+
+
+class NestingScheduler(QueryScheduler):
+    """Records how many `map` calls are running at once."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.active = self.deepest = 0
+
+    def map(self, func, items):
+        self.active += 1
+        self.deepest = max(self.deepest, self.active)
+        try:
+            yield from super().map(func, items)
+        finally:
+            self.active -= 1
+
+
+def test_stream_cells_yields_each_tile_without_nesting_pools(tmp_path):
+    scheduler = NestingScheduler(max_workers=4)
+    cache = TileCache(SyntheticDataset(num_features=2, jitter=0.01), table_name='t', cache_dir=str(tmp_path),
+                      scheduler=scheduler)
+    # Cells scattered over a 3 x 3 block of tiles, some repeated
+    cols, rows = np.meshgrid(np.arange(7500, 7590, 7), np.arange(2010, 2100, 11))
+    keys = index_keys(cols.ravel(), rows.ravel())
+
+    tiles = list(stream_cells(cache, np.concatenate([keys, keys[:10]]), verbose=False))
+
+    assert [tile for tile, _ in tiles] == sorted(cache.tiles_for_keys(keys))
+    assert len(tiles) == 9
+    for tile, tile_rows in tiles:
+        assert np.array_equal(np.sort(cell_keys(tile_rows['lon'], tile_rows['lat'])),
+                              np.sort(cache.tiles_for_keys(keys)[tile]))
+    assert scheduler.deepest == 1
+
+
+@pytest.mark.parametrize('columns, expected', [
+    (['X_2', 'X_0'], ['lon', 'lat', 'X_2', 'X_0']),
+    (None, ['lon', 'lat', 'X_0', 'X_1', 'X_2', 'X_3']),
+])
+def test_stream_query_projects_every_batch(columns, expected):
+    # The synthetic dataset answers every query with all its columns, whatever the SELECT list
+    dataset = SyntheticDataset(num_features=4)
+    cols, rows = np.meshgrid(np.arange(7500, 7540, 3), np.arange(2000, 2020, 2))
+    keys = index_keys(cols.ravel(), rows.ravel())
+
+    frames = list(stream_query(dataset, keys, table_name='t', columns=columns))
+
+    assert all(list(frame.columns) == expected for frame in frames)
+    streamed = np.concatenate([cell_keys(frame['lon'], frame['lat']) for frame in frames])
+    assert np.array_equal(np.sort(streamed), np.sort(keys))
+
+
+def test_bucket_bounds_split_by_row_count():
+    bounds = bucket_bounds(np.array(['c', 'a', 'd', 'b', 'e']), np.array([5, 4, 1, 3, 6]), bucket_rows=6)
+
+    # a:0-3, b:4-6, c:7-11, d:12, e:13-18 start in buckets 0, 0, 1, 2, 2
+    assert bounds.tolist() == ['c', 'd']
+
+
+@pytest.mark.parametrize('bucket_rows', [1, 7, 1000])
+def test_write_sorted_stream_sorts_across_frames(tmp_path, bucket_rows):
+    rng = np.random.default_rng(0)
+    ids = np.array([f"11-{n:03d}" for n in range(40)], dtype=object)
+    rows = pd.DataFrame({'shrid2': rng.choice(ids, 300), 'lon': rng.integers(0, 50, 300) / 100 + 75.005,
+                         'lat': 20.005, 'X_0': rng.standard_normal(300)}).drop_duplicates(['shrid2', 'lon'])
+    shuffled = rows.sample(frac=1, random_state=1).set_index('shrid2')
+    frames = [shuffled.iloc[start:start + 50] for start in range(0, len(shuffled), 50)]
+    bounds = bucket_bounds(ids, np.full(len(ids), 8), bucket_rows=bucket_rows)
+    path = str(tmp_path / 'merged.parquet')
+
+    count = write_sorted_stream(frames, path, ['shrid2', 'lon', 'lat'], bounds, index=True)
+
+    written = pd.read_parquet(path)
+    expected = rows.sort_values(by=['shrid2', 'lon', 'lat'], ignore_index=True)
+    assert count == len(rows)
+    assert list(written.columns) == ['shrid2', 'lon', 'lat', 'X_0']
+    assert written['shrid2'].tolist() == expected['shrid2'].tolist()
+    assert np.allclose(written['lon'], expected['lon'])
+    assert np.allclose(written['X_0'], expected['X_0'], rtol=1e-6)
+    assert not os.path.exists(f"{path}.parts")
@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mosaiks_query import feature_store
+from mosaiks_query.feature_store import FeatureStore
+from mosaiks_query.storage import write_table
+
+
+def table(tmp_path, rows, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.standard_normal((rows, 4)).astype(np.float32), columns=[f'X_{i}' for i in range(4)])
+    df.insert(0, 'v_shp_id', np.arange(rows))
+    path = str(tmp_path / f'rows_{seed}.parquet')
+    write_table(df, path)
+    return path, df
+
+
+def test_rebuild_replaces_every_file(tmp_path):
+    directory = str(tmp_path / 'features')
+    FeatureStore.build(table(tmp_path, 30, seed=0)[0], directory)
+    path, df = table(tmp_path, 20, seed=1)
+
+    store = FeatureStore.build(path, directory, batch_rows=7)
+
+    assert np.array_equal(store.features, df.filter(like='X_').to_numpy())
+    assert store.index['v_shp_id'].tolist() == df['v_shp_id'].tolist()
+    assert sorted(os.listdir(directory)) == ['features.npy', 'index.parquet', 'meta.json']
+
+
+@pytest.mark.parametrize('completed', [0, 1, 2])
+def test_interrupted_rebuild_is_detected(tmp_path, monkeypatch, completed):
+    directory = str(tmp_path / 'features')
+    FeatureStore.build(table(tmp_path, 30, seed=0)[0], directory)
+    path, _ = table(tmp_path, 20, seed=1)
+
+    # Stop the rebuild after swapping in only some of its files
+    replace = os.replace
+    calls = []
+
+    def interrupted(src, dst):
+        if len(calls) == completed:
+            raise KeyboardInterrupt
+        calls.append(dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(feature_store.os, 'replace', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        FeatureStore.build(path, directory)
+    monkeypatch.undo()
+
+    if completed == 0:
+        # Nothing was swapped in, so the old store is still whole
+        assert len(FeatureStore(directory).index) == 30
+    else:
+        with pytest.raises(ValueError, match="interrupted build"):
+            FeatureStore(directory)
@@ -0,0 +1,86 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from synthetic import synthetic_villages
+
+from mosaiks_query.grid_join import CellMembership
+from mosaiks_query.lattice import cell_keys
+
+
+def centre(index):
+    """Coordinate of a lattice centre, as MOSAIKS stores it."""
+    return (10 * index + 5) / 1000
+
+
+@pytest.fixture
+def polygons():
+    villages = list(synthetic_villages(9, seed=4).geometry)
+    c = centre
+    shapes = [
+        # Two parts, one of them a triangle
+        shapely.MultiPolygon([shapely.box(75.101, 20.002, 75.128, 20.031),
+                              shapely.Polygon([(75.141, 20.0), (75.171, 20.004), (75.152, 20.036)])]),
+        # A hole in the middle
+        shapely.box(75.181, 20.001, 75.239, 20.059).difference(shapely.box(75.198, 20.018, 75.222, 20.042)),
+        # Edges along rows and columns of centres, vertices on centres
+        shapely.box(c(7525), c(2000), c(7530), c(2005)),
+        # Diagonal edges through centres and a vertex on a centre
+        shapely.Polygon([(c(7532), c(2000)), (c(7537), c(2005)), (c(7542), c(2000))]),
+        # A hole whose edges run along centres
+        shapely.box(c(7544), c(2000), c(7552), c(2008)).difference(shapely.box(c(7546), c(2002), c(7550), c(2006))),
+        # A sliver between centres, covering none
+        shapely.box(75.261, 20.061, 75.264, 20.064),
+    ]
+    geometries = villages + shapes
+    return gpd.GeoDataFrame({'id': np.arange(len(geometries)) + 100}, geometry=geometries, crs="EPSG:4326")
+
+
+@pytest.fixture
+def points():
+    cols, rows = np.meshgrid(np.arange(7495, 7560), np.arange(1995, 2015))
+    lon, lat = centre(cols.ravel()), centre(rows.ravel())
+    return gpd.GeoDataFrame({'lon': lon, 'lat': lat}, geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326")
+
+
+def sjoin_pairs(points, polygons):
+    joined = gpd.sjoin(points, polygons, predicate='within')
+    return pd.DataFrame({'id': joined['id'].to_numpy(), 'cell': cell_keys(joined['lon'], joined['lat'])})
+
+
+def membership_pairs(polygons, bbox=False):
+    membership = CellMembership.from_geometries(polygons.geometry.values, polygons['id'].to_numpy(), bbox=bbox)
+    return membership.to_frame('id')
+
+
+def assert_same_pairs(a, b):
+    a = a.sort_values(by=['id', 'cell'], ignore_index=True)
+    b = b.sort_values(by=['id', 'cell'], ignore_index=True)
+    pd.testing.assert_frame_equal(a, b, check_dtype=False)
+
+
+def test_membership_matches_sjoin(points, polygons):
+    expected = sjoin_pairs(points, polygons)
+
+    assert_same_pairs(membership_pairs(polygons), expected)
+    # Every special shape has cells except the sliver, and the boundary cases are exercised
+    assert set(expected['id']) == set(polygons['id'][:-1])
+    # Centres on the edges of the on-centre box are outside: 4 x 4 of its 6 x 6 centres remain
+    assert (expected['id'] == 111).sum() == 16
+
+
+def test_bbox_membership_matches_sjoin_on_boxes(points, polygons):
+    boxes = polygons.assign(geometry=shapely.box(*polygons.geometry.bounds.to_numpy().T))
+
+    assert_same_pairs(membership_pairs(polygons, bbox=True), sjoin_pairs(points, boxes))
+
+
+def test_join_fans_rows_out_like_sjoin(points, polygons):
+    membership = CellMembership.from_geometries(polygons.geometry.values, polygons['id'].to_numpy())
+    rows = pd.DataFrame(points.drop(columns='geometry')).assign(value=np.arange(len(points)))
+
+    joined = membership.join(rows, id_column='id')
+
+    expected = gpd.sjoin(points, polygons, predicate='within')
+    assert sorted(zip(joined['id'], joined['value'])) == sorted(zip(expected['id'], expected.index))
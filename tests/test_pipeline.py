@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from synthetic import SyntheticDataset, synthetic_villages
+
+from mosaiks_query.cache import TileCache
+from mosaiks_query.pipeline import stream_villages, update_villages
+from mosaiks_query.storage import read_table
+
+# A sliver between lattice centres, so it covers no cell
+NO_CELLS = shapely.box(75.001, 20.001, 75.004, 20.004)
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    # Membership caches go under cache/ in the working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'out').mkdir()
+    (tmp_path / 'ref').mkdir()
+    villages = synthetic_villages(16, seed=2)
+    villages['name'] = [f"village {n}" for n in villages['v_shp_id']]
+    cache = TileCache(SyntheticDataset(num_features=3), table_name='t', cache_dir='cache')
+    return villages, cache
+
+
+def save(villages, name):
+    path = f"{name}.shp"
+    villages.to_file(path)
+    return path
+
+
+def edit_add(villages):
+    return villages
+
+
+def edit_modify(villages):
+    villages = villages.copy()
+    villages.loc[villages['v_shp_id'] == 3, 'geometry'] = shapely.affinity.translate(
+        villages.geometry[villages['v_shp_id'] == 3].iloc[0], 0.006, 0.004)
+    villages.loc[villages['v_shp_id'] == 5, 'name'] = "renamed"
+    return villages.iloc[:12]
+
+
+def edit_remove(villages):
+    return villages.iloc[:12][~villages['v_shp_id'].iloc[:12].isin([2, 7])]
+
+
+def edit_no_cells(villages):
+    extra = villages.iloc[:1].assign(v_shp_id=99, name="sliver", geometry=[NO_CELLS])
+    return pd.concat([villages.iloc[:12], extra], ignore_index=True)
+
+
+def sorted_table(path, id_column='v_shp_id'):
+    table = read_table(path)
+    return table.sort_values(by=[c for c in (id_column, 'lon', 'lat') if c in table.columns], ignore_index=True)
+
+
+@pytest.mark.parametrize('edit', [edit_add, edit_modify, edit_remove, edit_no_cells])
+def test_update_matches_full_rebuild(workspace, edit):
+    villages, cache = workspace
+    update_villages(cache, save(villages.iloc[:12], 'before'), output='out/coords_inside.parquet')
+    edited = save(edit(villages), 'after')
+
+    changes = update_villages(cache, edited, output='out/coords_inside.parquet')
+    queries = cache.dataset.queries
+    update_villages(cache, edited, output='ref/coords_inside.parquet')
+
+    assert len(changes.added) + len(changes.modified) + len(changes.removed) > 0
+    # The rebuild only reads cells the update already cached
+    assert cache.dataset.queries == queries
+    for name in ('coords_inside.parquet', 'coords_inside_average.parquet'):
+        pd.testing.assert_frame_equal(sorted_table(f'out/{name}'), sorted_table(f'ref/{name}'), check_dtype=False)
+
+
+def test_update_to_polygons_without_cells_empties_the_tables(workspace):
+    villages, cache = workspace
+    update_villages(cache, save(villages.iloc[:12], 'before'), output='out/coords_inside.parquet')
+    columns = {name: list(read_table(f'out/{name}').columns)
+               for name in ('coords_inside.parquet', 'coords_inside_average.parquet')}
+    queries = cache.dataset.queries
+
+    # Every polygon shrinks to a sliver, so all rows go and nothing is queried
+    changes = update_villages(cache, save(villages.iloc[:12].assign(geometry=[NO_CELLS] * 12), 'after'),
+                              output='out/coords_inside.parquet')
+
+    assert len(changes.modified) == 12
+    assert cache.dataset.queries == queries
+    for name, names in columns.items():
+        table = read_table(f'out/{name}')
+        assert table.empty
+        assert list(table.columns) == names
+
+
+def test_update_without_changes_is_a_no_op(workspace):
+    villages, cache = workspace
+    path = save(villages.iloc[:12], 'before')
+    update_villages(cache, path, output='out/coords_inside.parquet')
+    queries = cache.dataset.queries
+
+    changes = update_villages(cache, path, output='out/coords_inside.parquet')
+
+    assert [len(ids) for ids in changes] == [0, 0, 0]
+    assert cache.dataset.queries == queries
+    assert np.array_equal(sorted_table('out/coords_inside.parquet')['v_shp_id'].unique(), np.arange(1, 13))
+
+
+def test_stream_villages_keeps_only_selected_columns(workspace):
+    villages, cache = workspace
+    path = save(villages, 'villages')
+
+    output = stream_villages(cache.dataset, path, output='out/streamed.parquet', columns=['X_1'], table_name='t')
+
+    streamed = read_table(output)
+    assert list(streamed.columns) == ['lon', 'lat', 'X_1', 'v_shp_id']
+    assert set(streamed['v_shp_id']) == set(villages['v_shp_id'])
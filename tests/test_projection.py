@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from synthetic import SyntheticDataset
+
+from mosaiks_query.feature_store import FeatureStore
+from mosaiks_query.lattice import index_keys
+from mosaiks_query.projection import FeatureProjection
+from mosaiks_query.storage import write_table
+
+decomposition = pytest.importorskip('sklearn.decomposition')
+
+BATCH_ROWS = 500
+
+
+@pytest.fixture(scope='module')
+def rows():
+    cols, lat_rows = np.meshgrid(np.arange(7500, 7560), np.arange(2000, 2040))
+    return SyntheticDataset(num_features=60).rows_for(index_keys(cols.ravel(), lat_rows.ravel()))
+
+
+@pytest.fixture(scope='module')
+def features(rows):
+    return rows.filter(like='X_').to_numpy()
+
+
+def aligned(projection, reference, features):
+    """First component and PCA_1 scores of ``reference``, flipped to the sign of ``projection``."""
+    sign = np.sign(projection.components[0] @ reference.components_[0])
+    return sign * reference.components_[0], sign * reference.transform(features.astype(np.float64))[:, 0]
+
+
+def test_randomized_fit_matches_pca(features):
+    projection = FeatureProjection.fit(features, method='randomized', batch_rows=BATCH_ROWS)
+    component, scores = aligned(projection, decomposition.PCA(n_components=1).fit(features), features)
+
+    assert np.allclose(projection.components[0], component, atol=1e-6)
+    assert np.allclose(projection.transform(features)[:, 0], scores, rtol=1e-4, atol=1e-4)
+
+
+def test_incremental_fit_matches_pca(features):
+    projection = FeatureProjection.fit(features, method='incremental', batch_rows=BATCH_ROWS)
+    reference = decomposition.PCA(n_components=1).fit(features)
+    component, scores = aligned(projection, reference, features)
+
+    # Incremental PCA only approximates the full fit...
+    assert projection.components[0] @ component > 0.995
+    assert np.abs(projection.transform(features)[:, 0] - scores).max() < 0.05 * np.abs(scores).max()
+
+    # ...and matches sklearn's IncrementalPCA fed the same batches
+    incremental = decomposition.IncrementalPCA(n_components=1, batch_size=BATCH_ROWS).fit(features)
+    component, scores = aligned(projection, incremental, features)
+    assert np.allclose(projection.components[0], component, atol=1e-5)
+    assert np.allclose(projection.transform(features)[:, 0], scores, rtol=1e-3, atol=1e-3)
+
+
+def test_sign_is_stable_across_methods(features):
+    incremental = FeatureProjection.fit(features, method='incremental', batch_rows=BATCH_ROWS)
+    randomized = FeatureProjection.fit(features, method='randomized', batch_rows=BATCH_ROWS)
+
+    assert incremental.components[0] @ randomized.components[0] > 0.995
+
+
+@pytest.mark.parametrize('method', ['incremental', 'randomized'])
+def test_saved_projection_scores_the_same(features, rows, tmp_path, method):
+    path = str(tmp_path / 'pca.npz')
+    projection = FeatureProjection.load_or_fit(path, features, method=method, batch_rows=BATCH_ROWS)
+
+    # The saved file is reused; no source is needed to score with it
+    loaded = FeatureProjection.load_or_fit(path, None)
+
+    assert loaded.feature_names == projection.feature_names
+    assert np.array_equal(loaded.components, projection.components)
+    assert np.array_equal(loaded.transform(features), projection.transform(features))
+
+    # Scores from a table path and a feature store match the in-memory ones
+    table = str(tmp_path / 'rows.parquet')
+    write_table(rows, table)
+    store = FeatureStore.build(table, str(tmp_path / 'features'))
+    assert np.allclose(loaded.transform_source(table, batch_rows=333), projection.transform(features), atol=1e-4)
+    assert np.allclose(loaded.transform_source(store, batch_rows=333), projection.transform(features), atol=1e-4)
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from synthetic import SyntheticDataset
+
+from mosaiks_query.aggregate import aggregate_stream
+from mosaiks_query.grid_join import CellMembership
+from mosaiks_query.lattice import index_keys
+from mosaiks_query.planner import AdaptiveBatchSize
+from mosaiks_query.pushdown import LocalDataset, aggregate_in_query, membership_runs
+
+STATS = ('mean', 'count', 'std')
+
+
+def box(x0, y0, x1, y1):
+    return shapely.box(75 + x0, 20 + y0, 75 + x1, 20 + y1)
+
+
+@pytest.fixture
+def villages():
+    # A U whose middle rows hold two separate runs of cells
+    u_shape = box(0, 0, 0.06, 0.05).difference(box(0.02, 0.015, 0.04, 0.06))
+    # Two squares in the same lattice rows, several columns apart
+    islands = shapely.MultiPolygon([box(0.07, 0, 0.09, 0.02), box(0.11, 0, 0.13, 0.02)])
+    # Overlaps the U, so some cells belong to two villages
+    corner = box(0, 0, 0.03, 0.03)
+    return CellMembership.from_geometries(np.array([u_shape, islands, corner]), np.array([11, 12, 13]))
+
+
+@pytest.fixture
+def rows():
+    cols, lat_rows = np.meshgrid(np.arange(7500, 7515), np.arange(2000, 2006))
+    rows = SyntheticDataset(num_features=5).rows_for(index_keys(cols.ravel(), lat_rows.ravel()))
+    # A few cells without data and a missing feature value
+    rows = rows.drop(index=[0, 17, 40]).reset_index(drop=True)
+    rows.loc[5, 'X_2'] = np.nan
+    return rows
+
+
+def test_villages_have_non_contiguous_runs(villages):
+    runs = membership_runs(villages)
+    per_row = runs.groupby(['owner', 'row']).size()
+    assert per_row.loc[0].max() >= 2
+    assert per_row.loc[1].max() >= 2
+
+
+@pytest.mark.parametrize('max_columns, batch_literals', [
+    (1900, 1000),
+    # One village per query and two features per query
+    (6, 4),
+])
+def test_aggregate_in_query_matches_local_aggregation(villages, rows, max_columns, batch_literals):
+    dataset = LocalDataset()
+    dataset.add_table('mosaiks', rows)
+    dataset.max_columns = max_columns
+
+    pushed = aggregate_in_query(dataset, villages, table_name='mosaiks', id_column='v_shp_id', stats=STATS,
+                                batch_size=AdaptiveBatchSize(initial=batch_literals, minimum=batch_literals))
+    local = aggregate_stream(villages.join(rows, id_column='v_shp_id'), id_column='v_shp_id', stats=STATS)
+
+    assert pushed['v_shp_id'].tolist() == [11, 12, 13]
+    pd.testing.assert_frame_equal(pushed, local, check_dtype=False, rtol=1e-5)
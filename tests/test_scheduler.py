@@ -0,0 +1,68 @@
+import time
+
+import pytest
+from synthetic import SyntheticDataset
+
+from mosaiks_query import metrics
+from mosaiks_query.scheduler import QueryScheduler
+
+
+def point_sql(i):
+    return f"SELECT * FROM t WHERE lon = {75.005 + 0.01 * i:.3f} AND lat = 20.005"
+
+
+def test_transient_failures_are_retried():
+    dataset = SyntheticDataset(num_features=2, errors={1: ConnectionError("reset"), 2: TimeoutError("slow")})
+    scheduler = QueryScheduler(max_retries=3, backoff=0.0)
+
+    df = scheduler.call(dataset.query, point_sql(0)).to_pandas_dataframe()
+
+    assert len(df) == 1
+    assert dataset.calls == 3
+    assert dataset.queries == 1
+    assert metrics.counters()['query_retries']['calls'] == 2
+
+
+def test_retries_give_up_after_max_retries():
+    dataset = SyntheticDataset(num_features=2, failure_rate=1.0)
+    scheduler = QueryScheduler(max_retries=2, backoff=0.0)
+
+    with pytest.raises(ConnectionError):
+        scheduler.call(dataset.query, point_sql(0))
+    assert dataset.calls == 3
+
+
+@pytest.mark.parametrize('error', [ValueError("malformed query"), KeyError('X_0')])
+def test_other_errors_propagate_without_retry(error):
+    dataset = SyntheticDataset(num_features=2, errors={1: error})
+    scheduler = QueryScheduler(max_retries=3, backoff=0.0)
+
+    with pytest.raises(type(error)):
+        scheduler.call(dataset.query, point_sql(0))
+    assert dataset.calls == 1
+    assert 'query_retries' not in metrics.counters()
+
+
+def test_map_keeps_submission_order_under_jitter():
+    dataset = SyntheticDataset(num_features=2, jitter=0.02, failure_rate=0.2, seed=3)
+    scheduler = QueryScheduler(max_workers=4, max_retries=10, backoff=0.0)
+
+    results = scheduler.map(lambda i: scheduler.call(dataset.query, point_sql(i)).to_pandas_dataframe(),
+                            range(40))
+    lons = [df['lon'].iloc[0] for df in results]
+
+    assert lons == pytest.approx([75.005 + 0.01 * i for i in range(40)])
+    assert dataset.calls > dataset.queries == 40
+
+
+def test_requests_per_second_is_respected():
+    dataset = SyntheticDataset(num_features=2)
+    scheduler = QueryScheduler(max_workers=4, requests_per_second=20)
+
+    start = time.monotonic()
+    list(scheduler.map(lambda i: scheduler.call(dataset.query, point_sql(i)), range(40)))
+    elapsed = time.monotonic() - start
+
+    # A one second burst of 20, then the other 20 at 20 per second
+    assert elapsed >= 0.9
+    assert dataset.queries == 40
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from mosaiks_query.storage import patch_table, read_table, write_table
+
+
+@pytest.fixture(params=['parquet', 'feather', 'csv'])
+def table(request, tmp_path):
+    path = str(tmp_path / f"table.{request.param}")
+    rows = pd.DataFrame({'v_shp_id': np.repeat([1, 2, 3, 4], 3), 'lon': np.tile([75.005, 75.015, 75.025], 4),
+                         'lat': 20.005, 'X_0': np.arange(12, dtype=np.float32)})
+    write_table(rows, path)
+    return path, rows
+
+
+def test_patch_replaces_rows_in_order(table):
+    path, rows = table
+    new = pd.DataFrame({'v_shp_id': [5, 2], 'lon': [75.005, 75.035], 'lat': 20.005, 'X_0': [-1.0, -2.0]})
+
+    count = patch_table(path, new, drop_ids=[2, 3], id_column='v_shp_id', sort_columns=('lon', 'lat'), batch_rows=4)
+
+    patched = read_table(path)
+    assert count == len(patched) == 8
+    assert patched['v_shp_id'].tolist() == [1, 1, 1, 2, 4, 4, 4, 5]
+    assert patched.loc[patched['v_shp_id'] == 2, 'X_0'].tolist() == [-2.0]
+
+
+def test_patch_removing_every_row_leaves_an_empty_table(table):
+    path, rows = table
+
+    count = patch_table(path, rows.iloc[:0], drop_ids=[1, 2, 3, 4], id_column='v_shp_id', batch_rows=4)
+
+    patched = read_table(path)
+    assert count == 0
+    assert patched.empty
+    assert list(patched.columns) == list(rows.columns)